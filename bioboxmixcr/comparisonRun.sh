@@ -1,20 +1,39 @@
 #This file contains the commands to run the biobox encased project Mixcr
 #8-20-15
+#Usage (from the top level directory): ./bioboxmixcr/comparisonRun.sh [simulated input csv]
+#The last line of output is '<name of biobox>:<path to plot directory>', which comparison.py records in its registry
+#Each run gets its own directory under ./bioboxmixcr/runs with its own biobox.yml, input, output, and plots, so the checkout isn't modified and concurrent runs don't step on each other
 #================
 #generate input yaml file and move to input directory
 #python inputDir/MixcrYamlFileGenerator.py
 #mv biobox.yml ./inputDir
+set -o errexit
 #================
-#run docker commands 
+#set up this run's directory, and copy the input sample (or the default one) into it
+INPUTFILE=./bioboxmixcr/inputDir/simu-10-leaves-1-mutate.csv
+if [ $# -gt 0 ] ; then
+	INPUTFILE=$1
+fi
+mkdir -p ./bioboxmixcr/runs
+RUNDIR=$(cd $(mktemp -d ./bioboxmixcr/runs/run.XXXXXX) && pwd)
+mkdir -p $RUNDIR/input $RUNDIR/output
+cp $INPUTFILE $RUNDIR/input/
+BBXINPUT=/bbx/input/$(basename $INPUTFILE)
+#the input directory is mounted read-only, so convert csv input to fasta here rather than inside the container
+if [ ${INPUTFILE: -4} == ".csv" ] ; then
+	python ./bioboxmixcr/conversionScripts/csv2fasta.py $RUNDIR/input/$(basename $INPUTFILE)
+	BBXINPUT=${BBXINPUT:0:${#BBXINPUT}-4}'.fasta'
+fi
+#write this run's biobox.yml: the mixcr flags from the checked-in one, pointed at this run's input
+sed "s|^inputfile:.*|inputfile: $BBXINPUT|" ./bioboxmixcr/inputDir/biobox.yml > $RUNDIR/input/biobox.yml
+#================
+#run docker commands
 docker build -t bioboxmixcr ./bioboxmixcr
-docker run --volume="$(pwd)/bioboxmixcr/inputDir:/bbx/input:ro" --volume="$(pwd)/bioboxmixcr/outputDir:/bbx/output:rw" bioboxmixcr 
+docker run --volume="$RUNDIR/input:/bbx/input:ro" --volume="$RUNDIR/output:/bbx/output:rw" bioboxmixcr
 #================
 #run plot performance on this biobox
-#python plotPython/mixcrparser.py
-plotDir=$(python ./bioboxmixcr/plotPython/mixcrparser.py)
-plotDir=$plotDir | rev | cut -d ' ' -f2 | rev
+plotDir=$RUNDIR/plots
+python ./bioboxmixcr/plotPython/mixcrparser.py --stream --germline-dir ./bioboxmixcr/plotPython/data/imgt --simfile $INPUTFILE --mixcr-output $RUNDIR/output/output.txt --plotdir $plotDir --quiet
 #================
-#write name of biobox and corresponding path to output file into file containing address
-echo bioboxmixcr:$(pwd)/bioboxmixcr/plotPython/$plotDir > dataFile.txt
-
-
+#write name of biobox and corresponding path to the plot directory
+echo bioboxmixcr:$plotDir
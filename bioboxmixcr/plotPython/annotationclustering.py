@@ -1,15 +1,152 @@
 import sys
 import csv
 import math
+import heapq
+import multiprocessing
+from collections import OrderedDict
+import numpy
 from subprocess import check_call
 from sklearn.metrics.cluster import adjusted_mutual_info_score
 
 import utils
 import plotting
 from opener import opener
+from truthindex import TruthIndex
 
 # ----------------------------------------------------------------------------------------
-def vollmers(info, threshold, reco_info=None, debug=False):
+def get_d_plus_insertions(line):
+    return line['vd_insertion'] + line['d_qr_seq'] + line['dj_insertion']
+
+# ----------------------------------------------------------------------------------------
+class BucketNeighbors(object):
+    """
+    The pairs of seqs in one bucket whose hamming fraction is at most <max_fraction>, as each seq's neighbors sorted by hamming fraction: the neighbors of the ith seq are
+    neighbors[starts[i] : starts[i + 1]], with their fractions in the same slice of <fractions>. So getting the neighbors for any cutoff up to <max_fraction> is just a slice of each row.
+    """
+    __slots__ = ('max_fraction', 'starts', 'neighbors', 'fractions')
+
+    def __init__(self, max_fraction, starts, neighbors, fractions):
+        self.max_fraction = max_fraction
+        self.starts = starts
+        self.neighbors = neighbors
+        self.fractions = fractions
+
+    @classmethod
+    def from_seqs(cls, seqs, max_fraction):
+        """ <seqs> are all the same length """
+        rows, cols, fractions = [], [], []
+        if len(seqs) > 1 and max_fraction >= 0.:
+            if len(seqs[0]) == 0:  # hamming_fraction() is zero for zero-length seqs
+                codes = None
+            else:
+                codes, ambig = utils.encode_seqs(seqs)
+            for iseq in range(len(seqs) - 1):  # one row at a time, so we never have all n^2 / 2 fractions at once
+                if codes is None:
+                    row_fractions = numpy.zeros(len(seqs) - iseq - 1)
+                else:
+                    row_fractions = utils.hamming_fractions((codes[iseq : iseq + 1], ambig[iseq : iseq + 1]), (codes[iseq + 1 :], ambig[iseq + 1 :]))
+                icloses = numpy.nonzero(row_fractions <= max_fraction)[0]
+                rows.append(numpy.full(len(icloses), iseq, dtype=numpy.int32))
+                cols.append((icloses + iseq + 1).astype(numpy.int32))
+                fractions.append(row_fractions[icloses])
+        if len(rows) > 0:
+            rows, cols, fractions = numpy.concatenate(rows), numpy.concatenate(cols), numpy.concatenate(fractions)
+        else:
+            rows, cols, fractions = numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0)
+        rows, cols, fractions = numpy.concatenate((rows, cols)), numpy.concatenate((cols, rows)), numpy.concatenate((fractions, fractions))  # each pair goes in both seqs' rows
+        order = numpy.lexsort((cols, fractions, rows))  # by seq, then by fraction
+        starts = numpy.zeros(len(seqs) + 1, dtype=numpy.int32)
+        starts[1:] = numpy.cumsum(numpy.bincount(rows, minlength=len(seqs)))
+        return cls(max_fraction, starts, cols[order], fractions[order])
+
+    def get_neighbor_lists(self, max_fraction):
+        """ list of each seq's neighbors with hamming fraction at most <max_fraction> """
+        if max_fraction > self.max_fraction:
+            raise Exception('asked for neighbors within %f, but only kept them within %f (make the buckets with a larger <max_fraction>)' % (max_fraction, self.max_fraction))
+        n_close = numpy.zeros(len(self.fractions) + 1, dtype=int)
+        n_close[1:] = numpy.cumsum(self.fractions <= max_fraction)
+        ends = self.starts[:-1] + (n_close[self.starts[1:]] - n_close[self.starts[:-1]])  # rows are sorted by fraction, so the close ones are at the start of each row
+        neighbors = self.neighbors.tolist()
+        return [neighbors[start : end] for start, end in zip(self.starts[:-1].tolist(), ends.tolist())]
+
+# ----------------------------------------------------------------------------------------
+def get_bucket_neighbors(args):
+    """ BucketNeighbors.from_seqs() with one argument, for multiprocessing """
+    seqs, max_fraction = args
+    return BucketNeighbors.from_seqs(seqs, max_fraction)
+
+# ----------------------------------------------------------------------------------------
+def get_vollmers_buckets(info, max_fraction, n_procs=1):
+    """
+    Split the queries in <info> into the buckets within which vollmers() can put them in the same cluster (same v gene, j gene, cdr3 length, and length of d + insertions), and find the pairs in each bucket
+    whose d + insertions have hamming fraction at most <max_fraction>.
+    Returns a list of (uids, BucketNeighbors), with the uids in each bucket in the same order as in info.keys().
+    The neighbors don't depend on the threshold, so if you're trying several thresholds, make this once with <max_fraction> set to one minus the smallest one and pass it to vollmers() each time.
+    """
+    buckets = OrderedDict()
+    for uid in info:
+        seq = get_d_plus_insertions(info[uid])
+        key = (info[uid]['v_gene'], info[uid]['j_gene'], info[uid]['cdr3_length'], len(seq))
+        if key not in buckets:
+            buckets[key] = ([], [])
+        buckets[key][0].append(uid)
+        buckets[key][1].append(seq)
+
+    seq_lists = [seqs for _, seqs in buckets.values()]
+    if n_procs > 1:
+        ibuckets = sorted(range(len(seq_lists)), key=lambda ib: len(seq_lists[ib]), reverse=True)  # start the big ones first
+        pool = multiprocessing.Pool(n_procs)
+        bucket_neighbors = pool.map(get_bucket_neighbors, [(seq_lists[ib], max_fraction) for ib in ibuckets], chunksize=1)
+        pool.close()
+        pool.join()
+        neighbors = [None for _ in seq_lists]
+        for ib, bneighbors in zip(ibuckets, bucket_neighbors):
+            neighbors[ib] = bneighbors
+    else:
+        neighbors = [BucketNeighbors.from_seqs(seqs, max_fraction) for seqs in seq_lists]
+
+    return [(uids, bneighbors) for (uids, _), bneighbors in zip(buckets.values(), neighbors)]
+
+# ----------------------------------------------------------------------------------------
+def get_bucket_clusters(neighbors):
+    """
+    Cluster the seqs in one bucket the way vollmers() has always done it: start a cluster with the first unclustered seq, then make passes through the unclustered seqs
+    (in order) adding any that match a seq that's already in the cluster, until a pass adds nothing.
+    Instead of actually making the passes we keep a queue of the seqs that match something in the cluster: the ones after our position in the current pass get added
+    during this pass, and the ones before it during the next one. So the clusters (and the order of seqs within them) are the same, but we only look at each match once.
+    <neighbors> is each seq's list of matches (from BucketNeighbors.get_neighbor_lists()). Returns a list of clusters, each a list of indices into the bucket.
+    """
+    n_seqs = len(neighbors)
+    clustered = [False for _ in range(n_seqs)]
+    queued = [False for _ in range(n_seqs)]  # is it in <this_pass>? (so we only put each seq in once)
+    clusters = []
+    for iseed in range(n_seqs):
+        if clustered[iseed]:
+            continue
+        cluster = []
+        this_pass, next_pass = [iseed, ], set()  # everything before <iseed> is already clustered, so the first pass can take all of the seed's matches
+        while len(this_pass) > 0:
+            while len(this_pass) > 0:
+                iseq = heapq.heappop(this_pass)
+                cluster.append(iseq)
+                clustered[iseq] = True
+                for jseq in neighbors[iseq]:
+                    if clustered[jseq] or queued[jseq]:
+                        continue
+                    if jseq > iseq:
+                        heapq.heappush(this_pass, jseq)
+                        queued[jseq] = True
+                    else:
+                        next_pass.add(jseq)
+            this_pass = sorted(next_pass)  # (a sorted list is a valid heap)
+            for iseq in this_pass:
+                queued[iseq] = True
+            next_pass = set()
+        clusters.append(cluster)
+    return clusters
+
+# ----------------------------------------------------------------------------------------
+def vollmers(info, threshold, reco_info=None, truth_index=None, buckets=None, n_procs=1, debug=False):
     """
     From Vollmers paper:
         Lineage Clustering. IGH sequences were clustered into IGH lineages according
@@ -25,88 +162,34 @@ def vollmers(info, threshold, reco_info=None, debug=False):
       - if *any* sequence already in the cluster is 90% to the prospective sequence that it's added to the cluster
       - 'sequences the same length' means cdr3 the same length (entire sequence the same length only made sense for their primers
       - since the 90% is on d + insertions, also have to not merge if the d + insertions aren't the same length
+    Sequences can only be in the same cluster if they're in the same bucket from get_vollmers_buckets(), so we cluster each bucket separately (pass in <buckets> if you've already made them, with a <max_fraction> of at least 1 - <threshold>).
+    If you're calling this more than once with the same <reco_info>, pass in a TruthIndex for it as <truth_index> so we don't remake it every time.
     """
+    if buckets is None:
+        buckets = get_vollmers_buckets(info, 1. - threshold, n_procs=n_procs)
 
-    id_clusters = {}  # map from cluster id to list of query names
-
-    def get_d_plus_insertions(uid):
-        return info[uid]['vd_insertion'] + info[uid]['d_qr_seq'] + info[uid]['dj_insertion']
-
-    def get_cdr3_seq(uid):
-        cpos = info[uid]['cyst_position']
-        tpos = info[uid]['tryp_position']
-        assert len(info[uid]['seqs']) == 1
-        seq = info[uid]['seqs'][0]
-        cdr3_seq = seq[cpos : tpos+3]
-        if len(cdr3_seq) != info[uid]['cdr3_length']:
-            raise Exception('ERROR bad cdr3 sequence %s %d' % (cdr3_seq, info[uid]['cdr3_length']))
-        return cdr3_seq
-
-    def from_same_lineage(cluster_id, uid):
-        for clid in id_clusters[cluster_id]:  # loop over seqs already in the cluster (it only has to match one of 'em)
-            is_match = True
-            for key in ('cdr3_length', 'v_gene', 'j_gene'):  # same cdr3 length, v gene, and j gene
-                if info[clid][key] != info[uid][key]:
-                    is_match = False
-                    break
-            if not is_match:
-                continue
-            cl_seq = get_d_plus_insertions(clid)
-            u_seq = get_d_plus_insertions(uid)
-            if len(cl_seq) != len(u_seq):
-                continue
-            hamming_frac = utils.hamming_fraction(cl_seq, u_seq)
-            if hamming_frac > 1. - threshold:
-                continue
-
-            return True  # if we get to here, it's a match
-
-        return False
-
-    def check_unclustered_seqs():
-        """ loop through all unclustered sequences, adding them to the most recently created cluster """
-        uids_to_remove = []
-        for unique_id in unclustered_seqs:
-            assert unique_id not in id_clusters[last_cluster_id]  # not sure why I had the below, but I swear it's impossible. Remove this assertion when it fails to get triggered for a while
-            # if unique_id in id_clusters[last_cluster_id]:  # sequence is already in this cluster
-            #     continue
-            if from_same_lineage(last_cluster_id, unique_id):
-                if debug:
-                    print '     adding', unique_id
-                id_clusters[last_cluster_id].append(unique_id)
-                uids_to_remove.append(unique_id)
-        for uid in uids_to_remove:
-            unclustered_seqs.remove(uid)
-
-    def add_cluster(clid):
-        if debug:
-            print '  starting cluster %d' % clid
-        id_clusters[clid] = [unclustered_seqs[0],]
-        unclustered_seqs.remove(unclustered_seqs[0])
-        while True:
-            last_size = len(id_clusters[clid])
-            check_unclustered_seqs()
-            if last_size == len(id_clusters[clid]):  # stop when cluster stops growing
-                break
-            if debug:
-                print '    running again (%d --> %d)' % (last_size, len(id_clusters[clid]))
+    clusters = []
+    for uids, neighbors in buckets:
+        for cluster in get_bucket_clusters(neighbors.get_neighbor_lists(1. - threshold)):
+            clusters.append([uids[iseq] for iseq in cluster])
 
-    # the business
-    unclustered_seqs = info.keys()
-    last_cluster_id = 0
-    while len(unclustered_seqs) > 0:
-        add_cluster(last_cluster_id)
-        last_cluster_id += 1
+    # each cluster's first seq is the one it was started with, so sort them by where that is in <info> to get the same cluster ids as if we'd done all the buckets at once
+    info_index = {uid : iuid for iuid, uid in enumerate(info)}
+    clusters.sort(key=lambda cluster: info_index[cluster[0]])
+    id_clusters = {clid : clusters[clid] for clid in range(len(clusters))}  # map from cluster id to list of query names
+    if debug:
+        for clid in range(len(clusters)):
+            print '  cluster %d: %s' % (clid, ' '.join(clusters[clid]))
 
     adj_mi = -1
     if reco_info is not None:
-        true_cluster_list, inferred_cluster_list = [], []
-        for clid, uids in id_clusters.items():
-            for uid in uids:
-                true_cluster_list.append(reco_info[uid]['reco_id'])
-                inferred_cluster_list.append(clid)
+        if truth_index is None:
+            truth_index = TruthIndex(reco_info)
+        uids = [uid for clid in id_clusters for uid in id_clusters[clid]]
+        true_cluster_list = truth_index.get_labels(uids)
+        inferred_cluster_list = [clid for clid in id_clusters for _ in id_clusters[clid]]
         adj_mi = adjusted_mutual_info_score(true_cluster_list, inferred_cluster_list)
-        print '       threshold  %.2f:   %d clusters (%d true)   adj_mi: %.3f' % (threshold, len(set(inferred_cluster_list)), len(set(true_cluster_list)), adj_mi)
+        print '       threshold  %.2f:   %d clusters (%d true)   adj_mi: %.3f' % (threshold, len(id_clusters), len(set(true_cluster_list)), adj_mi)
 
     partition = [uids for uids in id_clusters.values()]  # convert to list of lists (no clid info)
     return adj_mi, partition
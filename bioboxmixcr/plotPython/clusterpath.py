@@ -4,16 +4,19 @@ import math
 import csv
 
 import utils
+import partitioncheck
+from partitionstore import PartitionStore, CompactPartition
+from mutualinfo import AdjMIScorer
 from opener import opener
 
 # ----------------------------------------------------------------------------------------
 class ClusterPath(object):
-    def __init__(self, initial_path_index):
+    def __init__(self, initial_path_index, uid_table=None):
         self.initial_path_index = initial_path_index
 
         # NOTE make *damn* sure if you add another list here that you also take care of it in remove_first_partition()
         self.n_lists = 5  # just to make sure you don't forget
-        self.partitions = []
+        self.partitions = PartitionStore(uid_table)  # indexing it gives you a list of lists of uids, but it's stored as integer ids and merges (see partitionstore.py)
         self.logprobs = []
         self.logweights = []
         self.adj_mis = []
@@ -32,6 +35,7 @@ class ClusterPath(object):
                 break
 
     def add_partition(self, partition, logprob, n_procs, logweight=None, adj_mi=None):
+        """ <partition> is either a list of lists of uids, or a CompactPartition from a path with the same uid table """
         # # don't add it if it's the same as the last partition
         # UPDATE we can get in trouble if we don't add duplicates, because they can have different numbers of procs... the duplicates don't really matter, anyway, as for most purposes I ignore partitions with greater than 1 proc
         # if len(self.partitions) > 0 and len(partition) == len(self.partitions[-1]) and logprob == self.logprobs[-1]:
@@ -49,18 +53,40 @@ class ClusterPath(object):
     def remove_first_partition(self):
         # NOTE after you do this, none of the 'best' shit is any good any more
         assert self.n_lists == 5  # make sure we didn't add another list and forget to put it in here
-        self.partitions.pop(0)
+        del self.partitions[0]
         self.logprobs.pop(0)
         self.logweights.pop(0)
         self.adj_mis.pop(0)
         self.n_procs.pop(0)
 
     # ----------------------------------------------------------------------------------------
-    def readfile(self, fname):
+    def add_path(self, path):
+        """ append all the partitions in <path> (without converting them back to uids, if we have the same uid table) """
+        for ip in range(len(path.partitions)):
+            partition = path.partitions.get_compact_for(ip, self.partitions.uid_table)
+            self.add_partition(partition, path.logprobs[ip], path.n_procs[ip], logweight=path.logweights[ip], adj_mi=path.adj_mis[ip])
+
+    # ----------------------------------------------------------------------------------------
+    def calculate_adj_mis(self, reco_info):
+        """ set all the adj mis, only rebuilding the contingency table for partitions that aren't stored as a merge of the previous one """
+        scorer = AdjMIScorer(reco_info)
+        for ip in range(len(self.partitions)):
+            record = self.partitions.records[ip]
+            if ip > 0 and not isinstance(record, CompactPartition):
+                scorer.merge(*record[:3])
+            else:
+                scorer.set_partition(self.partitions[ip])
+            self.adj_mis[ip] = scorer.get_adj_mi()
+
+    # ----------------------------------------------------------------------------------------
+    def readfile(self, fname, expected_ids=None):
+        """ if <expected_ids> is set, make sure each partition has each of them exactly once (and nothing else) """
         with opener('r')(fname) as infile:
             reader = csv.DictReader(infile)
             for line in reader:
                 partition = [cl.split(':') for cl in line['clusters'].split(';')]
+                if expected_ids is not None:
+                    partitioncheck.assert_partition_ok(partition, expected_ids=expected_ids, extra_str=' in %s' % fname)
                 logweight = float(line['logweight']) if 'logweight' in line else None
                 adj_mi = float(line['adj_mi']) if 'adj_mi' in line else None
                 self.add_partition(partition, float(line['logprob']), int(line['n_procs']), logweight=logweight, adj_mi=adj_mi)
@@ -72,7 +98,7 @@ class ClusterPath(object):
                 delta_str = '%.1f' % (self.logprobs[ip] - self.logprobs[ip-1])
             else:
                 delta_str = ''
-            print '      %5s  %-12.2f%-7s   %-5d  %5d' % (extrastr, self.logprobs[ip], delta_str, len(self.partitions[ip]), self.n_procs[ip]),
+            print '      %5s  %-12.2f%-7s   %-5d  %5d' % (extrastr, self.logprobs[ip], delta_str, self.partitions.n_clusters[ip], self.n_procs[ip]),
 
             # logweight (and inverse of number of potential parents)
             if self.logweights[ip] is not None:
@@ -147,12 +173,13 @@ class ClusterPath(object):
         """ Return the parent clusters that were merged to form the <ipart>th partition. """
         if ipart == 0:
             raise Exception('get_parent_clusters got ipart of zero... that don\'t make no sense yo')
-        if len(self.partitions[ipart - 1]) <= len(self.partitions[ipart]):
+        if self.partitions.n_clusters[ipart - 1] <= self.partitions.n_clusters[ipart]:
             return None  # this step isn't a merging step -- it's a synthetic rewinding step due to multiple processes
 
         parents = []
+        current_partition = self.partitions[ipart]
         for cluster in self.partitions[ipart - 1]:  # find all clusters in the previous partition that aren't in the current one
-            if cluster not in self.partitions[ipart]:
+            if cluster not in current_partition:
                 parents.append(cluster)
         assert len(parents) == 2  # there should've been two -- those're the two that were merged to form the new cluster
         return parents
@@ -180,8 +207,7 @@ class ClusterPath(object):
         # TODO switch clusterpath.cc back to using these
         def potential_n_parents(partition):
             combifactor = 0
-            for cluster in partition:
-                n_k = len(cluster)
+            for n_k in partition.sizes().tolist():  # tolist() so we get python ints, which don't overflow
                 combifactor += pow(2, n_k - 1) - 1
             if combifactor == 0:
                 combifactor = 1
@@ -192,11 +218,12 @@ class ClusterPath(object):
                 last_logweight = 0.
             else:
                 last_logweight = self.logweights[ip-1]
-            this_logweight = last_logweight + math.log(1. / potential_n_parents(self.partitions[ip]))
+            this_logweight = last_logweight + math.log(1. / potential_n_parents(self.partitions.get_compact(ip)))
             self.logweights[ip] = this_logweight
 
     # ----------------------------------------------------------------------------------------
-    def write_partitions(self, writer, is_data, reco_info, true_partition, smc_particles, path_index, n_to_write=None, calc_adj_mi=None):
+    def write_partitions(self, writer, is_data, reco_info, truth_index, smc_particles, path_index, n_to_write=None, calc_adj_mi=None):
+        """ <truth_index> is a TruthIndex for <reco_info> (None for data) """
         for ipart in self.get_partition_subset(n_partitions=n_to_write):
             part = self.partitions[ipart]
             cluster_str = ''
@@ -205,20 +232,8 @@ class ClusterPath(object):
                 if ic > 0:
                     cluster_str += ';'
                 cluster_str += ':'.join(part[ic])
-                if not is_data:
-                    same_event = utils.from_same_event(is_data, reco_info, part[ic])  # are all the sequences from the same event?
-                    entire_cluster = True  # ... and if so, are they the entire true cluster?
-                    if same_event:
-                        reco_id = reco_info[part[ic][0]]['reco_id']  # they've all got the same reco_id then, so pick an aribtrary one
-                        true_cluster = true_partition[reco_id]
-                        for uid in true_cluster:
-                            if uid not in part[ic]:
-                                entire_cluster = False
-                                break
-                    else:
-                        entire_cluster = False
-                    if not same_event or not entire_cluster:
-                        bad_clusters.append(':'.join(part[ic]))
+                if not is_data and not truth_index.is_true_cluster(part[ic]):  # are all the sequences from the same event, and are they the entire true cluster?
+                    bad_clusters.append(':'.join(part[ic]))
 
             if len(bad_clusters) > 25:
                 bad_clusters = ['too', 'long']
@@ -237,6 +252,6 @@ class ClusterPath(object):
                         row['adj_mi'] = utils.mutual_information(part, reco_info)
                     else:
                         row['adj_mi'] = self.adj_mis[ipart]
-                row['n_true_clusters'] = len(true_partition)
+                row['n_true_clusters'] = len(truth_index.partition)
                 row['bad_clusters'] = ';'.join(bad_clusters)
             writer.writerow(row)
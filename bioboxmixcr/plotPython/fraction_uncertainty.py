@@ -1,6 +1,39 @@
-import cached_uncertainties
+import os
+import math
+import numpy
 from scipy.stats import beta
 
+# binary version of the (obs, total) --> (lo, hi) dict in cached_uncertainties.py: a float array of shape (max total + 1, max obs + 1, 2), with nan where there's no cached value
+cache_fname = os.path.dirname(os.path.realpath(__file__)) + '/cached_uncertainties.npy'
+cache_table = None
+
+# ----------------------------------------------------------------------------------------
+def write_cache_table(outfname=cache_fname):
+    """ convert the dict in cached_uncertainties.py to the binary table that we actually read (only needs to be rerun if cached_uncertainties.py changes) """
+    import cached_uncertainties  # takes a few seconds, which is the whole point of not importing it
+    keys = [[int(n) for n in key.split('/')] for key in cached_uncertainties.errs]
+    table = numpy.empty((max(k[1] for k in keys) + 1, max(k[0] for k in keys) + 1, 2))
+    table.fill(numpy.nan)
+    for key, val in cached_uncertainties.errs.items():
+        obs, total = [int(n) for n in key.split('/')]
+        table[total, obs] = val
+    numpy.save(outfname, table)
+
+# ----------------------------------------------------------------------------------------
+def get_cache_table():
+    """ memory-map the cache table the first time it's needed """
+    global cache_table
+    if cache_table is None:
+        if not os.path.exists(cache_fname):
+            write_cache_table()
+        cache_table = numpy.load(cache_fname, mmap_mode='r')
+    return cache_table
+
+# ----------------------------------------------------------------------------------------
+def is_integral(val):
+    """ the cache is only used for integer obs and total (string keys like '3.0/10.0' never matched the old cache dict, and we keep it that way) """
+    return isinstance(val, (int, long, numpy.integer))
+
 # ----------------------------------------------------------------------------------------
 def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
     """ Return uncertainty on the ratio n / total """
@@ -8,9 +41,10 @@ def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
     if total == 0.0:
         return (0.0, 0.0, False)
 
-    key = str(obs) + '/' + str(total)
-    if use_cache and key in cached_uncertainties.errs:
-        return cached_uncertainties.errs[key] + (True, )
+    if use_cache and is_integral(obs) and is_integral(total):
+        table = get_cache_table()
+        if total < table.shape[0] and obs < table.shape[1] and not numpy.isnan(table[total, obs, 0]):
+            return (float(table[total, obs, 0]), float(table[total, obs, 1]), True)
 
     frac = float(obs) / total
     if use_beta or frac == 0.0 or frac == 1.0:  # still need to use beta for 0 and 1 'cause the sqrt thing below gives garbage for those cases
@@ -36,3 +70,65 @@ def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
     assert lo < frac or frac == 0.0
     assert frac < hi or frac == 1.0
     return (lo, hi) + (False, )
+
+# ----------------------------------------------------------------------------------------
+def err_many(obs, total, use_beta=True, use_cache=True, for_paper=False):
+    """
+    Vectorized version of err(): return arrays (lo, hi, cached) for each ratio obs[i] / total[i].
+    Cache hits are looked up all at once, and beta.ppf() is called once (well, up to three times) for all the misses.
+    """
+    obs = numpy.asarray(obs)
+    total = numpy.asarray(total)
+    assert obs.shape == total.shape
+    assert (obs <= total).all()
+    lo, hi = numpy.zeros(obs.shape), numpy.zeros(obs.shape)
+    cached = numpy.zeros(obs.shape, dtype=bool)
+
+    todo = total != 0  # zero total gives (0, 0, False)
+    if use_cache and numpy.issubdtype(obs.dtype, numpy.integer) and numpy.issubdtype(total.dtype, numpy.integer):
+        table = get_cache_table()
+        in_table = todo & (total < table.shape[0]) & (obs < table.shape[1])
+        itotal, iobs = total[in_table], obs[in_table]
+        vals = table[itotal, iobs]  # fancy indexing copies just the entries we need out of the memory map
+        hits = ~numpy.isnan(vals[..., 0])
+        cached[in_table] = hits
+        lo[in_table] = numpy.where(hits, vals[..., 0], 0.)
+        hi[in_table] = numpy.where(hits, vals[..., 1], 0.)
+        todo &= ~cached
+
+    obs_f, total_f = obs[todo].astype(float), total[todo].astype(float)
+    frac = obs_f / total_f
+    this_lo, this_hi = numpy.zeros(frac.shape), numpy.zeros(frac.shape)
+    use_beta_here = numpy.ones(frac.shape, dtype=bool) if use_beta else ((frac == 0.0) | (frac == 1.0))  # still need to use beta for 0 and 1 'cause the sqrt thing below gives garbage for those cases
+    if use_beta_here.any():
+        if for_paper:  # total volume of confidence interval
+            vol = 0.95  # use 95% for paper
+            cpr = 0.5  # constant from prior (jeffreys for paper)
+        else:
+            vol = 2./3  # otherwise +/- 1 sigma
+            cpr = 1.  # constant prior
+        a, b, bfrac = cpr + obs_f[use_beta_here], cpr + total_f[use_beta_here] - obs_f[use_beta_here], frac[use_beta_here]
+        blo = beta.ppf((1. - vol)/2, a, b)
+        bhi = beta.ppf((1. + vol)/2, a, b)
+        low_side = bfrac < blo  # if k/n very small (probably zero), take a one-sided c.i. with 2/3 (0.95) the mass
+        if low_side.any():
+            blo[low_side] = 0.
+            bhi[low_side] = beta.ppf(vol, a[low_side], b[low_side])
+        high_side = bfrac > bhi  # same deal if k/n very large (probably one)
+        if high_side.any():
+            blo[high_side] = beta.ppf(1. - vol, a[high_side], b[high_side])
+            bhi[high_side] = 1.
+        this_lo[use_beta_here] = blo
+        this_hi[use_beta_here] = bhi
+    use_sqrt = ~use_beta_here
+    if use_sqrt.any():  # square root shenaniganery
+        sobs, stotal = obs_f[use_sqrt], total_f[use_sqrt]
+        err = (1./(stotal*stotal)) * (numpy.sqrt(sobs)*stotal - sobs*numpy.sqrt(stotal))
+        this_lo[use_sqrt] = frac[use_sqrt] - err
+        this_hi[use_sqrt] = frac[use_sqrt] + err
+
+    assert ((this_lo < frac) | (frac == 0.0)).all()
+    assert ((frac < this_hi) | (frac == 1.0)).all()
+    lo[todo] = this_lo
+    hi[todo] = this_hi
+    return lo, hi, cached
@@ -4,72 +4,80 @@ import sys
 import math
 import csv
 import time
+import numpy
 
 import utils
+import partitioncheck
 from opener import opener
 from clusterpath import ClusterPath
+from partitionstore import UidTable, CompactPartition
+from truthindex import TruthIndex
 
 # ----------------------------------------------------------------------------------------
 class Glomerator(object):
     # ----------------------------------------------------------------------------------------
-    def __init__(self, reco_info=None):
+    def __init__(self, reco_info=None, truth_index=None, uid_table=None):
         self.reco_info = reco_info
+        self.truth_index = truth_index  # built from <reco_info> the first time we need it, unless somebody passes us one they've already got
+        self.uid_table = UidTable() if uid_table is None else uid_table  # used by all our paths, so we can stick their partitions together without translating ids (pass in the previous paths' table to prepend them cheaply, too)
         self.paths = None
 
     # ----------------------------------------------------------------------------------------
     def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
-        """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
+        """
+        Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters>.
+        Single-linkage: we calculate the distances between all pairs of sequences once, then go through the pairs from closest to furthest, merging
+        their clusters with a union-find unless the merged cluster would be too big. This is an equivalent single-linkage heuristic to repeatedly
+        looking for the closest allowed pair of clusters, but it is *not* guaranteed to give the same partition: ties in distance get broken in a
+        different order, and the cluster (and member) order that homogenize() then acts on is different.
+        """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
+        query_names = naive_seqs.keys()
+        n_queries = len(query_names)
 
-        seqs_per_cluster = float(len(clusters)) / n_clusters
+        seqs_per_cluster = float(n_queries) / n_clusters
         max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
+        parents = range(n_queries)  # union-find forest over query indices (each root is the representative of its cluster)
+        members = {iq : [query_names[iq], ] for iq in range(n_queries)}  # map from each root to the queries in its cluster
 
         # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+        def find(iq):
+            while parents[iq] != iq:
+                parents[iq] = parents[parents[iq]]  # path halving
+                iq = parents[iq]
+            return iq
 
         # ----------------------------------------------------------------------------------------
-        def glomerate():
-            if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
-                if debug:
-                    print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
+        def glomerate(pairs, merge_whatever_you_got):
+            """ merge the clusters of each pair in <pairs> (sorted closest first) until we're down to <n_clusters>, returning the pairs we skipped 'cause they'd make a cluster that's too big """
+            skipped_pairs = []
+            for ia, ib in pairs:
+                if len(members) <= n_clusters:
+                    break
+                root_a, root_b = find(ia), find(ib)
+                if root_a == root_b:  # already in the same cluster
+                    continue
+                if len(members[root_a]) + len(members[root_b]) > max_per_cluster and not merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
+                    skipped_pairs.append((ia, ib))
+                    continue
                 if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                    print '    merging', len(members[root_a]), len(members[root_b])
+                parents[root_b] = root_a
+                members[root_a] += members.pop(root_b)
+            if debug and len(skipped_pairs) > 0:
+                print '      skipped: %d ' % len(skipped_pairs)
+            return skipped_pairs
+
+        # ----------------------------------------------------------------------------------------
+        def sorted_pairs():
+            """ all pairs of query indices, sorted by increasing naive hamming fraction """
+            condensed_distances = utils.get_condensed_hamming_fractions([naive_seqs[query] for query in query_names])
+            ifirsts, iseconds = numpy.triu_indices(n_queries, 1)  # same ordering as the condensed distances
+            order = numpy.argsort(condensed_distances, kind='mergesort')  # stable, so ties are broken in the same order as itertools.combinations()
+            return itertools.izip(ifirsts[order].tolist(), iseconds[order].tolist())
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -90,11 +98,14 @@ class Glomerator(object):
 
         # ----------------------------------------------------------------------------------------
         # da bizniz
-        glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
+        if n_queries > n_clusters:
+            skipped_pairs = glomerate(sorted_pairs(), merge_whatever_you_got=False)
+            if len(members) > n_clusters:  # if we didn't find enough suitable pairs, merge whatever's best regardless of size
+                if debug:
+                    print '    didn\'t find shiznitz'
+                glomerate(skipped_pairs, merge_whatever_you_got=True)
 
-        while len(clusters) > n_clusters:
-            glomerate()
-        
+        clusters = [members[root] for root in sorted(members)]
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -111,19 +122,23 @@ class Glomerator(object):
         print '    divvy time: %.3f' % (time.time()-start)
         return clusters
 
+    # ----------------------------------------------------------------------------------------
+    def get_truth_index(self):
+        if self.truth_index is None:
+            self.truth_index = TruthIndex(self.reco_info)
+        return self.truth_index
+
     # ----------------------------------------------------------------------------------------
     def print_true_partition(self):
         print '  true partition'
         print '   clonal?   ids'
-        true_partition = utils.get_true_partition(self.reco_info)
-        for cluster in true_partition.values():
-            same_event = utils.from_same_event(self.reco_info is None, self.reco_info, cluster)
-            if same_event is None:
-                same_event = -1
-            print '     %d    %s' % (int(same_event), ':'.join([str(uid) for uid in cluster]))
+        truth_index = self.get_truth_index()
+        for cluster in truth_index.partition.values():
+            print '     %d    %s' % (int(truth_index.from_same_event(cluster)), ':'.join([str(uid) for uid in cluster]))
 
     # ----------------------------------------------------------------------------------------
-    def read_file_info(self, infname, n_paths, calc_adj_mi):
+    def read_file_info(self, infname, n_paths, calc_adj_mi, expected_ids=None):
+        """ if <expected_ids> is set, make sure each partition has each of them exactly once (and nothing else) """
         paths = [None for _ in range(n_paths)]
         with opener('r')(infname) as csvfile:
             reader = csv.DictReader(csvfile)
@@ -133,31 +148,32 @@ class Glomerator(object):
                 uids = []
                 for cluster in line['partition'].split(';'):
                     uids.append([unique_id for unique_id in cluster.split(':')])
+                if expected_ids is not None:
+                    partitioncheck.assert_partition_ok(uids, expected_ids=expected_ids, extra_str=' in %s' % infname)
                 path_index = int(line['path_index'])
                 if paths[path_index] is None:
-                    paths[path_index] = ClusterPath(int(line['initial_path_index']))
+                    paths[path_index] = ClusterPath(int(line['initial_path_index']), uid_table=self.uid_table)
                 else:
                     assert paths[path_index].initial_path_index == int(line['initial_path_index'])
                 n_procs = int(line['n_procs']) if 'n_procs' in line else 1
                 logweight = float(line['logweight']) if 'logweight' in line else None
-                adj_mi = -1
-                if calc_adj_mi:
-                    adj_mi = utils.mutual_information(uids, self.reco_info, debug=False) if self.reco_info is not None else -1
-                paths[path_index].add_partition(uids, float(line['logprob']), n_procs=n_procs, logweight=logweight, adj_mi=adj_mi)
+                paths[path_index].add_partition(uids, float(line['logprob']), n_procs=n_procs, logweight=logweight, adj_mi=-1)  # adj mi gets set below, if we want it
 
         for cp in paths:
             if cp is None:
                 raise Exception('None type path read from %s' % infname)
-            for ptn in cp.partitions:
-                if len(ptn) == 0:
+            for n_clusters in cp.partitions.n_clusters:
+                if n_clusters == 0:
                     raise Exception('zero length partition read from %s' % infname)
+            if calc_adj_mi and self.reco_info is not None:
+                cp.calculate_adj_mis(self.reco_info)
 
         return paths
 
     # ----------------------------------------------------------------------------------------
     def merge_fileinfos(self, fileinfos, smc_particles, calc_adj_mi, previous_info=None, debug=False):
          # 'TODO not doing the combined conservative thing any more seems to have knocked down performance a bit EDIT nevermind, that seems to be a result of smc (presumably it was choosing very unlikely merges)'
-        self.paths = [ClusterPath(None) for _ in range(smc_particles)]  # each path's initial_path_index is None since we're merging paths that, in general, have different initial path indices
+        self.paths = [ClusterPath(None, uid_table=self.uid_table) for _ in range(smc_particles)]  # each path's initial_path_index is None since we're merging paths that, in general, have different initial path indices
 
         # DEAR FUTURE SELF this won't make any sense until you find that picture you took of the white board
         if previous_info is not None and smc_particles > 1:  # if we're doing smc, this has to happen *beforehand*, since the previous paths are separate for each process (cont'd at XX)
@@ -177,13 +193,10 @@ class Glomerator(object):
                     previous_path = previous_info[ifile][initial_path_index]
                     current_path = fileinfos[ifile][ipath]
                     # first_new_logprob = current_path.logprobs[0]
-                    extended_path = ClusterPath(None)
-                    for ip in range(len(previous_path.partitions)):
-                        # if previous_path.logprobs[ip] >= first_new_logprob:  # skip the merges past which we rewound
-                        #     continue
-                        extended_path.add_partition(list(previous_path.partitions[ip]), previous_path.logprobs[ip], previous_path.n_procs[ip], logweight=previous_path.logweights[ip], adj_mi=previous_path.adj_mis[ip])
-                    for ip in range(len(current_path.partitions)):
-                        extended_path.add_partition(list(current_path.partitions[ip]), current_path.logprobs[ip], current_path.n_procs[ip], logweight=current_path.logweights[ip], adj_mi=current_path.adj_mis[ip])
+                    extended_path = ClusterPath(None, uid_table=self.uid_table)
+                    # (if we ever want to skip the merges past which we rewound, it'd be the partitions in <previous_path> with logprob >= first_new_logprob)
+                    extended_path.add_path(previous_path)
+                    extended_path.add_path(current_path)
                     fileinfos[ifile][ipath] = extended_path
                     fileinfos[ifile][ipath].set_synthetic_logweight_history(self.reco_info)  # need to multiply the combinatorical factors in the later partitions by the factors from the earlier partitions
                     if debug:
@@ -219,22 +232,18 @@ class Glomerator(object):
                 fileinfos[ibestfile][ipath].remove_first_partition()
 
             def add_next_global_partition():
-                global_partition = []
                 global_logprob = 0.
                 for ifile in range(len(fileinfos)):  # combine the first line in each file to make a global partition
-                    for cluster in fileinfos[ifile][ipath].partitions[0]:
-                        global_partition.append(list(cluster))
                     global_logprob += fileinfos[ifile][ipath].logprobs[0]
-                global_adj_mi = -1
-                if calc_adj_mi:
-                    global_adj_mi = utils.mutual_information(global_partition, self.reco_info, debug=False) if self.reco_info is not None else -1
-                self.paths[ipath].add_partition(global_partition, global_logprob, n_procs=len(fileinfos), logweight=0., adj_mi=global_adj_mi)  # don't know the logweight yet (or maybe at all!)
+                global_partition = CompactPartition.concatenate([fileinfos[ifile][ipath].partitions.get_compact_for(0, self.uid_table) for ifile in range(len(fileinfos))])  # paths we read use our uid table, so we can (usually) just stick the ids together
+                self.paths[ipath].add_partition(global_partition, global_logprob, n_procs=len(fileinfos), logweight=0., adj_mi=-1)  # don't know the logweight yet (or maybe at all!), and adj mi gets set below, if we want it
 
             while not last_one():
                 add_next_global_partition()
                 remove_one_of_the_first_partitions()
             add_next_global_partition()
-
+            if calc_adj_mi and self.reco_info is not None:  # each global partition is (mostly) the previous one plus a merge, so this is much faster than doing each one separately
+                self.paths[ipath].calculate_adj_mis(self.reco_info)
 
             if smc_particles > 1:
                 self.paths[ipath].set_synthetic_logweight_history(self.reco_info)
@@ -242,7 +251,7 @@ class Glomerator(object):
                 print '  merged path:'
                 self.paths[ipath].print_partitions(self.reco_info, one_line=True)
             else:
-                print '  merged path %d with %d glomeration steps and %d final clusters' % (ipath, len(self.paths[ipath].partitions), len(self.paths[ipath].partitions[-1]))
+                print '  merged path %d with %d glomeration steps and %d final clusters' % (ipath, len(self.paths[ipath].partitions), self.paths[ipath].partitions.n_clusters[-1])
 
         if smc_particles == 1:  # XX: ...whereas if we're *not* doing smc, we have to add the previous histories *afterward*, since the previous histories are all in one piece
             if previous_info is None:
@@ -260,13 +269,10 @@ class Glomerator(object):
                 previous_path = previous_info
                 current_path = self.paths[0]
                 # first_new_logprob = UPDATEME current_path.logprobs[0]
-                extended_path = ClusterPath(None)
-                for ip in range(len(previous_path.partitions)):
-                    # if previous_path.logprobs[ip] >= first_new_logprob:  # skip the merges past which we rewound
-                    #     continue
-                    extended_path.add_partition(list(previous_path.partitions[ip]), previous_path.logprobs[ip], previous_path.n_procs[ip], logweight=previous_path.logweights[ip], adj_mi=previous_path.adj_mis[ip])
-                for ip in range(len(current_path.partitions)):
-                    extended_path.add_partition(list(current_path.partitions[ip]), current_path.logprobs[ip], current_path.n_procs[ip], logweight=current_path.logweights[ip], adj_mi=current_path.adj_mis[ip])
+                extended_path = ClusterPath(None, uid_table=self.uid_table)
+                # (if we ever want to skip the merges past which we rewound, it'd be the partitions in <previous_path> with logprob >= first_new_logprob)
+                extended_path.add_path(previous_path)
+                extended_path.add_path(current_path)
                 self.paths[0] = extended_path
                 # self.paths[0].set_synthetic_logweight_history(self.reco_info)  # need to multiply the combinatorical factors in the later partitions by the factors from the earlier partitions
                 if debug:
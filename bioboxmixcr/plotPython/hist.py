@@ -1,27 +1,43 @@
 import csv
-import math
 import os
+import numpy
 from opener import opener
 from utils import is_normed
 
 # ----------------------------------------------------------------------------------------
 class Hist(object):
-    """ a simple histogram """
-    def __init__(self, n_bins=None, xmin=None, xmax=None, sumw2=False, xbins=None, fname=None):  # if <sumw2>, keep track of errors with <sum_weights_squared>
+    """ a simple histogram (bin contents, errors, and sum of weights squared are numpy arrays) """
+    def __init__(self, n_bins=None, xmin=None, xmax=None, sumw2=False, xbins=None, fname=None, state=None):  # if <sumw2>, keep track of errors with <sum_weights_squared>
         self.low_edges, self.bin_contents, self.bin_labels = [], [], []
         self.xtitle, self.ytitle = '', ''
+        self.dx = None  # bin width, if the binning is uniform (in which case we find bins with arithmetic rather than a search)
+        self.stale_errors = None  # bins that've been filled since we last set their errors to sqrt(contents) (we only calculate them when someone asks for <errors>)
 
-        if fname is None:
+        if state is not None:
+            self.state_init(state)
+        elif fname is None:
             self.scratch_init(n_bins, xmin, xmax, sumw2=sumw2, xbins=xbins)
         else:
             self.file_init(fname)
 
+    # ----------------------------------------------------------------------------------------
+    @property
+    def errors(self):
+        if self.stale_errors is not None and self.stale_errors.any():
+            self._errors[self.stale_errors] = numpy.sqrt(self.bin_contents[self.stale_errors])
+            self.stale_errors[:] = False
+        return self._errors
+
+    # ----------------------------------------------------------------------------------------
+    @errors.setter
+    def errors(self, errors):
+        self._errors = errors
+        self.stale_errors = None if errors is None else numpy.zeros(len(errors), dtype=bool)
+
     # ----------------------------------------------------------------------------------------
     def scratch_init(self, n_bins, xmin, xmax, sumw2=None, xbins=None):
         self.n_bins = int(n_bins)
         self.xmin, self.xmax = float(xmin), float(xmax)
-        self.errors = None if sumw2 else []
-        self.sum_weights_squared = [] if sumw2 else None
 
         if xbins is not None:  # check validity of handmade bins
             assert len(xbins) == self.n_bins + 1
@@ -38,26 +54,28 @@ class Hist(object):
                     self.low_edges.append(xbins[0] - dx)  # low edge of underflow needs to be less than xmin, but is otherwise arbitrary, so just choose something that kinda makes sense
                 else:
                     self.low_edges.append(xbins[ib-1])
-            self.bin_contents.append(0.0)
-            if sumw2:
-                self.sum_weights_squared.append(0.)
-            else:
-                self.errors.append(0.)  # don't set the error values until we <write> (that is unless you explicitly set them with <set_ibin()>
+        if xbins is None and self.n_bins > 0:
+            self.dx = dx
+
+        self.low_edges = numpy.array(self.low_edges, dtype=float)
+        self.bin_contents = numpy.zeros(self.n_bins + 2)
+        self.sum_weights_squared = numpy.zeros(self.n_bins + 2) if sumw2 else None
+        self.errors = None if sumw2 else numpy.zeros(self.n_bins + 2)  # don't set the error values until we <write> (that is unless you explicitly set them with <set_ibin()>
 
     # ----------------------------------------------------------------------------------------
     def file_init(self, fname):
-        self.errors, self.sum_weights_squared = [], []  # kill the unused one after reading file
+        errors, sum_weights_squared = [], []  # kill the unused one after reading file
         with opener('r')(fname) as infile:
             reader = csv.DictReader(infile)
             for line in reader:
                 self.low_edges.append(float(line['bin_low_edge']))
                 self.bin_contents.append(float(line['contents']))
                 if 'sum-weights-squared' in line:
-                    self.sum_weights_squared.append(float(line['sum-weights-squared']))
+                    sum_weights_squared.append(float(line['sum-weights-squared']))
                 if 'error' in line or 'binerror' in line:  # in theory I should go find all the code that writes these files and make 'em use the same header for this
                     assert 'sum-weights-squared' not in line
                     tmp_error = float(line['error']) if 'error' in line else float(line['binerror'])
-                    self.errors.append(tmp_error)
+                    errors.append(tmp_error)
                 if 'binlabel' in line:
                     self.bin_labels.append(line['binlabel'])
                 else:
@@ -71,12 +89,41 @@ class Hist(object):
         assert sorted(self.low_edges) == self.low_edges
         assert len(self.bin_contents) == len(self.low_edges)
         assert len(self.low_edges) == len(self.bin_labels)
-        if len(self.errors) == 0:  # (re)set to None if the file didn't have errors listed
-            self.errors = None
-            assert len(self.sum_weights_squared) == len(self.low_edges)
-        if len(self.sum_weights_squared) == 0:
-            self.sum_weights_squared = None
-            assert len(self.errors) == len(self.low_edges)
+        if len(errors) == 0:  # (re)set to None if the file didn't have errors listed
+            errors = None
+            assert len(sum_weights_squared) == len(self.low_edges)
+        if len(sum_weights_squared) == 0:
+            sum_weights_squared = None
+            assert len(errors) == len(self.low_edges)
+
+        self.low_edges = numpy.array(self.low_edges, dtype=float)
+        self.bin_contents = numpy.array(self.bin_contents, dtype=float)
+        self.errors = None if errors is None else numpy.array(errors, dtype=float)
+        self.sum_weights_squared = None if sum_weights_squared is None else numpy.array(sum_weights_squared, dtype=float)
+
+    # ----------------------------------------------------------------------------------------
+    def state_init(self, state):
+        """ init from the output of get_state() """
+        self.n_bins = state['n_bins']
+        self.xmin, self.xmax = state['xmin'], state['xmax']
+        self.dx = state['dx']
+        self.xtitle, self.ytitle = state['xtitle'], state['ytitle']
+        self.bin_labels = list(state['bin_labels'])
+        self.low_edges = numpy.array(state['low_edges'], dtype=float)
+        self.bin_contents = numpy.array(state['bin_contents'], dtype=float)
+        self.errors = None if state['errors'] is None else numpy.array(state['errors'], dtype=float)
+        self.sum_weights_squared = None if state['sum_weights_squared'] is None else numpy.array(state['sum_weights_squared'], dtype=float)
+
+    # ----------------------------------------------------------------------------------------
+    def get_state(self):
+        """ return everything about this hist as a dict of plain python types (e.g. to write to json), from which you can recreate it with Hist(state=...) """
+        errors = self.errors
+        return {'n_bins' : self.n_bins, 'xmin' : self.xmin, 'xmax' : self.xmax, 'dx' : self.dx, 'xtitle' : self.xtitle, 'ytitle' : self.ytitle,
+                'bin_labels' : list(self.bin_labels),
+                'low_edges' : self.low_edges.tolist(),
+                'bin_contents' : self.bin_contents.tolist(),
+                'errors' : None if errors is None else errors.tolist(),
+                'sum_weights_squared' : None if self.sum_weights_squared is None else self.sum_weights_squared.tolist()}
 
     # ----------------------------------------------------------------------------------------
     def set_ibin(self, ibin, value, error=None, label=''):
@@ -93,49 +140,82 @@ class Hist(object):
         self.bin_contents[ibin] += weight
         if self.sum_weights_squared is not None:
             self.sum_weights_squared[ibin] += weight*weight
-        if self.errors is not None:
+        if self._errors is not None:
             if weight != 1.0:
                 print 'WARNING using errors instead of sumw2 with weight != 1.0 in Hist::fill_ibin()'
-            self.errors[ibin] = math.sqrt(self.bin_contents[ibin])
+            self.stale_errors[ibin] = True
 
     # ----------------------------------------------------------------------------------------
     def find_bin(self, value):
         """ find <ibin> corresponding to <value>. NOTE boundary is owned by the upper bin. """
-        if value < self.low_edges[0]:  # is it below the low edge of the underflow?
+        if value < self.low_edges[1]:  # is it below the upper edge of the underflow?
             return 0
         elif value >= self.low_edges[self.n_bins + 1]:  # or above the low edge of the overflow?
             return self.n_bins + 1
+        elif self.dx is not None:  # uniform binning, so we can just calculate it
+            ibin = min(self.n_bins, int((value - self.xmin) / self.dx) + 1)
+            if value < self.low_edges[ibin]:  # rounding can put us one bin off right at a boundary, in which case the edges get the final say
+                ibin -= 1
+            elif value >= self.low_edges[ibin + 1]:
+                ibin += 1
+            return ibin
         else:
-            for ib in range(self.n_bins + 2):  # loop over all the bins (including under/overflow)
-                if value >= self.low_edges[ib] and value < self.low_edges[ib+1]:  # NOTE <ib> never gets to <n_bins> + 1 because we already get all the overflows above (which is good 'cause this'd fail with an IndexError)
-                    return ib
+            return int(numpy.searchsorted(self.low_edges, value, side='right')) - 1
+
+    # ----------------------------------------------------------------------------------------
+    def find_bins(self, values):
+        """ find the bin corresponding to each entry in <values> (vectorized version of find_bin()) """
+        values = numpy.asarray(values, dtype=float)
+        if self.dx is not None:
+            ibins = numpy.clip(numpy.floor((values - self.xmin) / self.dx).astype(int) + 1, 0, self.n_bins + 1)
+            upper_edges = numpy.append(self.low_edges[1:], numpy.inf)
+            ibins -= (ibins > 0) & (values < self.low_edges[ibins])  # same deal as in find_bin(): fix rounding at the boundaries
+            ibins += values >= upper_edges[ibins]
+        else:
+            ibins = numpy.searchsorted(self.low_edges, values, side='right') - 1
+        ibins[values < self.low_edges[1]] = 0
+        ibins[values >= self.low_edges[self.n_bins + 1]] = self.n_bins + 1
+        return ibins
 
     # ----------------------------------------------------------------------------------------
     def fill(self, value, weight=1.0):
         """ fill bin corresponding to <value> with <weight> """
         self.fill_ibin(self.find_bin(value), weight)
 
+    # ----------------------------------------------------------------------------------------
+    def fill_many(self, values, weights=None):
+        """ fill the bins corresponding to each of <values> with the corresponding entry in <weights> (or 1.0, if <weights> isn't set) """
+        ibins = self.find_bins(values)
+        if len(ibins) == 0:
+            return
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype=float)
+            assert len(weights) == len(ibins)
+        self.bin_contents += numpy.bincount(ibins, weights=weights, minlength=self.n_bins + 2)
+        if self.sum_weights_squared is not None:
+            self.sum_weights_squared += numpy.bincount(ibins, weights=(None if weights is None else weights*weights), minlength=self.n_bins + 2)
+        if self._errors is not None:
+            if weights is not None and (weights != 1.0).any():
+                print 'WARNING using errors instead of sumw2 with weight != 1.0 in Hist::fill_many()'
+            self.stale_errors[ibins] = True
+
     # ----------------------------------------------------------------------------------------
     def normalize(self, overflow_warn=True):  # since when you normalize hists you have to make the arbitrary decision whether you're going to include the under/overflow bins (we don't include them here), in general we prefer to avoid having under/overflow entries
         """ NOTE does not multiply/divide by bin widths """
-        sum_value = 0.0
-        for ib in range(1, self.n_bins + 1):  # don't include under/overflows
-            sum_value += self.bin_contents[ib]
+        sum_value = float(self.bin_contents[1 : self.n_bins + 1].sum())  # don't include under/overflows
         if sum_value == 0.0:
             print 'WARNING sum zero in Hist::normalize(), returning without doing anything'
             return
         # make sure there's not too much stuff in the under/overflows
         if overflow_warn and (self.bin_contents[0]/sum_value > 1e-10 or self.bin_contents[self.n_bins+1]/sum_value > 1e-10):
             print 'WARNING under/overflows in Hist::normalize()'
-        for ib in range(1, self.n_bins + 1):
-            self.bin_contents[ib] /= sum_value
-            if self.sum_weights_squared is not None:
-                self.sum_weights_squared[ib] /= sum_value*sum_value
-            if self.errors is not None:
-                self.errors[ib] /= sum_value
-        check_sum = 0.0
-        for ib in range(1, self.n_bins + 1):  # check it
-            check_sum += self.bin_contents[ib]
+        errors = self.errors  # get the errors *before* changing the contents, since they might still be waiting to get set from the contents
+        self.bin_contents[1 : self.n_bins + 1] /= sum_value
+        if self.sum_weights_squared is not None:
+            self.sum_weights_squared[1 : self.n_bins + 1] /= sum_value*sum_value
+        if errors is not None:
+            errors[1 : self.n_bins + 1] /= sum_value
+        check_sum = float(self.bin_contents[1 : self.n_bins + 1].sum())  # check it
         assert is_normed(check_sum, this_eps=1e-10)
 
     # ----------------------------------------------------------------------------------------
@@ -143,23 +223,31 @@ class Hist(object):
         """ NOTE doesn't check bin edges are the same, only that they've got the same number of bins """
         if self.n_bins != denom_hist.n_bins or self.xmin != denom_hist.xmin or self.xmax != denom_hist.xmax:
             raise Exception('ERROR bad limits in Hist::divide_by')
-        for ib in range(0, self.n_bins + 2):
-            if debug:
+        if debug:
+            for ib in range(0, self.n_bins + 2):
                 print ib, self.bin_contents[ib], float(denom_hist.bin_contents[ib])
-            if denom_hist.bin_contents[ib] == 0.0:
-                self.bin_contents[ib] = 0.0
-            else:
-                self.bin_contents[ib] /= float(denom_hist.bin_contents[ib])
+        self.errors  # make sure any errors from filling get set before we change the contents
+        nonzero = denom_hist.bin_contents != 0.0
+        self.bin_contents[nonzero] /= denom_hist.bin_contents[nonzero]
+        self.bin_contents[~nonzero] = 0.0
 
     # ----------------------------------------------------------------------------------------
     def add(self, h2, debug=False):
-        """ NOTE doesn't check bin edges are the same, only that they've got the same number of bins """
+        """
+        NOTE doesn't check bin edges are the same, only that they've got the same number of bins
+        Sums of weights squared are added, and errors are added in quadrature (so, e.g., adding two hists with sqrt(n) errors gives sqrt(n) errors).
+        """
         if self.n_bins != h2.n_bins or self.xmin != h2.xmin or self.xmax != h2.xmax:
             raise Exception('ERROR bad limits in Hist::add')
-        for ib in range(0, self.n_bins + 2):
-            if debug:
+        if debug:
+            for ib in range(0, self.n_bins + 2):
                 print ib, self.bin_contents[ib], float(h2.bin_contents[ib])
-            self.bin_contents[ib] += h2.bin_contents[ib]
+        errors, h2_errors = self.errors, h2.errors  # make sure any errors from filling get set before we change the contents
+        self.bin_contents += h2.bin_contents
+        if self.sum_weights_squared is not None and h2.sum_weights_squared is not None:
+            self.sum_weights_squared += h2.sum_weights_squared
+        if errors is not None and h2_errors is not None:
+            self.errors = numpy.sqrt(errors*errors + h2_errors*h2_errors)
 
     # ----------------------------------------------------------------------------------------
     def write(self, outfname):
@@ -173,12 +261,13 @@ class Hist(object):
                 header.append('sum-weights-squared')
             writer = csv.DictWriter(outfile, header)
             writer.writeheader()
+            errors = self.errors
             for ib in range(self.n_bins + 2):
-                row = {'bin_low_edge':self.low_edges[ib], 'contents':self.bin_contents[ib], 'binlabel':self.bin_labels[ib] }
-                if self.errors is not None:
-                    row['error'] = self.errors[ib]
+                row = {'bin_low_edge':float(self.low_edges[ib]), 'contents':float(self.bin_contents[ib]), 'binlabel':self.bin_labels[ib] }
+                if errors is not None:
+                    row['error'] = float(errors[ib])
                 else:
-                    row['sum-weights-squared'] = self.sum_weights_squared[ib]
+                    row['sum-weights-squared'] = float(self.sum_weights_squared[ib])
                 writer.writerow(row)
 
     # ----------------------------------------------------------------------------------------
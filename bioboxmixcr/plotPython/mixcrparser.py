@@ -1,53 +1,138 @@
 #This script takes in the inferences for gene locations from project Mixcr in the form of a text file and outputs a directory containing the results in both table and histogram form.
 #----------------------------
 #Import relevant packages
+import argparse
+import sys
 from performanceplotter import PerformancePlotter
 import csv
 import utils
+import plotting
+#----------------------------
+#Command line arguments. With --stream, the script runs without prompting, reading the simulation file and the mixcr output in lockstep so memory use doesn't grow with the number of reads.
+parser = argparse.ArgumentParser()
+parser.add_argument('--stream', action='store_true', help='non-interactive, constant-memory mode: join the two files on unique id and evaluate each read as it is read (requires mixcr exportAlignments with -descrR1 or -readId)')
+parser.add_argument('--germline-dir', default='data/imgt')
+parser.add_argument('--simfile', default='simu-10-leaves-1-mutate.csv', help='original simulated input file into mixcr')
+parser.add_argument('--mixcr-output', default='edited_output_file.txt', help='tab-separated output of mixcr exportAlignments')
+parser.add_argument('--plotdir', default='mixcrPlotDir')
+parser.add_argument('--batch-size', type=int, default=10000, help='number of reads to evaluate at once in --stream mode')
+parser.add_argument('--write-state', help='instead of plotting, write the accumulated counts and hists to this json file (e.g. when scoring one chunk of a large sample)')
+parser.add_argument('--merge-states', help='colon-separated list of json files from --write-state to add together and plot (instead of evaluating anything)')
+parser.add_argument('--plot-backend', default='csv', choices=['csv', 'root'], help='csv: just write the csv files that comparison.py reads; root: also draw every plot with root and make the html index')
+parser.add_argument('--render-images', action='store_true', help='with the csv backend, also draw the plots as svgs (with matplotlib)')
+parser.add_argument('--quiet', action='store_true', help='don\'t print the naive sequence and region bounds of every read')
+args = parser.parse_args([arg for arg in sys.argv[1:] if arg != '-b'])  # plotting.py appends '-b' to sys.argv to keep root in batch mode
 #----------------------------
 #Get user input
-germlineDirectory = raw_input('Enter the path of the germline sequences): ') or 'data/imgt'
-originalInputFile = raw_input('Enter the path of the original input file into mixcr): ') or 'simu-10-leaves-1-mutate.csv'
-mixcrOutput = raw_input('Enter the path of the output from mixcr: ') or 'edited_output_file.txt'
-mixcrPlotDir='mixcrPlotDir'
+if not args.stream and args.merge_states is None:
+	args.germline_dir = raw_input('Enter the path of the germline sequences): ') or args.germline_dir
+	args.simfile = raw_input('Enter the path of the original input file into mixcr): ') or args.simfile
+	args.mixcr_output = raw_input('Enter the path of the output from mixcr: ') or args.mixcr_output
+mixcrPlotDir = args.plotdir
+utils.quiet_reco_events = args.quiet
+#----------------------------
+#columns in the simulation file that need to be converted to integers (same as in seqfileopener.py)
+int_columns = ('v_5p_del', 'd_5p_del', 'cdr3_length', 'j_5p_del', 'j_3p_del', 'd_3p_del', 'v_3p_del')
+#mixcr exportAlignments column headers for the read name (-descrR1) and read number (-readId)
+description_column = 'Description R1'
+read_id_column = 'Read id'
+#----------------------------
+#returns the true line from a row in the simulation file
+def get_true_line(row):
+	utils.process_input_line(row, int_columns=int_columns)
+	return row
+#----------------------------
+#returns the inferred gene calls from a row in the mixcr output
+def get_inferred_line(row):
+	return {'v_gene' : row['Best V hit'], 'd_gene' : row['Best D hit'], 'j_gene' : row['Best J hit']}
+#----------------------------
+#evaluates a batch of (true line, inferred line) pairs at once, and empties the lists
+def evaluate_batch(perfplotter, true_lines, inf_lines):
+	if len(true_lines) == 0:
+		return
+	perfplotter.evaluate_batch(utils.get_columns(true_lines), utils.get_columns(inf_lines))
+	del true_lines[:]
+	del inf_lines[:]
+#----------------------------
+#Evaluates each mixcr read against its simulated read as the two files are read, without storing either file in memory (apart from <batch_size> reads at a time, which are evaluated together).
+#Mixcr writes the reads in the same order as its input, but leaves out reads that it failed to align, so we skip ahead in the simulation file until we find each mixcr read (counting the skipped ones as failures).
+def stream_evaluate(perfplotter, simfname, mixcrfname, batch_size):
+	n_evaluated, n_failed = 0, 0
+	true_lines, inf_lines = [], []
+	with open(simfname) as simfile:
+		with open(mixcrfname) as mixcrfile:
+			true_reader = csv.DictReader(simfile)
+			inf_reader = csv.DictReader(mixcrfile, delimiter='\t')
+			if description_column in inf_reader.fieldnames:
+				get_key = lambda iquery, row: row['unique_id']
+				get_inf_key = lambda row: row[description_column].split()[0]
+			elif read_id_column in inf_reader.fieldnames:
+				get_key = lambda iquery, row: str(iquery)
+				get_inf_key = lambda row: row[read_id_column].strip()
+			else:
+				raise Exception('%s has neither a \'%s\' nor a \'%s\' column (export with -descrR1 or -readId)' % (mixcrfname, description_column, read_id_column))
+			iquery = -1
+			for inf_row in inf_reader:
+				inf_key = get_inf_key(inf_row)
+				while True:
+					true_row = next(true_reader, None)
+					iquery += 1
+					if true_row is None:
+						raise Exception('%s not found in %s (or files are not in the same order)' % (inf_key, simfname))
+					if get_key(iquery, true_row) == inf_key:
+						break
+					perfplotter.add_fail()
+					n_failed += 1
+				true_lines.append(get_true_line(true_row))
+				inf_lines.append(get_inferred_line(inf_row))
+				n_evaluated += 1
+				if len(true_lines) >= batch_size:
+					evaluate_batch(perfplotter, true_lines, inf_lines)
+			evaluate_batch(perfplotter, true_lines, inf_lines)
+			for true_row in true_reader:  # reads after the last one mixcr aligned
+				perfplotter.add_fail()
+				n_failed += 1
+	print '  evaluated %d reads (%d not aligned by mixcr)' % (n_evaluated, n_failed)
 #----------------------------
 #hardcoded default germline sequences
-germline_seqs = utils.read_germlines(germlineDirectory) 
+germline_seqs = utils.read_germlines(args.germline_dir)
 
 #create an instance of the performance plotter class
-perfplotter = PerformancePlotter(germline_seqs, 'mixcr')
+perfplotter = PerformancePlotter(germline_seqs, 'mixcr', only_correct_gene_fractions=True)
 
-#The true dictionary contains the correct locations taken from the original simulated data file
-#The inferred dictionary (iDictionary) will contain the inferences of those locations from Mixcr
-trueDictionary = {}
-iDictionary = {}
-with open(originalInputFile) as inFile1:
-	with open(mixcrOutput) as inFile2:
-		reader1 = csv.DictReader(inFile1)
-		reader2 = csv.DictReader(inFile2, delimiter='\t')
-		for row1, row2 in zip(reader1, reader2):
-			unique_id = row1['unique_id']
-			#print unique_id
-			trueDictionary[unique_id] = {}
-			trueDictionary[unique_id]['v_gene'] = row1['v_gene']	
-			trueDictionary[unique_id]['d_gene'] = row1['d_gene']	
-			trueDictionary[unique_id]['j_gene'] = row1['v_gene']	
-			#print trueDictionary[unique_id]
-			iDictionary[unique_id] = {}
-			iDictionary[unique_id]['v_gene'] = row2['Best V hit']
-			iDictionary[unique_id]['d_gene'] = row2['Best D hit']
-			iDictionary[unique_id]['j_gene'] = row2['Best J hit']
-			#print iDictionary[unique_id]
+if args.merge_states is not None:
+	for fname in utils.get_arg_list(args.merge_states):
+		chunkplotter = PerformancePlotter(germline_seqs, 'mixcr', only_correct_gene_fractions=True)
+		chunkplotter.read_state(fname)
+		perfplotter.add(chunkplotter)
+elif args.stream:
+	stream_evaluate(perfplotter, args.simfile, args.mixcr_output, args.batch_size)
+else:
+	#The true dictionary contains the correct locations taken from the original simulated data file
+	#The inferred dictionary (iDictionary) will contain the inferences of those locations from Mixcr
+	trueDictionary = {}
+	iDictionary = {}
+	with open(args.simfile) as inFile1:
+		with open(args.mixcr_output) as inFile2:
+			reader1 = csv.DictReader(inFile1)
+			reader2 = csv.DictReader(inFile2, delimiter='\t')
+			for row1, row2 in zip(reader1, reader2):
+				unique_id = row1['unique_id']
+				trueDictionary[unique_id] = get_true_line(row1)
+				iDictionary[unique_id] = get_inferred_line(row2)
 
-#run evaluate function from performanceplotter.py
-for key in trueDictionary:
-	#if key == '123818946361786991':
-		#print 'RUNNING EVALUATE ON: ', key
-	perfplotter.evaluate(trueDictionary[key], iDictionary[key])
-	#perfplotter.evaluate(trueDictionary[key], iDictionary[key])
+	#run evaluate function from performanceplotter.py (on all the reads at once)
+	keys = list(trueDictionary)
+	evaluate_batch(perfplotter, [trueDictionary[key] for key in keys], [iDictionary[key] for key in keys])
 print 'COMPLETED EVALUATE'
+if args.write_state is not None:
+	perfplotter.write_state(args.write_state)
+	print 'wrote state to ' + args.write_state
+	sys.exit(0)
 #plot the information gained from the 'evaluate' function
-perfplotter.plot(mixcrPlotDir)			
+perfplotter.plot(mixcrPlotDir, backend=args.plot_backend)
+if args.render_images and args.plot_backend == 'csv':
+	plotting.render_plots(mixcrPlotDir)
 print mixcrPlotDir
 print 'COMPLETED PLOTTING'
 #----------------------------
@@ -4,6 +4,7 @@ import sys
 import os
 from subprocess import check_call
 import csv
+import numpy
 
 import plotting
 has_root = plotting.has_root
@@ -75,6 +76,7 @@ class MuteFreqer(object):
         assert not self.finalized
 
         self.n_cached, self.n_not_cached = 0, 0
+        uncertainty_obs, uncertainty_totals, uncertainty_targets = [], [], []  # collect everything that needs an uncertainty, so we can get them all with one call to err_many()
         for gene in self.counts:
             self.freqs[gene], self.plotting_info[gene] = {}, []
             # NOTE <counts> hold the overall (not per-base) frequencies, while <freqs> holds the per-base frequencies
@@ -91,16 +93,9 @@ class MuteFreqer(object):
                     freqs[position][nuke] = nuke_freq
                     plotting_info[-1]['nuke_freqs'][nuke] = nuke_freq
                     if calculate_uncertainty:  # it's kinda slow
-                        errs = fraction_uncertainty.err(counts[position][nuke], counts[position]['total'])
-                        if errs[2]:
-                            self.n_cached += 1
-                        else:
-                            self.n_not_cached += 1
-                        # print nuke_freq, errs[0], errs[1], '(', counts[position][nuke], ',', counts[position]['total'], ')'
-                        assert errs[0] <= nuke_freq  # these checks are probably unnecessary. EDIT and totally saved my ass about ten minutes after writing the previous statement
-                        assert nuke_freq <= errs[1]
-                        freqs[position][nuke + '_lo_err'] = errs[0]
-                        freqs[position][nuke + '_hi_err'] = errs[1]
+                        uncertainty_obs.append(counts[position][nuke])
+                        uncertainty_totals.append(counts[position]['total'])
+                        uncertainty_targets.append((freqs[position], nuke + '_lo_err', nuke + '_hi_err'))
 
                     if nuke == counts[position]['gl_nuke']:
                         n_conserved += counts[position][nuke]
@@ -108,15 +103,24 @@ class MuteFreqer(object):
                         n_mutated += counts[position][nuke]  # sum over A,C,G,T
                     # uncert = fraction_uncertainty.err(obs, total)  # uncertainty for each nuke
                 counts[position]['freq'] = float(n_mutated) / counts[position]['total']
-                mutated_fraction_err = (0.0, 0.0)
+                counts[position]['freq_lo_err'] = 0.0
+                counts[position]['freq_hi_err'] = 0.0
                 if calculate_uncertainty:  # it's kinda slow
-                    mutated_fraction_err = fraction_uncertainty.err(n_mutated, counts[position]['total'])
-                    if mutated_fraction_err[2]:
-                        self.n_cached += 1
-                    else:
-                        self.n_not_cached += 1
-                counts[position]['freq_lo_err'] = mutated_fraction_err[0]
-                counts[position]['freq_hi_err'] = mutated_fraction_err[1]
+                    uncertainty_obs.append(n_mutated)
+                    uncertainty_totals.append(counts[position]['total'])
+                    uncertainty_targets.append((counts[position], 'freq_lo_err', 'freq_hi_err'))
+
+        if len(uncertainty_targets) > 0:
+            los, his, cached = fraction_uncertainty.err_many(uncertainty_obs, uncertainty_totals)
+            self.n_cached = int(cached.sum())
+            self.n_not_cached = len(cached) - self.n_cached
+            fracs = numpy.array(uncertainty_obs, dtype=float) / numpy.array(uncertainty_totals, dtype=float)
+            assert (los <= fracs).all()  # these checks are probably unnecessary. EDIT and totally saved my ass about ten minutes after writing the previous statement
+            assert (fracs <= his).all()
+            for itarget in range(len(uncertainty_targets)):
+                info, lo_key, hi_key = uncertainty_targets[itarget]
+                info[lo_key] = float(los[itarget])
+                info[hi_key] = float(his[itarget])
 
         self.mean_rates['all'].normalize(overflow_warn=False)  # we expect overflows in mute freq hists, so no need to warn us
         for region in utils.regions:
@@ -0,0 +1,90 @@
+"""
+Adjusted mutual information between inferred partitions and the true (simulated) clusters, kept up to date as clusters get merged.
+Gives the same number as sklearn's adjusted_mutual_info_score() (with the 'max' normalization that's the default in the sklearn versions we use) but since the expected mutual information is a sum over inferred clusters of a term that only depends on the cluster's size, we only work that term out once for each size.
+"""
+import math
+from collections import Counter
+import numpy
+from scipy.special import gammaln
+
+# ----------------------------------------------------------------------------------------
+def xlogx(x):
+    return x * math.log(x) if x > 0 else 0.
+
+# ----------------------------------------------------------------------------------------
+class AdjMIScorer(object):
+    """ set_partition() to start from scratch, then merge() for each merge, and get_adj_mi() whenever you like """
+    def __init__(self, reco_info):
+        self.reco_info = reco_info
+        self.true_sizes = None  # Counter of true cluster sizes (i.e. how many true clusters have each size) for the uids in the current partition
+
+    # ----------------------------------------------------------------------------------------
+    def set_partition(self, partition):
+        """ <partition> is a list of lists of uids """
+        self.clusters = [Counter(self.reco_info[uid]['reco_id'] for uid in cluster) for cluster in partition]  # each cluster is one column of the contingency table: number of its uids from each true cluster
+        self.sizes = Counter(len(cluster) for cluster in partition)  # number of inferred clusters of each size
+        true_cluster_sizes = Counter()
+        for column in self.clusters:
+            true_cluster_sizes.update(column)
+        true_sizes = Counter(true_cluster_sizes.values())
+        if true_sizes != self.true_sizes:  # expected mi terms depend on the true cluster sizes, so if they're different we have to start over
+            self.true_sizes = true_sizes
+            self.n_uids = sum(size * count for size, count in true_sizes.items())
+            self.n_true_clusters = len(true_cluster_sizes)
+            self.sum_true_xlogx = sum(count * xlogx(size) for size, count in true_sizes.items())
+            self.gammaln_table = gammaln(numpy.arange(self.n_uids + 2))  # log((n-1)!) for n up to n_uids + 1
+            self.emi_terms = {}
+        self.sum_nij_xlogx = sum(xlogx(nij) for column in self.clusters for nij in column.values())
+
+    # ----------------------------------------------------------------------------------------
+    def merge(self, i, j, k):
+        """ clusters <i> and <j> were merged, and the new cluster is at index <k> (i.e. the same order as the merge records in partitionstore.py) """
+        ci, cj = self.clusters[i], self.clusters[j]
+        if len(ci) < len(cj):  # add the smaller one to the bigger one
+            ci, cj = cj, ci
+        ni, nj = sum(ci.values()), sum(cj.values())
+        for reco_id, nij in cj.items():
+            self.sum_nij_xlogx += xlogx(ci[reco_id] + nij) - xlogx(ci[reco_id]) - xlogx(nij)
+            ci[reco_id] += nij
+        for size in (ni, nj):
+            self.sizes[size] -= 1
+            if self.sizes[size] == 0:
+                del self.sizes[size]
+        self.sizes[ni + nj] += 1
+        for ic in sorted((i, j), reverse=True):
+            del self.clusters[ic]
+        self.clusters.insert(k, ci)
+
+    # ----------------------------------------------------------------------------------------
+    def emi_term(self, b):
+        """ contribution to the expected mutual information from an inferred cluster of size <b> """
+        if b not in self.emi_terms:
+            N, lg = self.n_uids, self.gammaln_table
+            term = 0.
+            for a, n_true in self.true_sizes.items():
+                nij = numpy.arange(max(1, a + b - N), min(a, b) + 1)
+                if len(nij) == 0:
+                    continue
+                log_prob = lg[a + 1] + lg[b + 1] + lg[N - a + 1] + lg[N - b + 1] - lg[N + 1] - lg[nij + 1] - lg[a - nij + 1] - lg[b - nij + 1] - lg[N - a - b + nij + 1]  # hypergeometric probability of <nij>
+                term += n_true * numpy.sum(nij / float(N) * (numpy.log(N * nij) - math.log(a) - math.log(b)) * numpy.exp(log_prob))
+            self.emi_terms[b] = term
+        return self.emi_terms[b]
+
+    # ----------------------------------------------------------------------------------------
+    def get_adj_mi(self):
+        if len(self.clusters) == self.n_true_clusters and len(self.clusters) <= 1:  # no clustering, so it's a perfect match (same as sklearn)
+            return 1.0
+        if self.sizes.keys() == [1] and self.true_sizes.keys() == [1]:  # all singletons on both sides is also a perfect match (sklearn gets 0/0 here, so it gives either 0 or 1 depending on rounding)
+            return 1.0
+        N = float(self.n_uids)
+        sum_inferred_xlogx = sum(count * xlogx(size) for size, count in self.sizes.items())
+        mi = (self.sum_nij_xlogx - self.sum_true_xlogx - sum_inferred_xlogx) / N + math.log(N)
+        emi = sum(count * self.emi_term(size) for size, count in self.sizes.items())
+        h_true = math.log(N) - self.sum_true_xlogx / N
+        h_inferred = math.log(N) - sum_inferred_xlogx / N
+        denominator = max(h_true, h_inferred) - emi
+        if denominator < 0:  # should always be >= 0, but with floating point it isn't always (again, same as sklearn)
+            denominator = min(denominator, -numpy.finfo('float64').eps)
+        else:
+            denominator = max(denominator, numpy.finfo('float64').eps)
+        return (mi - emi) / denominator
@@ -0,0 +1,42 @@
+""" Linear-time sanity checks for partitions (lists of clusters, each of which is a list of unique ids) """
+
+# ----------------------------------------------------------------------------------------
+def get_cluster_index(partition):
+    """ return a dict from each uid in <partition> to the index of its cluster (if a uid is in more than one cluster, the last one wins) """
+    return {uid : iclust for iclust in range(len(partition)) for uid in partition[iclust]}
+
+# ----------------------------------------------------------------------------------------
+def check_partition(partition, expected_ids=None, ignore_ids=None):
+    """
+    Return a dict with the sets of 'missing' (in <expected_ids> but not in <partition>), 'duplicated' (in more than one cluster, or twice in one cluster), and 'unknown' (in <partition> but not in <expected_ids>) uids.
+    If <expected_ids> is None we can only check for duplicates. Uids in <ignore_ids> are never reported as missing (e.g. queries that we skipped).
+    """
+    seen, duplicated = set(), set()
+    for cluster in partition:
+        for uid in cluster:
+            if uid in seen:
+                duplicated.add(uid)
+            seen.add(uid)
+
+    missing, unknown = set(), set()
+    if expected_ids is not None:
+        if not isinstance(expected_ids, (set, frozenset, dict)):  # make sure lookups are constant time
+            expected_ids = set(expected_ids)
+        missing = set(uid for uid in expected_ids if uid not in seen)
+        if ignore_ids is not None:
+            missing -= set(ignore_ids)
+        unknown = set(uid for uid in seen if uid not in expected_ids)
+
+    return {'missing' : missing, 'duplicated' : duplicated, 'unknown' : unknown}
+
+# ----------------------------------------------------------------------------------------
+def get_problem_str(problems):
+    """ return a string describing the non-empty sets in <problems> (from check_partition()), or '' if there aren't any """
+    return '   '.join('%s: %s' % (problem, ' '.join(sorted(problems[problem]))) for problem in ('missing', 'duplicated', 'unknown') if len(problems[problem]) > 0)
+
+# ----------------------------------------------------------------------------------------
+def assert_partition_ok(partition, expected_ids=None, ignore_ids=None, extra_str=''):
+    """ raise an exception if <partition> has any missing, duplicated, or unknown uids """
+    problem_str = get_problem_str(check_partition(partition, expected_ids=expected_ids, ignore_ids=ignore_ids))
+    if problem_str != '':
+        raise Exception('bad partition%s\n    %s' % (extra_str, problem_str))
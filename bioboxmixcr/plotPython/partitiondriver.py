@@ -2,6 +2,7 @@ import time
 import sys
 import json
 import itertools
+import heapq
 import shutil
 import math
 import os
@@ -9,19 +10,25 @@ import glob
 import csv
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
-from collections import OrderedDict
-from subprocess import Popen, check_call, PIPE, check_output
+import Queue
+from collections import OrderedDict, deque
+from subprocess import check_call, check_output
 
 import utils
 from opener import opener
 from seqfileopener import get_seqfile_info
 import annotationclustering
+import partitioncheck
 from glomerator import Glomerator
 from clusterpath import ClusterPath
+from partitionstore import UidTable
 from waterer import Waterer
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
 from hist import Hist
+from persistentcache import PersistentCache
+from profiler import Profiler
+from truthindex import TruthIndex
 
 # ----------------------------------------------------------------------------------------
 class PartitionDriver(object):
@@ -34,20 +41,40 @@ class PartitionDriver(object):
             tryp_reader = csv.reader(csv_file)
             self.tryp_positions = {row[0]:row[1] for row in tryp_reader}  # WARNING: this doesn't filter out the header line
 
+        self.truth_index = None  # true clusters (for simulation), worked out once and shared with everything that scores partitions
         if self.args.seqfile is not None:
             self.input_info, self.reco_info = get_seqfile_info(self.args.seqfile, self.args.is_data, self.germline_seqs, self.cyst_positions, self.tryp_positions,
                                                                self.args.n_max_queries, self.args.queries, self.args.reco_ids)
+            if not self.args.is_data:
+                self.truth_index = TruthIndex(self.reco_info)
 
-        self.cached_results = None
+        self.persistent_cache = None
+        if self.args.persistent_cachefname is not None:
+            self.persistent_cache = PersistentCache(self.args.persistent_cachefname)
         self.bcrham_divvied_queries = None
         self.n_max_divvy = 5  # if input info is longer than this, divvy with bcrham
+        self.few_merges_fraction = 0.05  # if a partition step merges less than this fraction of the clusters, reduce the number of procs faster
+        self.slow_step_factor = 2.  # if a partition step takes this many times longer than the first one, reduce the number of procs more slowly
+        self.min_clusters_per_proc = 10  # don't use so many procs that each one gets fewer clusters than this
+        self.n_procs_decisions = []  # info about each choice of the number of procs for the next partition step (see get_next_n_procs())
+        self.max_concurrent_procs = getattr(self.args, 'max_concurrent_procs', None)  # if set, run at most this many bcrham procs at once (the rest of the chunks wait for a free slot)
+        self.chunks_per_proc = 4  # if <max_concurrent_procs> is set, split steps whose results don't depend on the chunking into this many chunks per concurrent proc, so one slow chunk holds up less of the step
+        self.sw_in_process_max_queries = getattr(self.args, 'sw_in_process_max_queries', None)  # if set, smith-waterman passes with at most this many queries run in this process (see Waterer)
 
         self.sw_info = None
+        self.uid_table = None  # shared by all the paths in a partition() run, so glomerators can prepend the previous paths without translating ids
 
         utils.prep_dir(self.args.workdir)
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
+        self.hmm_input_header = ['path_index', 'logweight', 'names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'only_genes', 'seqs', 'mute_freqs', 'cyst_positions']  # NOTE logweight is for the whole partition
+        self.hmm_input_lines = None  # the lines we last wrote to <self.hmm_infname>
+
+        self.profiler = Profiler()
+        self.profile_fname = None  # if set, clean() writes the timing spans and counters here (json, or csv if it ends in .csv)
+        if self.args.outfname is not None:
+            self.profile_fname = os.path.splitext(self.args.outfname)[0] + '-profile.json'
 
         if self.args.outfname is not None:
             outdir = os.path.dirname(self.args.outfname)
@@ -56,19 +83,16 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def clean(self):
-        if self.args.persistent_cachefname is not None:
-            lockfname = self.args.persistent_cachefname + '.lock'
-            while os.path.exists(lockfname):
-                print '  waiting for lock on %s' % lockfname
-                time.sleep(0.5)
-            lockfile = open(lockfname, 'w')
-            if not os.path.exists(self.args.persistent_cachefname):
-                open(self.args.persistent_cachefname, 'w').close()
-            tmp_cachefname = self.args.persistent_cachefname + '.tmp'
-            check_call(['cp', self.args.persistent_cachefname, tmp_cachefname])
-            self.merge_files(infnames=[tmp_cachefname, self.hmm_cachefname], outfname=self.args.persistent_cachefname)
-            lockfile.close()
-            os.remove(lockfname)
+        if self.persistent_cache is not None:
+            n_added = self.persistent_cache.add_csv(self.hmm_cachefname)
+            self.profiler.count('cache.persistent_lines_added', n_added)
+            print '  added %d lines to persistent cache %s' % (n_added, self.args.persistent_cachefname)
+            self.persistent_cache.close()
+        if self.profile_fname is not None:
+            self.profiler.write(self.profile_fname, extra_info={'n_procs_decisions' : self.n_procs_decisions})
+            print '  wrote profile to %s' % self.profile_fname
+        if self.args.debug:
+            self.profiler.print_summary()
         if not self.args.no_clean and os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
 
@@ -82,7 +106,7 @@ class PartitionDriver(object):
     def cache_parameters(self):
         """ Infer full parameter sets and write hmm files for sequences from <self.input_info>, first with Smith-Waterman, then using the SW output as seed for the HMM """
         sw_parameter_dir = self.args.parameter_dir + '/sw'
-        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=sw_parameter_dir, write_parameters=True)
+        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=sw_parameter_dir, write_parameters=True, profiler=self.profiler, in_process_max_queries=self.sw_in_process_max_queries)
         waterer.run()
         self.sw_info = waterer.info
         self.write_hmms(sw_parameter_dir)
@@ -95,7 +119,7 @@ class PartitionDriver(object):
         """ Just run <algorithm> (either 'forward' or 'viterbi') on sequences in <self.input_info> and exit. You've got to already have parameters cached in <self.args.parameter_dir> """
         if not os.path.exists(self.args.parameter_dir):
             raise Exception('parameter dir (' + self.args.parameter_dir + ') d.n.e')
-        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False)
+        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False, profiler=self.profiler, in_process_max_queries=self.sw_in_process_max_queries)
         waterer.run()
 
         self.sw_info = waterer.info
@@ -105,14 +129,45 @@ class PartitionDriver(object):
     # get number of clusters based on sum of last paths in <self.smc_info>
     def get_n_clusters(self):
         if self.args.smc_particles == 1:
-            return len(self.paths[-1].partitions[self.paths[-1].i_best_minus_x])
+            return self.paths[-1].partitions.n_clusters[self.paths[-1].i_best_minus_x]
 
         nclusters = 0
         for iproc in range(len(self.smc_info[-1])):  # number of processes
             path = self.smc_info[-1][iproc][0]  # uses the first smc particle, but the others will be similar
-            nclusters += len(path.partitions[path.i_best_minus_x])
+            nclusters += path.partitions.n_clusters[path.i_best_minus_x]
         return nclusters
 
+    # ----------------------------------------------------------------------------------------
+    def get_next_n_procs(self, n_procs, n_clusters_before, n_clusters_after, step_times):
+        """
+        Decide how many procs to use for the next partition step (non-smc only), based on how the step that just finished went.
+        Start from the old fixed schedule (divide by 1.5), then shrink faster if the step barely merged anything (the procs need to see each others' clusters),
+        and more slowly if the step was a lot slower than the first one (so we don't pile even more work on fewer procs). Never spread the clusters thinner
+        than <self.min_clusters_per_proc> per proc, go straight to one proc once there's few enough clusters that we wouldn't divvy them, and always use fewer procs than last time.
+        """
+        merge_fraction = float(n_clusters_before - n_clusters_after) / n_clusters_before if n_clusters_before > 0 else 0.
+        factor = 1.5
+        reasons = []
+        if merge_fraction < self.few_merges_fraction:
+            factor *= 4. / 3
+            reasons.append('few merges')
+        if len(step_times) > 1 and step_times[-1] > self.slow_step_factor * step_times[0]:
+            factor *= 5. / 6
+            reasons.append('slow step')
+        next_n_procs = int(n_procs / factor)
+        if n_clusters_after / self.min_clusters_per_proc < next_n_procs:
+            next_n_procs = n_clusters_after / self.min_clusters_per_proc
+            reasons.append('few clusters per proc')
+        if n_clusters_after <= self.n_max_divvy:
+            next_n_procs = 1
+            reasons.append('no need to divvy')
+        next_n_procs = max(1, min(n_procs - 1, next_n_procs))
+
+        self.n_procs_decisions.append({'n_procs' : n_procs, 'n_clusters_before' : n_clusters_before, 'n_clusters_after' : n_clusters_after, 'step_time' : step_times[-1], 'factor' : factor, 'next_n_procs' : next_n_procs, 'reasons' : reasons})
+        print '      %d --> %d clusters (merged %.3f) in %.1fs: %d --> %d procs (factor %.2f%s)' % (n_clusters_before, n_clusters_after, merge_fraction, step_times[-1], n_procs, next_n_procs, factor,
+                                                                                                     '' if len(reasons) == 0 else ', ' + ', '.join(reasons))
+        return next_n_procs
+
     # ----------------------------------------------------------------------------------------
     def partition(self):
         """ Partition sequences in <self.input_info> into clonally related lineages """
@@ -126,7 +181,7 @@ class PartitionDriver(object):
             return
 
         # run smith-waterman
-        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False)
+        waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False, profiler=self.profiler, in_process_max_queries=self.sw_in_process_max_queries)
         waterer.run()
         self.sw_info = waterer.info
         if not self.args.dont_pad_sequences:  # have to do this before we divvy... sigh TODO clean this up and only call it in one place
@@ -135,10 +190,11 @@ class PartitionDriver(object):
 
         n_procs = self.args.n_procs
         n_proc_list = []  # list of the number of procs we used for each run
+        self.uid_table = UidTable()
 
         # add initial lists of paths
         if self.args.smc_particles == 1:
-            cp = ClusterPath(-1)
+            cp = ClusterPath(-1, uid_table=self.uid_table)
             cp.add_partition([[cl, ] for cl in self.input_info.keys()], logprob=0., n_procs=n_procs)
             self.paths = [cp, ]
         else:
@@ -147,7 +203,7 @@ class PartitionDriver(object):
             for clusters in initial_divvied_queries:  # one set of <clusters> for each process
                 self.smc_info[-1].append([])
                 for iptl in range(self.args.smc_particles):
-                    cp = ClusterPath(-1)
+                    cp = ClusterPath(-1, uid_table=self.uid_table)
                     cp.add_partition([[cl, ] for cl in clusters], logprob=0., n_procs=n_procs)
                     self.smc_info[-1][-1].append(cp)
 
@@ -160,19 +216,23 @@ class PartitionDriver(object):
             return
 
         # run that shiznit
+        step_times = []
         while n_procs > 0:
             start = time.time()
             nclusters = self.get_n_clusters()
             print '--> %d clusters with %d procs' % (nclusters, n_procs)  # write_hmm_input uses the best-minus-ten partition
-            self.run_hmm('forward', self.args.parameter_dir, n_procs=n_procs, divvy_with_bcrham=(self.get_n_clusters() > self.n_max_divvy))
+            self.profiler.count('partition.steps')
+            self.profiler.count('partition.clusters', nclusters)  # summed over steps
+            self.run_hmm('forward', self.args.parameter_dir, n_procs=n_procs, divvy_with_bcrham=(nclusters > self.n_max_divvy))
             n_proc_list.append(n_procs)
 
-            print '      partition step time: %.3f' % (time.time()-start)
+            step_times.append(time.time()-start)
+            print '      partition step time: %.3f' % step_times[-1]
             if n_procs == 1:
                 break
 
             if self.args.smc_particles == 1:  # for smc, we merge pairs of processes; otherwise, we do some heuristics to come up with a good number of clusters for the next iteration
-                n_procs = int(n_procs / 1.5)
+                n_procs = self.get_next_n_procs(n_procs, nclusters, self.get_n_clusters(), step_times)
             else:
                 n_procs = len(self.smc_info[-1])  # if we're doing smc, the number of particles is determined by the file merging process
 
@@ -200,32 +260,19 @@ class PartitionDriver(object):
                 self.write_partitions(self.args.outfname, final_paths)
 
         if self.args.debug and not self.args.is_data:
-            tmpglom = Glomerator(self.reco_info)
+            tmpglom = Glomerator(self.reco_info, truth_index=self.truth_index)
             tmpglom.print_true_partition()
 
     # ----------------------------------------------------------------------------------------
     def check_path(self, path):
-        missing_ids = set()
-        def check_partition(partition):
-            for uid in self.input_info:
-                found = False
-                for cluster in partition:
-                    if uid in cluster:
-                        found = True
-                        break
-                if not found and uid not in self.sw_info['skipped_unproductive_queries']:
-                    missing_ids.add(uid)
-            for cluster in partition:
-                for uid in cluster:
-                    if uid not in self.input_info:
-                        missing_ids.add(uid)
-
-        check_partition(path.partitions[path.i_best])
+        problems = partitioncheck.check_partition(path.partitions[path.i_best], expected_ids=self.input_info, ignore_ids=self.sw_info['skipped_unproductive_queries'])
         # for ipart in range(len(path.partitions)):
         #     check_partition(path.partitions[ipart])
 
-        if len(missing_ids) > 0:
-            print 'WARNING not found in merged partitions: ' + ' '.join(missing_ids)
+        if len(problems['missing']) > 0 or len(problems['unknown']) > 0:
+            print 'WARNING not found in merged partitions: ' + ' '.join(problems['missing'] | problems['unknown'])
+        if len(problems['duplicated']) > 0:
+            print 'WARNING found more than once in merged partitions: ' + ' '.join(problems['duplicated'])
 
     # ----------------------------------------------------------------------------------------
     def write_partitions(self, outfname, paths):
@@ -237,9 +284,8 @@ class PartitionDriver(object):
                 headers += ['adj_mi', 'n_true_clusters', 'bad_clusters']
             writer = csv.DictWriter(outfile, headers)
             writer.writeheader()
-            true_partition = None if self.args.is_data else utils.get_true_partition(self.reco_info)
             for ipath in range(len(paths)):
-                paths[ipath].write_partitions(writer, self.args.is_data, self.reco_info, true_partition, self.args.smc_particles, path_index=self.args.seed + ipath, n_to_write=self.args.n_partitions_to_write, calc_adj_mi='best')
+                paths[ipath].write_partitions(writer, self.args.is_data, self.reco_info, self.truth_index, self.args.smc_particles, path_index=self.args.seed + ipath, n_to_write=self.args.n_partitions_to_write, calc_adj_mi='best')
 
     # ----------------------------------------------------------------------------------------
     def cluster_with_naive_vsearch(self, parameter_dir):
@@ -355,9 +401,9 @@ class PartitionDriver(object):
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def execute_iproc(self, cmd_str):
-        proc = Popen(cmd_str.split(), stdout=PIPE, stderr=PIPE)
-        return proc
+    def execute_iproc(self, cmd_str, iproc, finished):
+        """ start <cmd_str>, and put (<iproc>, out, err) on the <finished> queue when it's done """
+        return utils.start_watched_proc(cmd_str, iproc, finished)
 
     # ----------------------------------------------------------------------------------------
     def execute(self, cmd_str, n_procs, total_naive_hamming_cluster_procs=None):
@@ -369,6 +415,7 @@ class PartitionDriver(object):
             # print cmd_str
             # sys.exit()
             check_call(cmd_str.split())
+            self.profiler.count('bcrham.procs')
         else:
             if total_naive_hamming_cluster_procs is not None:
                 n_leftover = total_naive_hamming_cluster_procs - (total_naive_hamming_cluster_procs / n_procs) * n_procs
@@ -384,26 +431,37 @@ class PartitionDriver(object):
                     cmd_strs[-1] = cmd_strs[-1].replace('XXX', str(clusters_this_proc))
                 # print cmd_strs[-1]
                 # sys.exit()
-            procs, n_tries = [], []
-            for iproc in range(n_procs):
-                procs.append(self.execute_iproc(cmd_strs[iproc]))
-                n_tries.append(1)
-            while procs.count(None) != len(procs):
-                for iproc in range(n_procs):
-                    if procs[iproc] is None:
-                        continue
-                    out, err = procs[iproc].communicate()
-                    utils.process_out_err(out, err, extra_str=str(iproc))
-                    outfname = self.hmm_outfname.replace(self.args.workdir, workdirs[iproc])
-                    if os.path.exists(outfname):  # TODO also check cachefile, if necessary
-                        procs[iproc] = None  # job succeeded
-                    elif n_tries[iproc] > 5:
-                        raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s' % (cmd_strs[iproc], workdirs[iproc]))
-                    else:
-                        print '    rerunning proc %d' % iproc
-                        procs[iproc] = self.execute_iproc(cmd_strs[iproc])
-                        n_tries[iproc] += 1
-                        time.sleep(0.1)
+
+            # keep at most <max_running> procs going at once, starting the next chunk (or rerunning a failed one) as soon as any proc finishes
+            max_running = n_procs if self.max_concurrent_procs is None else max(1, min(n_procs, self.max_concurrent_procs))
+            pending = deque(range(n_procs))  # chunks waiting for a free slot (failed chunks go back on the front)
+            finished = Queue.Queue()
+            running, n_tries = {}, [0 for _ in range(n_procs)]
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < max_running:
+                    iproc = pending.popleft()
+                    running[iproc] = self.execute_iproc(cmd_strs[iproc], iproc, finished)
+                    n_tries[iproc] += 1
+                    self.profiler.count('bcrham.procs')
+                try:
+                    iproc, out, err = utils.get_finished_proc(finished)
+                except KeyboardInterrupt:
+                    for proc in running.values():  # don't leave them running behind our backs
+                        proc.kill()
+                    raise
+                del running[iproc]
+                utils.process_out_err(out, err, extra_str=str(iproc))
+                outfname = self.hmm_outfname.replace(self.args.workdir, workdirs[iproc])
+                if os.path.exists(outfname):  # TODO also check cachefile, if necessary
+                    continue  # job succeeded
+                elif n_tries[iproc] > 5:
+                    for proc in running.values():  # don't leave the other procs running behind our backs
+                        proc.kill()
+                    raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s' % (cmd_strs[iproc], workdirs[iproc]))
+                else:
+                    print '    rerunning proc %d' % iproc
+                    self.profiler.count('bcrham.retries')
+                    pending.appendleft(iproc)
 
         sys.stdout.flush()
         print '      hmm run time: %.3f' % (time.time()-start)
@@ -421,7 +479,8 @@ class PartitionDriver(object):
             raise Exception('bad n_procs %s' % n_procs)
 
         # if not naive_hamming_cluster:  # should already be there
-        self.write_hmm_input(parameter_dir=parameter_in_dir)  # TODO don't keep rewriting it
+        with self.profiler.span('write_hmm_input'):
+            self.write_hmm_input(parameter_dir=parameter_in_dir)  # TODO don't keep rewriting it
 
         # sys.stdout.flush()
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir)
@@ -430,19 +489,26 @@ class PartitionDriver(object):
             assert '--partition' in cmd_str
             cmd_str = cmd_str.replace('--partition', '--cache-naive-seqs')
 
-        if n_procs > 1 and self.args.smc_particles == 1:  # if we're doing smc (i.e. if > 1), we have to split things up more complicatedly elsewhere
-            if divvy_with_bcrham:
-                print '      naive hamming clustering'
-                assert '--partition' in cmd_str and algorithm == 'forward'
-                n_divvy_procs = max(1, self.get_n_clusters() / 500)  # number of bcrham procs used to divvy up queries with naive hamming clustering
-                self.split_input(n_procs=n_divvy_procs, infname=self.hmm_infname, prefix='hmm', divvy_up=False)
-                self.execute(cmd_str.replace('--partition', '--naive-hamming-cluster XXX'), n_procs=n_divvy_procs, total_naive_hamming_cluster_procs=n_procs)
-                self.read_naive_hamming_clusters(n_procs=n_divvy_procs)
-            self.split_input(n_procs, infname=self.hmm_infname, prefix='hmm', divvy_up=(self.args.action=='partition' and algorithm=='forward'))
-
-        self.execute(cmd_str, n_procs)
+        divvy_up = self.args.action == 'partition' and algorithm == 'forward'  # if we're partitioning, which queries end up together in a chunk changes the results
+        if self.max_concurrent_procs is not None and not divvy_up and self.args.smc_particles == 1:
+            n_procs = max(n_procs, min(len(self.hmm_input_lines), self.chunks_per_proc * self.max_concurrent_procs))
 
-        self.read_hmm_output(algorithm, n_procs, count_parameters, parameter_out_dir, cache_naive_seqs)
+        if n_procs > 1 and self.args.smc_particles == 1:  # if we're doing smc (i.e. if > 1), we have to split things up more complicatedly elsewhere
+            with self.profiler.span('divvy'):
+                if divvy_with_bcrham:
+                    print '      naive hamming clustering'
+                    assert '--partition' in cmd_str and algorithm == 'forward'
+                    n_divvy_procs = max(1, self.get_n_clusters() / 500)  # number of bcrham procs used to divvy up queries with naive hamming clustering
+                    self.split_input(n_procs=n_divvy_procs, infname=self.hmm_infname, prefix='hmm', divvy_up=False, info=self.hmm_input_lines)
+                    self.execute(cmd_str.replace('--partition', '--naive-hamming-cluster XXX'), n_procs=n_divvy_procs, total_naive_hamming_cluster_procs=n_procs)
+                    self.read_naive_hamming_clusters(n_procs=n_divvy_procs)
+                self.split_input(n_procs, infname=self.hmm_infname, prefix='hmm', divvy_up=divvy_up, info=self.hmm_input_lines)
+
+        with self.profiler.span('execute'):
+            self.execute(cmd_str, n_procs)
+
+        with self.profiler.span('read_output'):
+            self.read_hmm_output(algorithm, n_procs, count_parameters, parameter_out_dir, cache_naive_seqs)
 
     # ----------------------------------------------------------------------------------------
     def divvy_up_queries(self, n_procs, info, namekey, seqkey, debug=True):
@@ -461,16 +527,23 @@ class PartitionDriver(object):
                 naive_seq = padleft * utils.ambiguous_bases[0] + naive_seq + padright * utils.ambiguous_bases[0]
             return naive_seq
 
+        cached_naive_seqs = {}
+        if self.persistent_cache is not None:
+            cached_naive_seqs = self.persistent_cache.get_naive_seqs([line[namekey] for line in info])
+
         naive_seqs = {}
         for line in info:
             query = line[namekey]
             seqstr = line['padded'][seqkey] if 'padded' in line else line[seqkey]
-            # NOTE cached naive seqs should all be the same length
-            if self.cached_results is not None and seqstr in self.cached_results and self.cached_results[seqstr]['naive_seq'] is not None:  # first try to used cached hmm results
-                naive_seqs[query] = self.cached_results[seqstr]['naive_seq']
+            # NOTE cached naive seqs should all be the same length (which they won't be if they were padded in a run with different sequences)
+            if query in cached_naive_seqs and len(cached_naive_seqs[query]) == len(seqstr):  # first try to used cached hmm results
+                naive_seqs[query] = cached_naive_seqs[query]
+                self.profiler.count('cache.naive_seq_hits')
             elif len(query.split(':')) == 1:  # ...but if we don't have them, use smith-waterman (should only be for single queries)
                naive_seqs[query] = get_query_from_sw(query)
+               self.profiler.count('cache.naive_seq_misses')
             elif len(query.split(':')) > 1:
+                self.profiler.count('cache.naive_seq_misses')
                 naive_seqs[query] = get_query_from_sw(query.split(':')[0])  # just arbitrarily use the naive seq from the first one. This is ok partly because if we cache the logprob but not the naive seq, that's because we thought about merging two clusters but did not -- so they're naive seqs should be similar. Also, this is just for divvying queries.
             else:
                 raise Exception('no naive sequence found for ' + str(query))
@@ -496,85 +569,175 @@ class PartitionDriver(object):
         return divvied_queries
 
     # ----------------------------------------------------------------------------------------
-    def split_input(self, n_procs, infname, prefix, divvy_up):
-        """ Do stuff. Probably correctly. """
-        # read single input file
+    def split_input(self, n_procs, infname, prefix, divvy_up, info=None):
+        """ Split <infname> (or, if it's set, the list of lines <info> that we just wrote to it, so we don't have to read it back in) into one input file per process """
         assert self.args.smc_particles == 1
-        info = []
-        with opener('r')(infname) as infile:
-            reader = csv.DictReader(infile, delimiter=' ')
-            for line in reader:
-                info.append(line)
-
-        # initialize
-        sub_outfiles, writers = [], []
-        for iproc in range(n_procs):
-            subworkdir = self.args.workdir + '/' + prefix + '-' + str(iproc)
-            utils.prep_dir(subworkdir)
-            # prep each suboutput file
-            sub_outfiles.append(opener('w')(subworkdir + '/' + os.path.basename(infname)))
-            writers.append(csv.DictWriter(sub_outfiles[-1], reader.fieldnames, delimiter=' '))
-            writers[-1].writeheader()
-            # copy cachefile to this subdir
-            if os.path.exists(self.hmm_cachefname):
-                check_call(['cp', self.hmm_cachefname, subworkdir + '/'])
+        if info is None:  # read single input file
+            info = []
+            with opener('r')(infname) as infile:
+                reader = csv.DictReader(infile, delimiter=' ')
+                for line in reader:
+                    info.append(line)
 
+        # figure out which proc each line goes to
         if divvy_up:
             divvied_queries = self.divvy_up_queries(n_procs, info, 'names', 'seqs')
+            iprocs = {query : iproc for iproc in range(n_procs) for query in divvied_queries[iproc]}
+            # NOTE I think the reason this doesn't seem to be speeding things up is that our hierarhical agglomeration time is dominated by the distance calculation, and that distance calculation time is roughly proportional to the number of sequences in the cluster (i.e. larger clusters take longer)
+            line_iprocs = [iprocs.get(line['names']) for line in info]  # lines that didn't get divvied to any proc are skipped
+        else:
+            line_iprocs = [iquery % n_procs for iquery in range(len(info))]
+
+        subworkdirs = []
         for iproc in range(n_procs):
-            for iquery in range(len(info)):
-                if divvy_up:
-                    if info[iquery]['names'] not in divvied_queries[iproc]:  # NOTE I think the reason this doesn't seem to be speeding things up is that our hierarhical agglomeration time is dominated by the distance calculation, and that distance calculation time is roughly proportional to the number of sequences in the cluster (i.e. larger clusters take longer)
-                        continue
-                else:
-                    if iquery % n_procs != iproc:
-                        continue
-                writers[iproc].writerow(info[iquery])
+            subworkdirs.append(self.args.workdir + '/' + prefix + '-' + str(iproc))
+            utils.prep_dir(subworkdirs[-1])
 
+        # write each suboutput file
+        sub_outfiles, writers = [], []
+        for iproc in range(n_procs):
+            sub_outfiles.append(opener('w')(subworkdirs[iproc] + '/' + os.path.basename(infname)))
+            writers.append(csv.DictWriter(sub_outfiles[-1], self.hmm_input_header, delimiter=' '))
+            writers[-1].writeheader()
+        for iquery in range(len(info)):
+            if line_iprocs[iquery] is not None:
+                writers[line_iprocs[iquery]].writerow(info[iquery])
         for iproc in range(n_procs):
             sub_outfiles[iproc].close()
 
+        proc_queries = [set() for _ in range(n_procs)]
+        for iquery in range(len(info)):
+            if line_iprocs[iquery] is not None:
+                proc_queries[line_iprocs[iquery]] |= set(info[iquery]['names'].split(':'))
+        self.write_subprocess_cachefiles(subworkdirs, proc_queries)
+
         if self.bcrham_divvied_queries is not None:
             self.bcrham_divvied_queries = None
 
     # ----------------------------------------------------------------------------------------
-    def merge_subprocess_files(self, fname, n_procs, csv_header=True):
+    def write_subprocess_cachefiles(self, subworkdirs, proc_queries):
+        """
+        Write a cache file to each of <subworkdirs> with only the lines whose queries are all in that proc's <proc_queries> (since those are the only ones it can look up).
+        So we write the cache once in total, rather than copying all of it to every proc (the rest of the lines stay in the main cache file, see merge_subprocess_files()).
+        """
+        if not os.path.exists(self.hmm_cachefname) or os.stat(self.hmm_cachefname).st_size == 0:
+            return
+        iprocs = {query : iproc for iproc in range(len(proc_queries)) for query in proc_queries[iproc]}
+        sub_cachefiles, writers = [], []
+        with open(self.hmm_cachefname) as cachefile:
+            reader = csv.reader(cachefile)
+            header = reader.next()
+            ikey = header.index('unique_ids')
+            for subworkdir in subworkdirs:
+                sub_cachefiles.append(open(subworkdir + '/' + os.path.basename(self.hmm_cachefname), 'w'))
+                writers.append(csv.writer(sub_cachefiles[-1], lineterminator='\n'))
+                writers[-1].writerow(header)
+            for line in reader:
+                if len(line) == 0:
+                    continue
+                line_iprocs = set(iprocs.get(uid) for uid in line[ikey].split(':'))
+                if len(line_iprocs) == 1 and None not in line_iprocs:
+                    writers[line_iprocs.pop()].writerow(line)
+        for sub_cachefile in sub_cachefiles:
+            sub_cachefile.close()
+
+    # ----------------------------------------------------------------------------------------
+    def merge_subprocess_files(self, fname, n_procs, csv_header=True, include_fname=False, dedup_column=None):
+        """ if <include_fname>, also keep the lines already in <fname> (e.g. for the cache file, since each proc only got some of its lines). <dedup_column> is passed to merge_files(). """
         subfnames = []
+        if include_fname and os.path.exists(fname):
+            os.rename(fname, fname + '.prev')
+            subfnames.append(fname + '.prev')
         for iproc in range(n_procs):
             subfnames.append(self.args.workdir + '/hmm-' + str(iproc) + '/' + os.path.basename(fname))
-        self.merge_files(subfnames, fname, csv_header)
+        self.merge_files(subfnames, fname, csv_header, dedup_column=dedup_column)
 
     # ----------------------------------------------------------------------------------------
-    def merge_files(self, infnames, outfname, csv_header=True):
+    def merge_files(self, infnames, outfname, csv_header=True, dedup_column=None):
         """ 
         Merge <infnames> into <outfname>.
         NOTE that <outfname> is overwritten with the zero-length file if it exists, otherwise it is created.
         Some of <infnames> may not exist.
+        Lines are written sorted by <dedup_column> (or by the whole line, if it isn't set or there's no such column), with one line for each value of <dedup_column>, so merged files stay sorted on disk.
+        Only set <dedup_column> for files with one line per value of it, like the cache file (the annotation output, for instance, has a line for each of the n best events for each query, so it's deduplicated on the whole line).
+        Each of <infnames> is then usually a sorted part (an earlier merged file, or a subset of one) followed by whatever lines bcrham appended. We stream the sorted part
+        straight from disk, read and sort only the lines after it, and heapq.merge all the streams together, so we never hold a whole file in memory.
         """
         assert outfname not in infnames
         start = time.time()
+        self.profiler.count('merge.files', len(infnames))
 
-        header = ''
-        with open(outfname, 'w') as outfile:
-            if csv_header:  # if not <csv_header>, we'll just end up with a zero-length file
-                for fname in infnames:
-                    if not os.path.exists(fname) or os.stat(fname).st_size == 0:
+        header = None
+        sorted_streams = []
+        for ifile in range(len(infnames)):
+            fname = infnames[ifile]
+            if not os.path.exists(fname) or os.stat(fname).st_size == 0:
+                continue
+            with open(fname) as infile:
+                reader = csv.reader(iter(infile.readline, ''))  # readline() rather than iterating over the file, so tell() gives us the offset of each row
+                if csv_header:
+                    this_header = reader.next()
+                    if header is None:
+                        header = this_header
+                    elif this_header != header:
+                        raise Exception('header %s in %s doesn\'t match %s' % (','.join(this_header), fname, ','.join(header)))
+                ikey = header.index(dedup_column) if header is not None and dedup_column in header else None
+                sorted_start = infile.tell()
+                unsorted_start, unsorted_rows, previous_key = None, [], None
+                while True:
+                    offset = infile.tell()
+                    row = next(reader, None)
+                    if row is None:
+                        break
+                    if len(row) == 0:
                         continue
-                    with open(fname) as headfile:
-                        reader = csv.DictReader(headfile)
-                        writer = csv.DictWriter(outfile, reader.fieldnames)
-                        writer.writeheader()
-                        header = ','.join(reader.fieldnames)
-                    break
+                    key = row[ikey] if ikey is not None else row
+                    if unsorted_start is None and previous_key is not None and key < previous_key:  # everything from here on is treated as new
+                        unsorted_start = offset
+                    if unsorted_start is None:
+                        previous_key = key
+                    else:
+                        unsorted_rows.append((key, ifile, row))  # <ifile> breaks ties in favor of earlier files
+            unsorted_rows.sort()
+            sorted_streams.append(self.read_sorted_rows(fname, ifile, ikey, sorted_start, offset if unsorted_start is None else unsorted_start))
+            sorted_streams.append(unsorted_rows)
 
-        cmd = 'cat ' + ' '.join(infnames) + ' | grep -v \'^' + header + '$\' | sort | uniq >>' + outfname
-        check_call(cmd, shell=True)
+        n_written = 0
+        with open(outfname, 'w') as outfile:
+            writer = csv.writer(outfile, lineterminator='\n')  # same line endings as bcrham
+            if header is not None:  # if not <csv_header>, or all the files are empty, we'll just end up with a zero-length file
+                writer.writerow(header)
+            previous_key, best_row = None, None
+            for key, _, row in heapq.merge(*sorted_streams):
+                if key != previous_key:
+                    if best_row is not None:
+                        writer.writerow(best_row)
+                        n_written += 1
+                    previous_key, best_row = key, row
+                elif sum(val != '' for val in row) > sum(val != '' for val in best_row):  # duplicate: keep whichever line has more info (e.g. a logprob as well as a naive seq)
+                    best_row = row
+            if best_row is not None:
+                writer.writerow(best_row)
+                n_written += 1
 
         if not self.args.no_clean:
             for infname in infnames:
                 os.remove(infname)
 
-        print '    time to merge csv files: %.3f' % (time.time()-start)
+        self.profiler.add_time('merge', time.time()-start)
+        self.profiler.count('merge.lines', n_written)
+        print '    time to merge csv files (%d lines): %.3f' % (n_written, time.time()-start)
+
+    # ----------------------------------------------------------------------------------------
+    def read_sorted_rows(self, fname, ifile, ikey, start, stop):
+        """ yield (key, <ifile>, row) for each csv row in <fname> between byte offsets <start> and <stop>, which merge_files() has already checked are sorted """
+        with open(fname) as infile:
+            infile.seek(start)
+            reader = csv.reader(iter(infile.readline, ''))
+            while infile.tell() < stop:
+                row = reader.next()
+                if len(row) > 0:
+                    yield (row[ikey] if ikey is not None else row), ifile, row
 
     # ----------------------------------------------------------------------------------------
     def merge_all_hmm_outputs(self, n_procs, cache_naive_seqs):
@@ -582,7 +745,7 @@ class PartitionDriver(object):
         assert self.args.smc_particles == 1  # have to do things more complicatedly for smc
         if self.args.action == 'partition':  # merge partitions from several files
             if n_procs > 1:
-                self.merge_subprocess_files(self.hmm_cachefname, n_procs)
+                self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_fname=True, dedup_column='unique_ids')
 
             if not cache_naive_seqs:
                 if n_procs == 1:
@@ -592,7 +755,7 @@ class PartitionDriver(object):
                 previous_info = None
                 if len(self.paths) > 1:
                     previous_info = self.paths[-1]
-                glomerer = Glomerator(self.reco_info)
+                glomerer = Glomerator(self.reco_info, truth_index=self.truth_index, uid_table=self.uid_table)
                 glomerer.read_cached_agglomeration(infnames, smc_particles=1, previous_info=previous_info, calc_adj_mi=self.args.debug, debug=self.args.debug)  #, outfname=self.hmm_outfname)
                 assert len(glomerer.paths) == 1
                 # self.check_path(glomerer.paths[0])
@@ -634,7 +797,7 @@ class PartitionDriver(object):
             previous_info = None
             if len(self.smc_info) > 2:
                 previous_info = [self.smc_info[-2][iproc] for iproc in group]
-            glomerer = Glomerator(self.reco_info)
+            glomerer = Glomerator(self.reco_info, truth_index=self.truth_index, uid_table=self.uid_table)
             paths = glomerer.read_cached_agglomeration(infnames, self.args.smc_particles, previous_info=previous_info, calc_adj_mi=self.args.debug, debug=self.args.debug)  #, outfname=self.hmm_outfname)
             self.smc_info[-1].append(paths)
 
@@ -642,7 +805,7 @@ class PartitionDriver(object):
             # boof? self.list_of_preclusters.append(glomerer.combined_conservative_best_minus_ten_partitions)
 
         if n_procs > 1:  # TODO I don't think this is right any more...
-            self.merge_subprocess_files(self.hmm_cachefname, n_procs)
+            self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_fname=True, dedup_column='unique_ids')
             
         if not self.args.no_clean:
             if n_procs == 1:
@@ -983,13 +1146,14 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def write_to_single_input_file(self, fname, mode, nsets, parameter_dir, skipped_gene_matches, path_index=0, logweight=0.):
+        """ write a line to <fname> for each set of queries in <nsets>, and return the lines (so split_input() doesn't have to read them back in) """
         csvfile = opener(mode)(fname)
-        header = ['path_index', 'logweight', 'names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'only_genes', 'seqs', 'mute_freqs', 'cyst_positions']  # NOTE logweight is for the whole partition
-        writer = csv.DictWriter(csvfile, header, delimiter=' ')  # NOTE should eventually rewrite arg parser in ham to handle csvs (like in glomerator cache reader)
+        writer = csv.DictWriter(csvfile, self.hmm_input_header, delimiter=' ')  # NOTE should eventually rewrite arg parser in ham to handle csvs (like in glomerator cache reader)
         if mode == 'w':
             writer.writeheader()
         # start = time.time()
 
+        lines = []
         for query_names in nsets:
             non_failed_names = self.remove_sw_failures(query_names)
             if len(non_failed_names) == 0:
@@ -997,7 +1161,7 @@ class PartitionDriver(object):
             combined_query = self.combine_queries(non_failed_names, parameter_dir, skipped_gene_matches=skipped_gene_matches)
             if len(combined_query) == 0:  # didn't find all regions
                 continue
-            writer.writerow({
+            lines.append({
                 'path_index' : path_index,
                 'logweight' : logweight,  # NOTE same for all lines with the same <path_index> (since they're all from the same partition)
                 'names' : ':'.join([qn for qn in non_failed_names]),
@@ -1011,17 +1175,21 @@ class PartitionDriver(object):
                 'cyst_positions' : ':'.join([str(cpos) for cpos in combined_query['cyst_positions']]),  # TODO should really use the hmm cpos if it's available
                 # 'cyst_positions' : ':'.join([str(self.sw_info[qn]['cyst_position']) for qn in non_failed_names])  # TODO should really use the hmm cpos if it's available
             })
+            writer.writerow(lines[-1])
 
         csvfile.close()
         # print '        input write time: %.3f' % (time.time()-start)
+        return lines
 
     # ----------------------------------------------------------------------------------------
     def write_hmm_input(self, parameter_dir):
         """ Write input file for bcrham """
         print '    writing input'
         # if self.cached_results is None:
-        if self.args.persistent_cachefname is not None and os.path.exists(self.args.persistent_cachefname):
-            check_call(['cp', '-v', self.args.persistent_cachefname, self.args.workdir + '/' + os.path.basename(self.hmm_cachefname)])
+        if self.persistent_cache is not None and not os.path.exists(self.hmm_cachefname):  # only need to start from the persistent cache the first time (after that, it's already in the cache file)
+            n_cached = self.persistent_cache.write_csv(self.hmm_cachefname, self.input_info.keys())
+            print '      %d lines from persistent cache %s' % (n_cached, self.args.persistent_cachefname)
+            self.profiler.count('cache.persistent_lines_used', n_cached)
         # else:
         #     pass
         #     # assert os.path.exists(self.hmm_cachefname)
@@ -1032,6 +1200,7 @@ class PartitionDriver(object):
             self.pad_seqs_to_same_length()  # adds padded info to sw_info (returns if stuff has already been padded)
 
         skipped_gene_matches = set()
+        self.hmm_input_lines = None
 
         if self.args.smc_particles > 1:
             assert self.args.action == 'partition'
@@ -1042,14 +1211,15 @@ class PartitionDriver(object):
                 else:
                     subworkdir = self.args.workdir + '/hmm-' + str(iproc)
                     utils.prep_dir(subworkdir)
-                    if os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir
-                        check_call(['cp', self.hmm_cachefname, subworkdir + '/'])  # NOTE this is kind of wasteful to write it to each subdirectory (it could be large) but it's cleaner this way, 'cause then the subdirs are independent
                     fname = subworkdir + '/' + os.path.basename(self.hmm_infname)
                 procinfo = self.smc_info[-1][iproc]  # list of ClusterPaths, one for each smc particle
                 for iptl in range(len(procinfo)):
                     path = procinfo[iptl]
                     self.write_to_single_input_file(fname, 'w' if iptl==0 else 'a', list(path.partitions[path.i_best_minus_x]), parameter_dir,  #  list() is important since we may modify <nsets>
                                                     skipped_gene_matches, path_index=iptl, logweight=path.logweights[path.i_best_minus_x])
+            if n_procs > 1:  # each proc gets the cache lines for its own queries
+                proc_queries = [set(q for path in procinfo for cluster in path.partitions[path.i_best_minus_x] for q in cluster) for procinfo in self.smc_info[-1]]
+                self.write_subprocess_cachefiles([self.args.workdir + '/hmm-' + str(iproc) for iproc in range(n_procs)], proc_queries)
         else:
             if self.args.action == 'partition':
                 nsets = list(self.paths[-1].partitions[self.paths[-1].i_best_minus_x])  #  list() is important since we modify <nsets>
@@ -1072,7 +1242,7 @@ class PartitionDriver(object):
                         if len(this_set) > 0:
                             nsets.append(this_set)
 
-            self.write_to_single_input_file(self.hmm_infname, 'w', nsets, parameter_dir, skipped_gene_matches)
+            self.hmm_input_lines = self.write_to_single_input_file(self.hmm_infname, 'w', nsets, parameter_dir, skipped_gene_matches)
 
         if self.args.debug and len(skipped_gene_matches) > 0:
             print '    not found in %s, so removing from consideration for hmm (i.e. were only the nth best, but never the best sw match for any query):' % (parameter_dir),
@@ -1184,9 +1354,7 @@ class PartitionDriver(object):
                                          int_columns=('nth_best', 'v_5p_del', 'd_5p_del', 'cdr3_length', 'j_5p_del', 'j_3p_del', 'd_3p_del', 'v_3p_del'),
                                          float_columns=('logprob'))
                 ids = line['unique_ids']
-                same_event = utils.from_same_event(self.args.is_data, self.reco_info, ids)
-                if same_event is None:
-                    same_event = -1
+                same_event = -1 if self.args.is_data else self.truth_index.from_same_event(ids)
                 id_str = ''.join(['%20s ' % i for i in ids])
 
                 # check for errors
@@ -1263,8 +1431,9 @@ class PartitionDriver(object):
                 writer = csv.DictWriter(outfile, headers)
                 writer.writeheader()
 
+            buckets = annotationclustering.get_vollmers_buckets(hmminfo, 1. - min(self.args.annotation_clustering_thresholds), n_procs=self.args.n_procs)  # the distances don't depend on the threshold, so only work them out once (keeping only the pairs that are close enough for the loosest threshold)
             for thresh in self.args.annotation_clustering_thresholds:
-                adj_mi, partition = annotationclustering.vollmers(hmminfo, threshold=thresh, reco_info=self.reco_info)
+                adj_mi, partition = annotationclustering.vollmers(hmminfo, threshold=thresh, reco_info=self.reco_info, truth_index=self.truth_index, buckets=buckets)
                 n_clusters = len(partition)
                 if self.args.outfname is not None:
                     row = {'n_clusters' : n_clusters, 'threshold' : thresh, 'clusters' : utils.get_str_from_partition(partition)}
@@ -1284,7 +1453,7 @@ class PartitionDriver(object):
     def print_hmm_output(self, line, print_true=False):
         out_str_list = []
         if print_true and not self.args.is_data:  # first print true event (if this is simulation)
-            for uids in utils.get_true_clusters(line['unique_ids'], self.reco_info).values():
+            for uids in self.truth_index.get_true_clusters(line['unique_ids']).values():
                 synthetic_true_line = dict(self.reco_info[uids[0]])
                 synthetic_true_line['unique_ids'] = uids
                 synthetic_true_line['seqs'] = [self.reco_info[iid]['seq'] for iid in uids]
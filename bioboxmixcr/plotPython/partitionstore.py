@@ -0,0 +1,192 @@
+"""
+Compact storage for the partitions in a ClusterPath.
+Uids are interned to integer ids once, and each partition is stored either in full (as numpy arrays of ids) or, if it's just the previous partition with two clusters merged, as a record of that merge.
+We only make lists of uid strings when someone asks for a partition (i.e. for output).
+"""
+import numpy
+
+id_dtype = numpy.int32
+
+# ----------------------------------------------------------------------------------------
+class UidTable(object):
+    """ two-way map between uid strings and the integer ids we store instead """
+    def __init__(self):
+        self.ids = {}
+        self.uids = []
+
+    def __len__(self):
+        return len(self.uids)
+
+    def get_id(self, uid):
+        if uid not in self.ids:
+            self.ids[uid] = len(self.uids)
+            self.uids.append(uid)
+        return self.ids[uid]
+
+    def get_uids(self, ids):
+        return [self.uids[i] for i in ids]
+
+# ----------------------------------------------------------------------------------------
+class CompactPartition(object):
+    """ one partition as two arrays: the ids of every uid, cluster by cluster, and the index in <ids> at which each cluster starts (with len(ids) on the end). Treated as immutable, so it's fine to share them. """
+    __slots__ = ('ids', 'starts')
+
+    def __init__(self, ids, starts):
+        self.ids = ids
+        self.starts = starts
+
+    @classmethod
+    def from_lists(cls, partition, uid_table):
+        starts = numpy.zeros(len(partition) + 1, dtype=id_dtype)
+        starts[1:] = numpy.cumsum([len(cluster) for cluster in partition])
+        ids = numpy.fromiter((uid_table.get_id(uid) for cluster in partition for uid in cluster), dtype=id_dtype, count=int(starts[-1]))
+        return cls(ids, starts)
+
+    @classmethod
+    def concatenate(cls, partitions):
+        """ put the clusters from each of <partitions> (which must use the same uid table) into one partition """
+        ids = numpy.concatenate([ptn.ids for ptn in partitions])
+        offsets = numpy.cumsum([0] + [len(ptn.ids) for ptn in partitions[:-1]])
+        starts = numpy.concatenate([ptn.starts[:-1] + offset for ptn, offset in zip(partitions, offsets)] + [[len(ids)]]).astype(id_dtype)
+        return cls(ids, starts)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def sizes(self):
+        return numpy.diff(self.starts)
+
+    def cluster(self, iclust):
+        return self.ids[self.starts[iclust] : self.starts[iclust + 1]]
+
+    def get_cluster_tuples(self):
+        ids, starts = self.ids.tolist(), self.starts.tolist()
+        return [tuple(ids[starts[ic] : starts[ic + 1]]) for ic in range(len(self))]
+
+    def to_lists(self, uid_table):
+        uids, starts = uid_table.get_uids(self.ids.tolist()), self.starts.tolist()
+        return [uids[starts[ic] : starts[ic + 1]] for ic in range(len(self))]
+
+    def apply_merge(self, merge):
+        """ return the partition you get by removing clusters <i> and <j> and inserting a cluster with ids <merged_ids> at index <k> """
+        i, j, k, merged_ids = merge
+        sizes = self.sizes()
+        keep = numpy.ones(len(self), dtype=bool)
+        keep[[i, j]] = False
+        kept_ids = self.ids[numpy.repeat(keep, sizes)]
+        kept_sizes = sizes[keep]
+        pos = int(kept_sizes[:k].sum())
+        ids = numpy.concatenate((kept_ids[:pos], merged_ids, kept_ids[pos:]))
+        starts = numpy.zeros(len(kept_sizes) + 2, dtype=id_dtype)
+        starts[1:] = numpy.cumsum(numpy.insert(kept_sizes, k, len(merged_ids)))
+        return CompactPartition(ids, starts)
+
+# ----------------------------------------------------------------------------------------
+class PartitionStore(object):
+    """
+    List-like sequence of partitions: append() lists of lists of uids (or CompactPartitions from a store with the same uid table), and indexing gives you back lists of lists of uids.
+    Every <snapshot_interval>th partition (at most) is stored in full, so getting a random one means replaying at most that many merges. Sequential access only replays one.
+    """
+    def __init__(self, uid_table=None, snapshot_interval=50):
+        self.uid_table = UidTable() if uid_table is None else uid_table  # pass in the same table to stores you want to move partitions between without translating ids
+        self.snapshot_interval = snapshot_interval
+        self.records = []  # either a CompactPartition, or a merge (i, j, k, merged_ids) to apply to the previous partition
+        self.n_clusters = []  # number of clusters in each partition
+        self.n_since_snapshot = 0
+        self.last_tuples = None  # clusters in the last partition, as tuples of ids, so we can spot merges without replaying anything
+        self.cached = None  # (index, partition) of the last partition we replayed
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, ip):
+        return self.get_compact(ip).to_lists(self.uid_table)
+
+    def __iter__(self):
+        for ip in range(len(self)):
+            yield self[ip]
+
+    def __delitem__(self, ip):
+        ip = self.check_index(ip)
+        if ip + 1 < len(self) and not isinstance(self.records[ip + 1], CompactPartition):  # the next one is a merge on top of this one, so it has to be stored in full from now on
+            self.records[ip + 1] = self.get_compact(ip + 1)
+        del self.records[ip]
+        del self.n_clusters[ip]
+        self.cached = None
+        if ip == len(self):  # removed the last one, so start over for spotting merges
+            self.last_tuples = None
+
+    # ----------------------------------------------------------------------------------------
+    def check_index(self, ip):
+        if ip < 0:
+            ip += len(self)
+        if ip < 0 or ip >= len(self):
+            raise IndexError('partition index %d out of range for %d partitions' % (ip, len(self)))
+        return ip
+
+    # ----------------------------------------------------------------------------------------
+    def append(self, partition):
+        if not isinstance(partition, CompactPartition):
+            partition = CompactPartition.from_lists(partition, self.uid_table)
+        tuples = partition.get_cluster_tuples()
+        merge = None
+        if self.last_tuples is not None and self.n_since_snapshot < self.snapshot_interval:
+            merge = self.find_merge(tuples)
+        if merge is None:
+            self.records.append(partition)
+            self.n_since_snapshot = 0
+        else:
+            i, j, k = merge
+            self.records.append((i, j, k, partition.cluster(k).copy()))  # copy, so we don't keep the whole <partition> alive
+            self.n_since_snapshot += 1
+        self.n_clusters.append(len(partition))
+        self.last_tuples = tuples
+
+    # ----------------------------------------------------------------------------------------
+    def find_merge(self, tuples):
+        """ if <tuples> is the last partition with clusters i and j merged into a new cluster at index k (and the other clusters in the same order), return (i, j, k), otherwise None """
+        if len(tuples) != len(self.last_tuples) - 1:
+            return None
+        previous_index = {cluster : ic for ic, cluster in enumerate(self.last_tuples)}
+        if len(previous_index) != len(self.last_tuples):  # duplicate clusters, so we can't tell which is which
+            return None
+        k, previous_ics = None, []
+        for ic, cluster in enumerate(tuples):
+            if cluster in previous_index:
+                previous_ics.append(previous_index[cluster])
+            elif k is None:
+                k = ic
+            else:
+                return None
+        if k is None:
+            return None
+        missing = sorted(set(range(len(self.last_tuples))) - set(previous_ics))
+        if len(missing) != 2 or previous_ics != [ic for ic in range(len(self.last_tuples)) if ic not in missing]:
+            return None
+        i, j = missing
+        if sorted(tuples[k]) != sorted(self.last_tuples[i] + self.last_tuples[j]):
+            return None
+        return i, j, k
+
+    # ----------------------------------------------------------------------------------------
+    def get_compact(self, ip):
+        ip = self.check_index(ip)
+        if self.cached is not None and self.cached[0] == ip:
+            return self.cached[1]
+        istart = ip
+        while not isinstance(self.records[istart], CompactPartition):  # go back to the last one that's stored in full...
+            istart -= 1
+        partition = self.records[istart]
+        if self.cached is not None and istart < self.cached[0] < ip:  # ...unless we already replayed part of the way
+            istart, partition = self.cached
+        for jp in range(istart + 1, ip + 1):
+            partition = partition.apply_merge(self.records[jp])
+        self.cached = (ip, partition)
+        return partition
+
+    # ----------------------------------------------------------------------------------------
+    def get_compact_for(self, ip, uid_table):
+        """ partition <ip> as a CompactPartition in terms of <uid_table> (only going back through the uid strings if it isn't our table) """
+        if uid_table is self.uid_table:
+            return self.get_compact(ip)
+        return CompactPartition.from_lists(self[ip], uid_table)
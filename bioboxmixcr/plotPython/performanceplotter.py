@@ -1,4 +1,6 @@
 import sys
+import json
+import numpy
 import utils
 import plotting
 import re
@@ -100,6 +102,58 @@ class PerformancePlotter(object):
         else:
             return total_distance
 
+    # ----------------------------------------------------------------------------------------
+    def get_naive_seq_pairs(self, true_columns, inf_columns, true_views, inf_views, padfos=None):
+        """ (true naive seq, inferred naive seq) for each query, with the inferred one lined up with the true one the same way as in hamming_distance_to_true_naive() """
+        pairs = []
+        for iquery in range(len(true_views)):
+            true_seq, seq = true_columns['seq'][iquery], inf_columns['seq'][iquery]
+            inferred_naive_seq = inf_views[iquery].naive_seq
+            if len(true_seq) > len(seq):  # ihhhmmm doesn't report the bits of the sequence it erodes off the ends, so we have to add them back on
+                start = true_seq.find(seq)
+                assert start >= 0
+                end = len(seq) + start
+                inferred_naive_seq = 'N'*start + inferred_naive_seq + 'N'*(len(true_seq) - end)
+            if padfos is not None and padfos[iquery] is not None:  # remove N padding from the inferred sequence
+                inferred_naive_seq = inferred_naive_seq[padfos[iquery]['padleft'] : ]
+                if padfos[iquery]['padright'] > 0:
+                    inferred_naive_seq = inferred_naive_seq[ : -padfos[iquery]['padright']]
+            pairs.append((true_views[iquery].naive_seq, inferred_naive_seq))
+        return pairs
+
+    # ----------------------------------------------------------------------------------------
+    def hamming_distances_to_true_naive(self, true_columns, inf_columns, restrict_to_region='', normalize=False, padfos=None, true_views=None, naive_seq_pairs=None):
+        """
+        batch version of hamming_distance_to_true_naive(), with one entry in each column (and in <padfos>, if set) for each query
+        <true_views> (from utils.get_reco_views()) and <naive_seq_pairs> (from get_naive_seq_pairs()) don't depend on <restrict_to_region>, so evaluate_batch() works them out once and passes them in
+        """
+        if true_views is None:
+            true_views = utils.get_reco_views(self.germlines, true_columns)
+        if naive_seq_pairs is None:
+            naive_seq_pairs = self.get_naive_seq_pairs(true_columns, inf_columns, true_views, utils.get_reco_views(self.germlines, inf_columns), padfos=padfos)
+        true_naive_seqs, inferred_naive_seqs = [], []
+        for iquery in range(len(naive_seq_pairs)):
+            true_naive_seq, inferred_naive_seq = naive_seq_pairs[iquery]
+            if restrict_to_region != '':
+                bounds = true_views[iquery].get_bounds()[restrict_to_region]  # get the bounds of this *true* region
+                true_naive_seq = true_naive_seq[bounds[0] : bounds[1]]
+                inferred_naive_seq = inferred_naive_seq[bounds[0] : bounds[1]]
+            if len(true_naive_seq) != len(inferred_naive_seq):
+                raise Exception('still not the same lengths for %s\n  %s\n  %s' % (inf_columns['unique_id'][iquery] if 'unique_id' in inf_columns else iquery, true_naive_seq, inferred_naive_seq))
+            true_naive_seqs.append(true_naive_seq)
+            inferred_naive_seqs.append(inferred_naive_seq)
+
+        fractions, len_excluding_ambig = utils.paired_hamming_fractions(true_naive_seqs, inferred_naive_seqs, return_len_excluding_ambig=True)
+        total_distances = (fractions * len_excluding_ambig).astype(int)
+        lengths = numpy.array([len(seq) for seq in true_naive_seqs], dtype=int)
+        if (lengths == 0).any():
+            print 'WARNING zero length sequence in hamming_distances_to_true_naive'
+            total_distances[lengths == 0] = 0
+        if normalize:
+            nonzero = lengths > 0
+            total_distances[nonzero] = (100 * (total_distances[nonzero] / lengths[nonzero].astype(float))).astype(int)
+        return total_distances
+
     # ----------------------------------------------------------------------------------------
     def add_fail(self):
         for column in self.values:
@@ -126,8 +180,7 @@ class PerformancePlotter(object):
 
     # ----------------------------------------------------------------------------------------
     def evaluate(self, true_line, inf_line, padfo=None):
- 	#CHANGES FOR MIXCR
-        #overall_mute_freq = utils.get_mutation_rate(self.germlines, true_line)  # true value
+        overall_mute_freq = utils.get_mutation_rate(self.germlines, true_line)  # true value (NOTE <true_line> needs the full simulation info, even if <inf_line> only has gene calls)
 
         for column in self.values:
             if self.only_correct_gene_fractions and column not in bool_columns:
@@ -164,6 +217,9 @@ class PerformancePlotter(object):
                     self.values[column][diff] = 0
                 self.values[column][diff] += 1
 
+        if self.only_correct_gene_fractions:  # the rest needs the inferred naive sequence
+            return
+
         for column in self.hists:
             if '_vs_mute_freq' in column:  # fill these above
                 continue
@@ -176,8 +232,132 @@ class PerformancePlotter(object):
             self.hists[column].fill(guessval - trueval)
 
     # ----------------------------------------------------------------------------------------
-    def plot(self, plotdir):
-        utils.prep_dir(plotdir + '/plots', wildling=None, multilings=['*.csv', '*.svg', '*.root'])
+    def evaluate_batch(self, true_columns, inf_columns, padfos=None):
+        """
+        Vectorized version of evaluate() for many queries at once.
+        <true_columns> and <inf_columns> are dicts with a list of values for each column (gene calls, deletions, insertions, seq...), aligned so the ith entries are the same query (e.g. from utils.get_columns()).
+        Inferred columns that aren't there (e.g. mixcr doesn't give us deletions) are skipped.
+        """
+        true_views = utils.get_reco_views(self.germlines, true_columns)  # built once for the whole batch, and shared by everything below
+        overall_mute_freqs = utils.get_mutation_rates(self.germlines, true_columns, views=true_views)  # true value (NOTE <true_columns> needs the full simulation info, even if <inf_columns> only has gene calls)
+        n_queries = len(overall_mute_freqs)
+        if n_queries == 0:
+            return
+        inf_views, naive_seq_pairs = None, None
+        if not self.only_correct_gene_fractions:  # otherwise we only need the gene calls, and <inf_columns> may not have enough to build views
+            inf_views = utils.get_reco_views(self.germlines, inf_columns)
+            naive_seq_pairs = self.get_naive_seq_pairs(true_columns, inf_columns, true_views, inf_views, padfos=padfos)
+
+        for column in self.values:
+            if self.only_correct_gene_fractions and column not in bool_columns:
+                continue
+            if column in bool_columns:
+                right = utils.are_alleles_many(true_columns[column], inf_columns[column])
+                self.values[column]['right'] += int(right.sum())
+                self.values[column]['wrong'] += int((~right).sum())
+                self.hists[column + '_right_vs_mute_freq'].fill_many(overall_mute_freqs[right])
+                self.hists[column + '_wrong_vs_mute_freq'].fill_many(overall_mute_freqs[~right])
+            else:
+                if column[2:] == '_insertion':  # insertion length
+                    truevals = numpy.array([len(insertion) for insertion in true_columns[column]], dtype=int)
+                    guessvals = numpy.array([len(insertion) for insertion in inf_columns[column]], dtype=int)
+                elif 'hamming_to_true_naive' in column:
+                    truevals = numpy.zeros(n_queries, dtype=int)
+                    restrict_to_region = column[0].replace('h', '')  # if fist char in <column> is not an 'h', restrict to that region
+                    guessvals = self.hamming_distances_to_true_naive(true_columns, inf_columns, restrict_to_region=restrict_to_region, normalize='_norm' in column, true_views=true_views, naive_seq_pairs=naive_seq_pairs)
+                elif column in inf_columns:
+                    truevals = numpy.array(true_columns[column], dtype=int)
+                    guessvals = numpy.array(inf_columns[column], dtype=int)
+                else:
+                    continue
+
+                diffs, counts = numpy.unique(guessvals - truevals, return_counts=True)
+                for diff, count in zip(diffs, counts):
+                    diff = int(diff)
+                    if diff not in self.values[column]:
+                        self.values[column][diff] = 0
+                    self.values[column][diff] += int(count)
+
+        if self.only_correct_gene_fractions:  # the rest needs the inferred naive sequence
+            return
+
+        for column in self.hists:
+            if '_vs_mute_freq' in column:  # fill these above
+                continue
+            if len(re.findall('[vdj]_', column)) == 1:
+                region = re.findall('[vdj]_', column)[0][0]
+            else:
+                region = ''
+            truevals = overall_mute_freqs if region == '' else utils.get_mutation_rates(self.germlines, true_columns, restrict_to_region=region, views=true_views)
+            guessvals = utils.get_mutation_rates(self.germlines, inf_columns, restrict_to_region=region, views=inf_views)
+            self.hists[column].fill_many(guessvals - truevals)
+
+    # ----------------------------------------------------------------------------------------
+    def get_state(self):
+        """ return the accumulated counts and hists as a dict of plain python types (e.g. to write to json) """
+        values = {}
+        for column in self.values:
+            values[column] = {}
+            for key, count in self.values[column].items():
+                values[column][str(key)] = count  # json only allows string keys
+        hists = {}
+        for name in self.hists:
+            hists[name] = self.hists[name].get_state()
+        return {'name' : self.name, 'only_correct_gene_fractions' : self.only_correct_gene_fractions, 'values' : values, 'hists' : hists}
+
+    # ----------------------------------------------------------------------------------------
+    def set_state(self, state):
+        """ replace the accumulated counts and hists with those in <state> (from get_state()) """
+        if state['only_correct_gene_fractions'] != self.only_correct_gene_fractions:
+            raise Exception('only_correct_gene_fractions in state (%s) doesn\'t match this plotter (%s)' % (state['only_correct_gene_fractions'], self.only_correct_gene_fractions))
+        self.values = {}
+        for column in state['values']:
+            self.values[column] = {}
+            for key, count in state['values'][column].items():
+                if column not in bool_columns:  # keys are 'right' and 'wrong' for bool columns, and integer differences for everybody else
+                    key = int(key)
+                self.values[column][key] = count
+        self.hists = {}
+        for name in state['hists']:
+            self.hists[name] = Hist(state=state['hists'][name])
+
+    # ----------------------------------------------------------------------------------------
+    def write_state(self, fname):
+        with open(fname, 'w') as outfile:
+            json.dump(self.get_state(), outfile)
+
+    # ----------------------------------------------------------------------------------------
+    def read_state(self, fname):
+        with open(fname) as infile:
+            self.set_state(json.load(infile))
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, other):
+        """ add the counts and hists from <other> (e.g. from scoring a different chunk of queries in another process) to ours """
+        if set(self.values) != set(other.values) or set(self.hists) != set(other.hists):
+            raise Exception('can\'t add performance plotters with different columns or hists')
+        for column in self.values:
+            for key, count in other.values[column].items():
+                if key not in self.values[column]:
+                    self.values[column][key] = 0
+                self.values[column][key] += count
+        for name in self.hists:
+            self.hists[name].add(other.hists[name])
+
+    # ----------------------------------------------------------------------------------------
+    def plot(self, plotdir, backend=None):
+        """
+        <backend> is either 'root', which draws each plot with root and then makes the html index, or 'csv', which just writes the csv files (plus a json summary of the gene call fractions) without drawing anything.
+        You can then draw the csvs later, if you need to look at them, with plotting.render_plots().
+        Default is root if we have it.
+        """
+        if backend is None:
+            backend = 'root' if plotting.has_root else 'csv'
+        if backend not in ('root', 'csv'):
+            raise Exception('unknown plotting backend %s (choose root or csv)' % backend)
+        utils.prep_dir(plotdir + '/plots', wildling=None, multilings=['*.csv', '*.svg', '*.png', '*.root', '*.json'])
+        log = ''
+        summary = {}
         for column in self.values:
             if self.only_correct_gene_fractions and column not in bool_columns:
                 continue
@@ -186,20 +366,35 @@ class PerformancePlotter(object):
                 wrong = self.values[column]['wrong']
                 errs = fraction_uncertainty.err(right, right+wrong)
                 print '  %s\n    correct up to allele: %4d / %-4d = %4.4f (-%.3f, +%.3f)' % (column, right, right+wrong, float(right) / (right + wrong), errs[0], errs[1])
-                hist = plotting.make_bool_hist(right, wrong, self.name + '-' + column)
-                plotting.draw(hist, 'bool', plotname=column, plotdir=plotdir, write_csv=True)
+                summary[column] = {'right' : right, 'wrong' : wrong, 'fraction' : float(right) / (right + wrong), 'lo_err' : errs[0], 'hi_err' : errs[1]}
+                if backend == 'root':
+                    hist = plotting.make_bool_hist(right, wrong, self.name + '-' + column)
+                    plotting.draw(hist, 'bool', plotname=column, plotdir=plotdir, write_csv=True)
+                else:
+                    plotting.write_my_hist_to_file(plotdir + '/plots/' + column + '.csv', plotting.make_bool_my_hist(right, wrong))
             else:
                 # TODO this is dumb... I should make the integer-valued ones histograms as well
-                hist = plotting.make_hist_from_dict_of_counts(self.values[column], 'int', self.name + '-' + column, normalize=True)
-                log = ''
-                if column.find('hamming_to_true_naive') >= 0:
-                    hist.GetXaxis().SetTitle('hamming distance')
+                xtitle = 'hamming distance' if column.find('hamming_to_true_naive') >= 0 else 'inferred - true'
+                if backend == 'root':
+                    hist = plotting.make_hist_from_dict_of_counts(self.values[column], 'int', self.name + '-' + column, normalize=True)
+                    hist.GetXaxis().SetTitle(xtitle)
+                    plotting.draw(hist, 'int', plotname=column, plotdir=plotdir, write_csv=True, log=log)
                 else:
-                    hist.GetXaxis().SetTitle('inferred - true')
-                plotting.draw(hist, 'int', plotname=column, plotdir=plotdir, write_csv=True, log=log)
+                    hist = plotting.make_my_hist_from_dict_of_counts(self.values[column], 'int', self.name + '-' + column, normalize=True)
+                    hist.xtitle = xtitle
+                    plotting.write_my_hist_to_file(plotdir + '/plots/' + column + '.csv', hist)
         for column in self.hists:
-            hist = plotting.make_hist_from_my_hist_class(self.hists[column], column)
-            plotting.draw(hist, 'float', plotname=column, plotdir=plotdir, write_csv=True, log=log)
-        
-        check_call(['./bin/makeHtml', plotdir, '3', 'null', 'svg'])
-        check_call(['./bin/permissify-www', plotdir])  # NOTE this should really permissify starting a few directories higher up
+            if self.only_correct_gene_fractions and '_vs_mute_freq' not in column:
+                continue
+            if backend == 'root':
+                hist = plotting.make_hist_from_my_hist_class(self.hists[column], column)
+                plotting.draw(hist, 'float', plotname=column, plotdir=plotdir, write_csv=True, log=log)
+            else:
+                plotting.write_my_hist_to_file(plotdir + '/plots/' + column + '.csv', self.hists[column])
+
+        if backend == 'root':
+            check_call(['./bin/makeHtml', plotdir, '3', 'null', 'svg'])
+            check_call(['./bin/permissify-www', plotdir])  # NOTE this should really permissify starting a few directories higher up
+        else:
+            with open(plotdir + '/plots/summary.json', 'w') as summaryfile:
+                json.dump(summary, summaryfile, indent=2, sort_keys=True)
@@ -0,0 +1,115 @@
+import os
+import csv
+import json
+import sqlite3
+import contextlib
+
+# ----------------------------------------------------------------------------------------
+class PersistentCache(object):
+    """
+    On-disk cache of bcrham results (naive seq, logprob, etc.) keyed by the colon-separated list of queries (unique_ids), shared between partitioning runs.
+    bcrham itself still reads and writes its usual csv cache file: before a run we write out the cached lines whose queries are all in the run with write_csv(), and afterwards add the new lines with add_csv().
+    Several processes can read and write at once -- sqlite does the locking (readers don't block in wal mode, and writers wait for each other inside sqlite, for up to <timeout> seconds).
+    Each write is one BEGIN IMMEDIATE transaction, so nobody else can write between our checks (e.g. is this line new?) and our inserts.
+    NOTE wal mode doesn't work on network file systems
+    """
+    def __init__(self, fname, timeout=600.):
+        self.fname = fname
+        if os.path.exists(fname) and os.stat(fname).st_size > 0:
+            with open(fname) as dbfile:
+                if dbfile.read(16) != 'SQLite format 3\x00':
+                    raise Exception('persistent cache file %s isn\'t an sqlite file (convert an old csv cache file with PersistentCache(<new fname>).add_csv(<old fname>))' % fname)
+        self.db = sqlite3.connect(fname, timeout=timeout, isolation_level=None)  # no implicit transactions: we open them ourselves with transaction()
+        self.db.text_factory = str  # give us back the same (byte) strings we put in
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.transaction():
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, val TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (unique_ids TEXT PRIMARY KEY, n_ids INTEGER, n_filled INTEGER, logprob TEXT, naive_seq TEXT, line TEXT)')  # <line> is the whole csv line, as a json list
+            self.db.execute('CREATE TABLE IF NOT EXISTS members (uid TEXT, unique_ids TEXT, UNIQUE(uid, unique_ids))')  # one row for each query in each cached line, so we can find the lines for a set of queries
+            if self.db.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('index', 'members_unique')).fetchone() is None:  # cache files from before we had the UNIQUE constraint can have duplicate rows, so remove them and add the constraint as an index
+                self.db.execute('DELETE FROM members WHERE rowid NOT IN (SELECT MIN(rowid) FROM members GROUP BY uid, unique_ids)')
+                self.db.execute('CREATE UNIQUE INDEX members_unique ON members (uid, unique_ids)')
+
+    # ----------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def transaction(self, mode='IMMEDIATE'):
+        """ IMMEDIATE takes the write lock when we begin (rather than at the first write), so nobody can write between our reads and our writes """
+        self.db.execute('BEGIN ' + mode)
+        try:
+            yield
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.db.close()
+
+    # ----------------------------------------------------------------------------------------
+    def get_header(self):
+        row = self.db.execute('SELECT val FROM meta WHERE key = ?', ('header', )).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # ----------------------------------------------------------------------------------------
+    def add_csv(self, fname):
+        """ add the lines in bcrham cache file <fname>, keeping, for each set of unique_ids, whichever line has more info (e.g. a logprob as well as a naive seq) """
+        if not os.path.exists(fname) or os.stat(fname).st_size == 0:
+            return 0
+        n_added = 0
+        with open(fname) as cachefile:
+            reader = csv.reader(cachefile)
+            header = reader.next()
+            with self.transaction():  # one transaction for the whole file
+                self.db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('header', json.dumps(header)))
+                old_header = self.get_header()
+                if header != old_header:
+                    raise Exception('header %s in %s doesn\'t match %s in persistent cache %s' % (','.join(header), fname, ','.join(old_header), self.fname))
+                ikey = header.index('unique_ids')
+                ilogprob = header.index('logprob') if 'logprob' in header else None
+                inaive = header.index('naive_seq') if 'naive_seq' in header else None
+                for line in reader:
+                    if len(line) == 0:
+                        continue
+                    unique_ids = line[ikey]
+                    n_filled = sum(val != '' for val in line)
+                    if self.db.execute('SELECT 1 FROM cache WHERE unique_ids = ? AND n_filled >= ?', (unique_ids, n_filled)).fetchone() is not None:
+                        continue  # already have it
+                    self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)', (unique_ids, len(unique_ids.split(':')), n_filled,
+                                                                                                   None if ilogprob is None else line[ilogprob], None if inaive is None else line[inaive], json.dumps(line)))
+                    self.db.executemany('INSERT OR IGNORE INTO members VALUES (?, ?)', [(uid, unique_ids) for uid in set(unique_ids.split(':'))])
+                    n_added += 1
+        return n_added
+
+    # ----------------------------------------------------------------------------------------
+    def select_lines(self, queries, columns):
+        """ yield <columns> for each cached line all of whose unique_ids are in <queries> """
+        with self.transaction('DEFERRED'):  # the temp table is only visible to this connection, so this doesn't need the write lock
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (uid TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM wanted')
+            self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(q, ) for q in queries])
+        return self.db.execute('SELECT ' + ', '.join('cache.' + c for c in columns) + ' FROM members JOIN wanted ON members.uid = wanted.uid JOIN cache ON members.unique_ids = cache.unique_ids '
+                               'GROUP BY cache.unique_ids HAVING COUNT(DISTINCT members.uid) = cache.n_ids')
+
+    # ----------------------------------------------------------------------------------------
+    def write_csv(self, fname, queries):
+        """ write a bcrham cache file with the cached lines for <queries> (only writes the file if there are any) """
+        header = self.get_header()
+        if header is None:
+            return 0
+        lines = sorted(self.select_lines(queries, ['unique_ids', 'line']))  # sorted, so merge_files() has less to do
+        if len(lines) == 0:
+            return 0
+        with open(fname, 'w') as cachefile:
+            writer = csv.writer(cachefile, lineterminator='\n')
+            writer.writerow(header)
+            for _, line in lines:
+                writer.writerow(json.loads(line))
+        return len(lines)
+
+    # ----------------------------------------------------------------------------------------
+    def get_naive_seqs(self, queries):
+        """ return a dict of the non-empty cached naive seqs for <queries> (each of which is a colon-separated list of unique ids) """
+        queries = set(queries)
+        uids = set(uid for query in queries for uid in query.split(':'))
+        return {unique_ids : naive_seq for unique_ids, naive_seq in self.select_lines(uids, ['unique_ids', 'naive_seq']) if unique_ids in queries and naive_seq is not None and naive_seq != ''}
@@ -81,6 +81,28 @@ def write_hist_to_file(fname, hist):
                 'binlabel' : hist.GetXaxis().GetBinLabel(ibin)
             })
 
+# ----------------------------------------------------------------------------------------
+def write_my_hist_to_file(fname, myhist):
+    """ write <myhist> (from the Hist class) in the same format as write_hist_to_file(), without needing root """
+    errors = myhist.errors
+    with opener('w')(fname) as histfile:
+        writer = csv.DictWriter(histfile, ('bin_low_edge', 'contents', 'binerror', 'xtitle', 'binlabel'))
+        writer.writeheader()
+        for ibin in range(myhist.n_bins + 2):
+            if myhist.sum_weights_squared is not None:
+                binerror = math.sqrt(myhist.sum_weights_squared[ibin])
+            elif errors is not None:
+                binerror = float(errors[ibin])
+            else:
+                binerror = 0.0
+            writer.writerow({
+                'bin_low_edge' : float(myhist.low_edges[ibin]),
+                'contents' : float(myhist.bin_contents[ibin]),
+                'binerror' : binerror,
+                'xtitle' : myhist.xtitle,
+                'binlabel' : myhist.bin_labels[ibin]
+            })
+
 # ----------------------------------------------------------------------------------------
 def make_hist_from_bin_entry_file(fname, hist_label='', log=''):
     hist = Hist(fname=fname)
@@ -98,8 +120,8 @@ def make_hist_from_bin_entry_file(fname, hist_label='', log=''):
     return roothist
     
 # ----------------------------------------------------------------------------------------
-def make_bool_hist(n_true, n_false, hist_label):
-    """ fill a two-bin histogram with the fraction false in the first bin and the fraction true in the second """
+def make_bool_my_hist(n_true, n_false):
+    """ fill a two-bin Hist with the fraction true in the first bin and the fraction false in the second """
     hist = Hist(2, -0.5, 1.5)
 
     def set_bin(numer, denom, ibin, label):
@@ -110,7 +132,12 @@ def make_bool_hist(n_true, n_false, hist_label):
 
     set_bin(n_true, n_true + n_false, 1, 'right')
     set_bin(n_false, n_true + n_false, 2, 'wrong')
+    return hist
 
+# ----------------------------------------------------------------------------------------
+def make_bool_hist(n_true, n_false, hist_label):
+    """ root version of make_bool_my_hist() """
+    hist = make_bool_my_hist(n_true, n_false)
     roothist = make_hist_from_my_hist_class(hist, hist_label)
     roothist.GetXaxis().SetNdivisions(0)
     roothist.GetXaxis().SetLabelSize(0.1)
@@ -119,13 +146,13 @@ def make_bool_hist(n_true, n_false, hist_label):
 
 # ----------------------------------------------------------------------------------------
 # <values> is of form {<bin 1>:<counts 1>, <bin 2>:<counts 2>, ...}
-def make_hist_from_dict_of_counts(values, var_type, hist_label, log='', xmin_force=0.0, xmax_force=0.0, normalize=False, sort=False):
-    """ Fill a histogram with values from a dictionary (each key will correspond to one bin) """
+def make_my_hist_from_dict_of_counts(values, var_type, hist_label, log='', xmin_force=0.0, xmax_force=0.0, normalize=False, sort=False):
+    """ Fill a Hist with values from a dictionary (each key will correspond to one bin) """
     assert var_type == 'int' or var_type == 'string'  # floats should be handled by Hist class in hist.py
 
     if len(values) == 0:
         print 'WARNING no values for %s in make_hist' % hist_label
-        return TH1D(hist_label, '', 1, 0, 1)
+        return Hist(1, 0, 1)
 
     bin_labels = sorted(values)
     if not sort and var_type == 'string':  # for strings, sort so most common value is to left side
@@ -167,7 +194,15 @@ def make_hist_from_dict_of_counts(values, var_type, hist_label, log='', xmin_for
         hist.ytitle = 'freq'
     else:
         hist.ytitle = 'counts'
-    
+    return hist
+
+# ----------------------------------------------------------------------------------------
+def make_hist_from_dict_of_counts(values, var_type, hist_label, log='', xmin_force=0.0, xmax_force=0.0, normalize=False, sort=False):
+    """ root version of make_my_hist_from_dict_of_counts() """
+    if len(values) == 0:
+        print 'WARNING no values for %s in make_hist' % hist_label
+        return TH1D(hist_label, '', 1, 0, 1)
+    hist = make_my_hist_from_dict_of_counts(values, var_type, hist_label, log=log, xmin_force=xmin_force, xmax_force=xmax_force, normalize=normalize, sort=sort)
     roothist = make_hist_from_my_hist_class(hist, hist_label)
     return roothist
 
@@ -493,6 +528,33 @@ def draw(hist, var_type, log='', plotdir=None, plotname='foop', more_hists=None,
             write_hist_to_file(csv_fname, hist)
     cvn.SaveAs(plotdir + '/plots/' + plotname + '.' + imagetype)
 
+# ----------------------------------------------------------------------------------------
+def render_plots(plotdir, imagetype='svg', names=None, force=False):
+    """
+    Draw (with matplotlib) the hist csv files in <plotdir>/plots that were written without drawing anything (e.g. by PerformancePlotter.plot() with the csv backend).
+    Only draws <names> (default all of them), and skips any whose image is already newer than the csv (unless <force>).
+    """
+    for fname in sorted(glob.glob(plotdir + '/plots/*.csv')):
+        plotname = os.path.basename(fname).replace('.csv', '')
+        if names is not None and plotname not in names:
+            continue
+        imagefname = plotdir + '/plots/' + plotname + '.' + imagetype
+        if not force and os.path.exists(imagefname) and os.path.getmtime(imagefname) >= os.path.getmtime(fname):
+            continue
+        hist = Hist(fname=fname)
+        centers = hist.get_bin_centers()[1 : hist.n_bins + 1]  # NOTE ignoring under/overflows
+        contents = hist.bin_contents[1 : hist.n_bins + 1]
+        errors = None if hist.errors is None else hist.errors[1 : hist.n_bins + 1]
+        fig, ax = plt.subplots()
+        ax.errorbar(centers, contents, yerr=errors, drawstyle='steps-mid', linewidth=2, color='#cc0000')
+        if len([label for label in hist.bin_labels if label != '']) > 0:
+            ax.set_xticks(centers)
+            ax.set_xticklabels(hist.bin_labels[1 : hist.n_bins + 1])
+        ax.set_title(plotname)
+        ax.set_xlabel(hist.xtitle)
+        plt.savefig(imagefname)
+        plt.close(fig)
+
 # ----------------------------------------------------------------------------------------
 def get_hists_from_dir(dirname, histname, string_to_ignore=None):
     hists = {}
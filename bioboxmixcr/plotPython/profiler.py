@@ -0,0 +1,61 @@
+import time
+import csv
+import json
+import contextlib
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------------------
+class Profiler(object):
+    """
+    Named timing spans and counters for one run, so we can write a machine-readable profile instead of grepping the timing printouts.
+    Spans can be nested (e.g. 'merge' inside 'read_output'), so their totals overlap.
+    """
+    def __init__(self):
+        self.spans = OrderedDict()  # name : {'n' : number of times we were in the span, 'total' : total seconds, 'max' : longest single time}
+        self.counters = OrderedDict()
+
+    # ----------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def add_time(self, name, seconds):
+        if name not in self.spans:
+            self.spans[name] = {'n' : 0, 'total' : 0., 'max' : 0.}
+        self.spans[name]['n'] += 1
+        self.spans[name]['total'] += seconds
+        self.spans[name]['max'] = max(seconds, self.spans[name]['max'])
+
+    # ----------------------------------------------------------------------------------------
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # ----------------------------------------------------------------------------------------
+    def write(self, fname, extra_info=None):
+        """ write to <fname> as json, or as csv if it ends in .csv (in which case <extra_info> is ignored) """
+        if fname.endswith('.csv'):
+            with open(fname, 'w') as outfile:
+                writer = csv.DictWriter(outfile, ('kind', 'name', 'n', 'total', 'max'))
+                writer.writeheader()
+                for name, info in self.spans.items():
+                    writer.writerow({'kind' : 'span', 'name' : name, 'n' : info['n'], 'total' : '%.6f' % info['total'], 'max' : '%.6f' % info['max']})
+                for name, val in self.counters.items():
+                    writer.writerow({'kind' : 'counter', 'name' : name, 'n' : val})
+        else:
+            profile = OrderedDict([('spans', self.spans), ('counters', self.counters)])
+            if extra_info is not None:
+                profile.update(extra_info)
+            with open(fname, 'w') as outfile:
+                json.dump(profile, outfile, indent=2)
+
+    # ----------------------------------------------------------------------------------------
+    def print_summary(self):
+        for name, info in self.spans.items():
+            print '    %-25s %5d  %9.3f  (max %.3f)' % (name, info['n'], info['total'], info['max'])
+        for name, val in self.counters.items():
+            print '    %-25s %5d' % (name, val)
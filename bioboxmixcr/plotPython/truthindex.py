@@ -0,0 +1,54 @@
+import numpy
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------------------
+class TruthIndex(object):
+    """
+    The true (simulated) clusters in <reco_info>, worked out once so the things that score inferred partitions against them don't each have to redo it.
+    Each reco_id gets an integer label (in the order we first see them), so you can also get labels for a bunch of uids as a numpy array.
+    """
+    def __init__(self, reco_info):
+        self.reco_info = reco_info
+        self.partition = OrderedDict()  # reco_id : list of uids, i.e. the same thing as utils.get_true_partition()
+        for key in reco_info:
+            reco_id = reco_info[key]['reco_id']
+            if reco_id not in self.partition:
+                self.partition[reco_id] = []
+            self.partition[reco_id].append(reco_info[key]['unique_id'])
+        self.reco_ids = self.partition.keys()  # label : reco_id
+        self.label_of_reco_id = {reco_id : label for label, reco_id in enumerate(self.reco_ids)}
+        self.labels = {uid : self.label_of_reco_id[reco_info[uid]['reco_id']] for uid in reco_info}  # uid : label
+
+    # ----------------------------------------------------------------------------------------
+    def get_labels(self, uids):
+        return numpy.fromiter((self.labels[uid] for uid in uids), dtype=int, count=len(uids))
+
+    # ----------------------------------------------------------------------------------------
+    def same_event(self, uid_a, uid_b):
+        return self.labels[uid_a] == self.labels[uid_b]
+
+    # ----------------------------------------------------------------------------------------
+    def from_same_event(self, uids):
+        """ same as utils.from_same_event() for simulation """
+        if len(uids) < 2:
+            return True
+        label = self.labels[uids[0]]
+        return all(self.labels[uid] == label for uid in uids[1:])
+
+    # ----------------------------------------------------------------------------------------
+    def is_true_cluster(self, uids):
+        """ are <uids> all from the same event, and are they the entire true cluster for that event? """
+        if len(uids) == 0 or not self.from_same_event(uids):
+            return False
+        return len(set(uids)) == len(self.partition[self.reco_ids[self.labels[uids[0]]]])
+
+    # ----------------------------------------------------------------------------------------
+    def get_true_clusters(self, uids):
+        """ same as utils.get_true_clusters(): dict from reco_id to the <uids> that come from it """
+        clusters = OrderedDict()
+        for uid in uids:
+            reco_id = self.reco_ids[self.labels[uid]]
+            if reco_id not in clusters:
+                clusters[reco_id] = []
+            clusters[reco_id].append(uid)
+        return clusters
@@ -8,11 +8,15 @@ import ast
 import re
 import math
 import glob
+import threading
+import Queue
+from subprocess import Popen, PIPE
 from collections import OrderedDict
 import csv
-from sklearn.metrics.cluster import adjusted_mutual_info_score
+import numpy
 
 from opener import opener
+from mutualinfo import AdjMIScorer
 
 from Bio import SeqIO
 
@@ -410,7 +414,8 @@ def get_reco_event_seqs(germlines, line, original_seqs, lengths, eroded_seqs):
     get original and eroded germline seqs
     NOTE does not modify line
     """
-    print 'GET RECO EVENTS'
+    if not quiet_reco_events:
+        print 'GET RECO EVENTS'
     for region in regions:
 	#print 'REGION: ', region
         #print "LINE INSIDE FOR LOOP: ", line[region + '_gene']
@@ -491,63 +496,94 @@ def add_cdr3_info(germlines, cyst_positions, tryp_positions, line, debug=False):
         if debug:
             print '    bad codon[s] (%s %s) in %s' % ('cyst' if not cyst_ok else '', 'tryp' if not tryp_ok else '', ':'.join(line['unique_ids']) if 'unique_ids' in line else line)
 
+# ----------------------------------------------------------------------------------------
+class RecoView(object):
+    """
+    Everything we derive from the germline matches in <line> -- original and eroded germline seqs, naive seq, and regional bounds -- calculated once.
+    NOTE doesn't hold on to <line>, so use get_reco_view(), which notices if the relevant columns in <line> change
+    """
+    def __init__(self, germlines, line):
+        self.original_seqs = {}  # original (non-eroded) germline seqs
+        self.lengths = {}  # length of each match (including erosion)
+        self.eroded_seqs = {}  # eroded germline seqs
+        get_reco_event_seqs(germlines, line, self.original_seqs, self.lengths, self.eroded_seqs)
+        self.insertions = {}
+        for boundary in ['fv', ] + boundaries + ['jf', ]:
+            self.insertions[boundary] = line[boundary + '_insertion']
+        self.v_5p_del = int(line['v_5p_del'])
+        self.seq_len = len(line['seq']) if 'seq' in line else None
+        self.unique_id = line.get('unique_id')
+        self.naive_seq = self.insertions['fv'] + self.eroded_seqs['v'] + self.insertions['vd'] + self.eroded_seqs['d'] + self.insertions['dj'] + self.eroded_seqs['j'] + self.insertions['jf']
+        self.bounds = {}  # (start, end) for each region, keyed by <subtract_unphysical_erosions>
+
+    # ----------------------------------------------------------------------------------------
+    def get_bounds(self, subtract_unphysical_erosions=True):
+        if subtract_unphysical_erosions in self.bounds:
+            return self.bounds[subtract_unphysical_erosions]
+
+        start, end = {}, {}
+        start['v'] = self.v_5p_del
+        end['v'] = start['v'] + len(self.insertions['fv'] + self.eroded_seqs['v'])  # base just after the end of v
+        start['d'] = end['v'] + len(self.insertions['vd'])
+        end['d'] = start['d'] + len(self.eroded_seqs['d'])
+        start['j'] = end['d'] + len(self.insertions['dj'])
+        end['j'] = start['j'] + len(self.eroded_seqs['j'] + self.insertions['jf'])
+
+        if subtract_unphysical_erosions:
+            for tmpreg in regions:
+                start[tmpreg] -= self.v_5p_del
+                end[tmpreg] -= self.v_5p_del
+            # end['j'] -= line['j_3p_del']  # ARG.ARG.ARG
+
+        for chkreg in regions:
+            assert start[chkreg] >= 0
+            assert end[chkreg] >= 0
+            assert end[chkreg] >= start[chkreg]
+        if end['j'] != self.seq_len:
+            raise Exception('end of j %d not equal to sequence length %d in %s' % (end['j'], self.seq_len, self.unique_id))
+
+        self.bounds[subtract_unphysical_erosions] = {}
+        for region in regions:
+            self.bounds[subtract_unphysical_erosions][region] = (start[region], end[region])
+        return self.bounds[subtract_unphysical_erosions]
+
+# ----------------------------------------------------------------------------------------
+quiet_reco_events = False  # if set, don't print anything on every call to get_reco_event_seqs(), get_full_naive_seq(), and get_regional_naive_seq_bounds()
+reco_event_columns = [region + '_gene' for region in regions] + [erosion + '_del' for erosion in real_erosions + effective_erosions] + [boundary + '_insertion' for boundary in ['fv', ] + boundaries + ['jf', ]] + ['seq', ]
+max_reco_views = 10000  # if we get more than this many, throw them all out and start over (we usually only need the few views for the query we're currently looking at)
+reco_views = {}
+
+# ----------------------------------------------------------------------------------------
+def get_reco_view(germlines, line):
+    """ return the (cached) RecoView for <line> """
+    key = (id(germlines), line.get('unique_id')) + tuple([line.get(column) for column in reco_event_columns])  # NOTE <line> may not have a 'seq' yet
+    if key not in reco_views:
+        if len(reco_views) >= max_reco_views:
+            reco_views.clear()
+        reco_views[key] = RecoView(germlines, line)
+    return reco_views[key]
+
 # ----------------------------------------------------------------------------------------
 def get_full_naive_seq(germlines, line):  #, restrict_to_region=''):
-    print '\nGET FULL NAIVE SEQ', line, '\n'
-    #print 'FV INSERTION', line['fv_insertion']
+    if not quiet_reco_events:
+        print '\nGET FULL NAIVE SEQ', line, '\n'
     for erosion in real_erosions + effective_erosions:
-	#print 'FINAL CHECKS'
         if line[erosion + '_del'] < 0:
-	    print 'FINAL TRUES'
             print 'ERROR %s less than zero %d' % (erosion, line[erosion + '_del'])
         assert line[erosion + '_del'] >= 0
-    original_seqs = {}  # original (non-eroded) germline seqs
-    lengths = {}  # length of each match (including erosion)
-    eroded_seqs = {}  # eroded germline seqs
-    get_reco_event_seqs(germlines, line, original_seqs, lengths, eroded_seqs)
-    # if restrict_to_region == '':
-    print 'FV insertion: ', line['fv_insertion'], 'eroded seqs v: ', eroded_seqs['v'], 'vd insertion: ', line['vd_insertion'], 'eroded seqs d: ', eroded_seqs['d'], 'dj insertion: ',line['dj_insertion'], 'eroded seqs j: ', eroded_seqs['j'], 'jf insertion: ', line['jf_insertion'], '\n' 
-    #print 'ERODED SEQS: ', eroded_seqs
-    return line['fv_insertion'] + eroded_seqs['v'] + line['vd_insertion'] + eroded_seqs['d'] + line['dj_insertion'] + eroded_seqs['j'] + line['jf_insertion']
-    # else:
-    # return eroded_seqs[restrict_to_region]
+    view = get_reco_view(germlines, line)
+    if not quiet_reco_events:
+        print 'FV insertion: ', line['fv_insertion'], 'eroded seqs v: ', view.eroded_seqs['v'], 'vd insertion: ', line['vd_insertion'], 'eroded seqs d: ', view.eroded_seqs['d'], 'dj insertion: ',line['dj_insertion'], 'eroded seqs j: ', view.eroded_seqs['j'], 'jf insertion: ', line['jf_insertion'], '\n'
+    return view.naive_seq
 
 # ----------------------------------------------------------------------------------------
 def get_regional_naive_seq_bounds(return_reg, germlines, line, subtract_unphysical_erosions=True):
     # NOTE it's kind of a matter of taste whether unphysical deletions (v left and j right) should be included in the 'naive sequence'.
     # Unless <subtract_unphysical_erosions>, here we assume the naive sequence has *no* unphysical deletions
-
-    original_seqs = {}  # original (non-eroded) germline seqs
-    lengths = {}  # length of each match (including erosion)
-    eroded_seqs = {}  # eroded germline seqs
-    get_reco_event_seqs(germlines, line, original_seqs, lengths, eroded_seqs)
-
-    start, end = {}, {}
-    start['v'] = int(line['v_5p_del'])
-    end['v'] = start['v'] + len(line['fv_insertion'] + eroded_seqs['v'])  # base just after the end of v
-    start['d'] = end['v'] + len(line['vd_insertion'])
-    end['d'] = start['d'] + len(eroded_seqs['d'])
-    start['j'] = end['d'] + len(line['dj_insertion'])
-    end['j'] = start['j'] + len(eroded_seqs['j'] + line['jf_insertion'])
-
-    if subtract_unphysical_erosions:
-        for tmpreg in regions:
-            start[tmpreg] -= int(line['v_5p_del'])
-            end[tmpreg] -= int(line['v_5p_del'])
-        # end['j'] -= line['j_3p_del']  # ARG.ARG.ARG
-
-    #for key, val in line.items():
-     #   print key, val
-    for chkreg in regions:
-     #   print chkreg, start[chkreg], end[chkreg]
-        assert start[chkreg] >= 0
-        assert end[chkreg] >= 0
-        assert end[chkreg] >= start[chkreg]
-    #print end['j'], len(line['seq']), line['v_5p_del'], line['j_3p_del']
-    if end['j'] != len(line['seq']):
-        raise Exception('end of j %d not equal to sequence length %d in %s' % (end['j'], len(line['seq']), line['unique_id']))
-    print 'INSIDE OF RESTRICT TO REGION: ', start[return_reg], end[return_reg]
-    return (start[return_reg], end[return_reg])
+    bounds = get_reco_view(germlines, line).get_bounds(subtract_unphysical_erosions)[return_reg]
+    if not quiet_reco_events:
+        print 'INSIDE OF RESTRICT TO REGION: ', bounds[0], bounds[1]
+    return bounds
 
 # ----------------------------------------------------------------------------------------
 def add_match_info(germlines, line, cyst_positions, tryp_positions, debug=False):
@@ -907,6 +943,17 @@ def are_alleles(gene1, gene2):
     right_str_2 = gene2[gene1.find('*')+3 :]
     return left_str_1 == left_str_2 and right_str_1 == right_str_2
 
+# ----------------------------------------------------------------------------------------
+def are_alleles_many(genes, other_genes):
+    """ batch version of are_alleles(): return a bool array that's True where the ith of <genes> and <other_genes> are alleles of each other """
+    are_alleles_cache = {}  # there's only a few hundred genes, so we only need to call are_alleles() once for each distinct pair
+    results = []
+    for pair in zip(genes, other_genes):
+        if pair not in are_alleles_cache:
+            are_alleles_cache[pair] = are_alleles(pair[0], pair[1])
+        results.append(are_alleles_cache[pair])
+    return numpy.array(results, dtype=bool)
+
 # ----------------------------------------------------------------------------------------
 def are_same_primary_version(gene1, gene2):
     """
@@ -1067,6 +1114,122 @@ def hamming_fraction(seq1, seq2, return_len_excluding_ambig=False):
     else:
         return  fraction
 
+# ----------------------------------------------------------------------------------------
+# lookup tables (indexed by ascii code) used to vectorize hamming_fraction() over many sequences at once
+hamming_alphabet_table = numpy.zeros(256, dtype=bool)
+hamming_alphabet_table[[ord(ch) for ch in nukes + ambiguous_bases]] = True
+ambiguous_base_table = numpy.zeros(256, dtype=bool)
+ambiguous_base_table[[ord(ch) for ch in ambiguous_bases]] = True
+
+# ----------------------------------------------------------------------------------------
+def encode_seqs(seqs):
+    """
+    Encode <seqs> (which must all be the same length) as a 2d uint8 array with one row per sequence.
+    Returns the array and a boolean mask of the same shape which is True at ambiguous bases.
+    Pass the returned tuple to hamming_fractions() or hamming_fraction_matrix() in place of a list of strings to avoid re-encoding.
+    """
+    seqs = list(seqs)
+    seq_len = len(seqs[0]) if len(seqs) > 0 else 0
+    for seq in seqs:
+        if len(seq) != seq_len:
+            raise Exception('sequences of different lengths (%d and %d) passed to encode_seqs()' % (seq_len, len(seq)))
+    codes = numpy.frombuffer(''.join(seqs), dtype=numpy.uint8).reshape(len(seqs), seq_len)
+    bad_chars = ~hamming_alphabet_table[codes]
+    if bad_chars.any():
+        iseq, ipos = [int(i[0]) for i in numpy.nonzero(bad_chars)]
+        raise Exception('unexpected character (%s) not among %s in hamming_fraction()' % (seqs[iseq][ipos], nukes + ambiguous_bases))
+    return codes, ambiguous_base_table[codes]
+
+# ----------------------------------------------------------------------------------------
+def get_encoded_seqs(seqs):
+    """ return <seqs> as (codes, ambiguous mask), encoding them if they aren't already """
+    if isinstance(seqs, tuple) and len(seqs) == 2 and isinstance(seqs[0], numpy.ndarray):
+        return seqs
+    return encode_seqs(seqs)
+
+# ----------------------------------------------------------------------------------------
+def hamming_fractions(seq, seqs, return_len_excluding_ambig=False):
+    """
+    One-to-many version of hamming_fraction(): return an array with the fractional hamming distance between <seq> and each of <seqs>.
+    <seqs> is either a list of strings or the output of encode_seqs() (and likewise <seq> may be a string or a single encoded row). Ambiguous bases are excluded in the same way as in hamming_fraction().
+    """
+    codes, ambig = get_encoded_seqs(seqs)
+    seq_codes, seq_ambig = get_encoded_seqs(seq if isinstance(seq, tuple) else [seq, ])
+    assert seq_codes.shape[1] == codes.shape[1]
+    excluded = ambig | seq_ambig  # broadcasts <seq> against every row
+    len_excluding_ambig = codes.shape[1] - excluded.sum(axis=1)
+    distances = ((codes != seq_codes) & ~excluded).sum(axis=1)
+    fractions = numpy.zeros(len(codes))
+    nonzero = len_excluding_ambig > 0
+    fractions[nonzero] = distances[nonzero] / len_excluding_ambig[nonzero].astype(float)
+    if return_len_excluding_ambig:
+        return fractions, len_excluding_ambig
+    else:
+        return fractions
+
+# ----------------------------------------------------------------------------------------
+def hamming_fraction_matrix(seqs, other_seqs=None):
+    """
+    Many-to-many version of hamming_fraction(): return a 2d array whose [i, j]th entry is the fractional hamming distance between the ith of <seqs> and the jth of <other_seqs>.
+    If <other_seqs> isn't specified, return the (symmetric) matrix of distances among <seqs>, only calculating each pair once.
+    """
+    codes, ambig = get_encoded_seqs(seqs)
+    if other_seqs is None:
+        matrix = numpy.zeros((len(codes), len(codes)))
+        for iseq in range(len(codes) - 1):
+            row = hamming_fractions((codes[iseq : iseq + 1], ambig[iseq : iseq + 1]), (codes[iseq + 1 :], ambig[iseq + 1 :]))
+            matrix[iseq, iseq + 1 :] = row
+            matrix[iseq + 1 :, iseq] = row
+    else:
+        other_codes, other_ambig = get_encoded_seqs(other_seqs)
+        matrix = numpy.zeros((len(codes), len(other_codes)))
+        for iseq in range(len(codes)):
+            matrix[iseq, :] = hamming_fractions((codes[iseq : iseq + 1], ambig[iseq : iseq + 1]), (other_codes, other_ambig))
+    return matrix
+
+# ----------------------------------------------------------------------------------------
+def get_condensed_hamming_fractions(seqs):
+    """
+    Return the fractional hamming distances among <seqs> as a condensed (upper triangle) 1d array, i.e. in the order of itertools.combinations(seqs, 2) (and of scipy's squareform()).
+    Uses half the memory of hamming_fraction_matrix().
+    """
+    codes, ambig = get_encoded_seqs(seqs)
+    rows = [hamming_fractions((codes[iseq : iseq + 1], ambig[iseq : iseq + 1]), (codes[iseq + 1 :], ambig[iseq + 1 :])) for iseq in range(len(codes) - 1)]
+    if len(rows) == 0:
+        return numpy.zeros(0)
+    return numpy.concatenate(rows)
+
+# ----------------------------------------------------------------------------------------
+def paired_hamming_fractions(seqs, other_seqs, return_len_excluding_ambig=False):
+    """
+    Pairwise version of hamming_fraction(): return an array with the fractional hamming distance between the ith of <seqs> and the ith of <other_seqs>.
+    Each pair has to be the same length, but (unlike for hamming_fractions()) different pairs needn't be.
+    """
+    seqs, other_seqs = list(seqs), list(other_seqs)
+    assert len(seqs) == len(other_seqs)
+    lengths = numpy.array([len(seq) for seq in seqs], dtype=int)
+    other_lengths = numpy.array([len(seq) for seq in other_seqs], dtype=int)
+    if (lengths != other_lengths).any():
+        iseq = int(numpy.nonzero(lengths != other_lengths)[0][0])
+        raise Exception('sequences of different lengths (%d and %d) passed to paired_hamming_fractions()' % (lengths[iseq], other_lengths[iseq]))
+    codes = numpy.frombuffer(''.join(seqs), dtype=numpy.uint8)  # all the sequences mashed together, since the pairs have different lengths
+    other_codes = numpy.frombuffer(''.join(other_seqs), dtype=numpy.uint8)
+    bad_chars = ~hamming_alphabet_table[codes] | ~hamming_alphabet_table[other_codes]
+    if bad_chars.any():
+        ipos = int(numpy.nonzero(bad_chars)[0][0])
+        raise Exception('unexpected character (%s or %s) not among %s in hamming_fraction()' % (chr(codes[ipos]), chr(other_codes[ipos]), nukes + ambiguous_bases))
+    excluded = ambiguous_base_table[codes] | ambiguous_base_table[other_codes]
+    iseqs = numpy.repeat(numpy.arange(len(seqs)), lengths)  # index of the pair to which each position belongs
+    distances = numpy.bincount(iseqs, weights=((codes != other_codes) & ~excluded).astype(float), minlength=len(seqs))
+    len_excluding_ambig = lengths - numpy.bincount(iseqs, weights=excluded.astype(float), minlength=len(seqs)).astype(int)
+    fractions = numpy.zeros(len(seqs))
+    nonzero = len_excluding_ambig > 0
+    fractions[nonzero] = distances[nonzero] / len_excluding_ambig[nonzero].astype(float)
+    if return_len_excluding_ambig:
+        return fractions, len_excluding_ambig
+    else:
+        return fractions
+
 # ----------------------------------------------------------------------------------------
 def get_key(names):
     """
@@ -1160,25 +1323,67 @@ def merge_csvs(outfname, csv_list, cleanup=True):
 
 # ----------------------------------------------------------------------------------------
 def get_mutation_rate(germlines, line, restrict_to_region=''):
-    naive_seq = get_full_naive_seq(germlines, line)  # NOTE this includes the fv and jf insertions
+    view = get_reco_view(germlines, line)
+    naive_seq = view.naive_seq  # NOTE this includes the fv and jf insertions
     muted_seq = line['seq']
+    bounds = view.get_bounds(subtract_unphysical_erosions=True)
     if restrict_to_region == '':  # NOTE this is very similar to code in performanceplotter. I should eventually cut it out of there and combine them, but I'm nervous a.t.m. because of all the complications there of having the true *and* inferred sequences so I'm punting
         mashed_naive_seq = ''
         mashed_muted_seq = ''
         for region in regions:  # can't use the full sequence because we have no idea what the mutations were in the inserts. So have to mash together the three regions
-            bounds = get_regional_naive_seq_bounds(region, germlines, line, subtract_unphysical_erosions=True)
-            mashed_naive_seq += naive_seq[bounds[0] : bounds[1]]
-            mashed_muted_seq += muted_seq[bounds[0] : bounds[1]]
+            mashed_naive_seq += naive_seq[bounds[region][0] : bounds[region][1]]
+            mashed_muted_seq += muted_seq[bounds[region][0] : bounds[region][1]]
     else:
-        bounds = get_regional_naive_seq_bounds(restrict_to_region, germlines, line, subtract_unphysical_erosions=True)
-        naive_seq = naive_seq[bounds[0] : bounds[1]]
-        muted_seq = muted_seq[bounds[0] : bounds[1]]
+        naive_seq = naive_seq[bounds[restrict_to_region][0] : bounds[restrict_to_region][1]]
+        muted_seq = muted_seq[bounds[restrict_to_region][0] : bounds[restrict_to_region][1]]
 
 
     # print 'restrict %s' % restrict_to_region
     # color_mutants(naive_seq, muted_seq, print_result=True, extra_str='  ')
     return hamming_fraction(naive_seq, muted_seq)
 
+# ----------------------------------------------------------------------------------------
+def get_columns(lines, columns=None):
+    """ convert a list of <lines> to a dict of columns, i.e. with a list of values (one for each line) for each of <columns> (default: the columns in the first line) """
+    if columns is None:
+        columns = lines[0].keys() if len(lines) > 0 else []
+    coldict = {}
+    for column in columns:
+        coldict[column] = [line[column] for line in lines]
+    return coldict
+
+# ----------------------------------------------------------------------------------------
+def get_reco_views(germlines, columns):
+    """ uncached RecoView for each line in <columns> (a dict with a list of values for each column, e.g. from get_columns()), so a batch can build its views once and share them """
+    view_columns = [column for column in reco_event_columns + ['unique_id', ] if column in columns]
+    views = []
+    for iline in range(len(columns['seq'])):
+        line = {}
+        for column in view_columns:
+            line[column] = columns[column][iline]
+        views.append(RecoView(germlines, line))
+    return views
+
+# ----------------------------------------------------------------------------------------
+def get_mutation_rates(germlines, columns, restrict_to_region='', views=None):
+    """
+    Batch version of get_mutation_rate(), where <columns> is a dict with a list of values for each column (e.g. from get_columns()).
+    Pass in <views> from get_reco_views() if you've already got them, since building them is most of the work.
+    Returns an array with one mutation rate for each line.
+    """
+    if views is None:
+        views = get_reco_views(germlines, columns)
+    naive_seqs, muted_seqs = [], []
+    for view, muted_seq in zip(views, columns['seq']):
+        naive_seq = view.naive_seq
+        bounds = view.get_bounds(subtract_unphysical_erosions=True)  # NOTE also checks that the regions add up to the sequence length
+        if restrict_to_region != '':  # NOTE same as in get_mutation_rate(), we use the full sequence if we're not restricting to a region
+            naive_seq = naive_seq[bounds[restrict_to_region][0] : bounds[restrict_to_region][1]]
+            muted_seq = muted_seq[bounds[restrict_to_region][0] : bounds[restrict_to_region][1]]
+        naive_seqs.append(naive_seq)
+        muted_seqs.append(muted_seq)
+    return paired_hamming_fractions(naive_seqs, muted_seqs)
+
 # ----------------------------------------------------------------------------------------
 def print_linsim_output(outstr):
     import ast
@@ -1212,6 +1417,27 @@ def process_out_err(out, err, extra_str='0'):
         print '      --> proc %s' % extra_str
         print print_str
 
+# ----------------------------------------------------------------------------------------
+def start_watched_proc(cmd_str, key, finished):
+    """ start <cmd_str>, and put (<key>, out, err) on the queue <finished> when it's done (from a thread, so we can wait on a bunch of procs at once, in whatever order they finish) """
+    proc = Popen(cmd_str.split(), stdout=PIPE, stderr=PIPE)
+    def wait_for_proc():
+        out, err = proc.communicate()  # have to read stdout/stderr as we go, or the proc can block on a full pipe
+        finished.put((key, out, err))
+    watcher = threading.Thread(target=wait_for_proc)
+    watcher.daemon = True
+    watcher.start()
+    return proc
+
+# ----------------------------------------------------------------------------------------
+def get_finished_proc(finished, poll_interval=1.):
+    """ wait for the next (key, out, err) on the queue <finished> from start_watched_proc(), polling every <poll_interval> seconds (python 2's Queue.get() ignores ctrl-c if it doesn't have a timeout) """
+    while True:
+        try:
+            return finished.get(timeout=poll_interval)
+        except Queue.Empty:
+            pass
+
 # ----------------------------------------------------------------------------------------
 def remove_ambiguous_ends(seq, fv_insertion, jf_insertion):
     """ remove ambiguous bases from the left and right ends of <seq> """
@@ -1235,14 +1461,9 @@ def get_true_clusters(ids, reco_info):
     clusters = {}
     for uid in ids:
         rid = reco_info[uid]['reco_id']
-        found = False
-        for clid in clusters:
-            if rid == clid:
-                clusters[clid].append(uid)
-                found = True
-                break
-        if not found:
-            clusters[rid] = [uid]
+        if rid not in clusters:
+            clusters[rid] = []
+        clusters[rid].append(uid)
     return clusters
 
 # ----------------------------------------------------------------------------------------
@@ -1272,15 +1493,13 @@ def get_str_from_partition(partition):
 
 # ----------------------------------------------------------------------------------------
 def mutual_information(partition, reco_info, debug=False):
-    true_cluster_list, inferred_cluster_list = [], []
-    for iclust in range(len(partition)):
-        for uid in partition[iclust]:
-            true_cluster_list.append(reco_info[uid]['reco_id'])
-            inferred_cluster_list.append(iclust)
-    adj_mi = adjusted_mutual_info_score(true_cluster_list, inferred_cluster_list)
+    """ adjusted mi between <partition> and the true clusters (if you've got a bunch of partitions that differ by merges, use ClusterPath.calculate_adj_mis() instead) """
+    scorer = AdjMIScorer(reco_info)
+    scorer.set_partition(partition)
+    adj_mi = scorer.get_adj_mi()
     if debug:
-        print '       true clusters %d' % len(set(true_cluster_list))
-        print '   inferred clusters %d' % len(set(inferred_cluster_list))
+        print '       true clusters %d' % scorer.n_true_clusters
+        print '   inferred clusters %d' % len(partition)
         print '         adjusted mi %.2f' % adj_mi
     return adj_mi
 
@@ -1,7 +1,5 @@
-import time
 import sys
 import json
-import math
 import re
 import csv
 import os
@@ -9,24 +7,73 @@ import itertools
 import operator
 import pysam
 import contextlib
-from subprocess import check_call, check_output, Popen, PIPE
+import Queue
+import heapq
+import collections
+from subprocess import check_call, check_output
 
 import utils
 from opener import opener
+from profiler import Profiler
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
 
+# ----------------------------------------------------------------------------------------
+class SamRead(object):
+    """ the bits of a pysam AlignedRead that Waterer.process_query() uses, for alignments that we read straight from sam text """
+    def __init__(self, line, tids):
+        fields = line.rstrip('\n').split('\t')
+        self.qname = fields[0]
+        self.flag = int(fields[1])
+        self.is_secondary = bool(self.flag & 0x100)
+        self.tid = tids.get(fields[2], -1)  # -1 for unmapped, like pysam
+        self.pos = int(fields[3]) - 1  # sam is 1-based
+        self.cigarstring = fields[5]
+        self.seq = None if fields[9] == '*' else fields[9]
+        self.tags = []
+        for tagstr in fields[11:]:
+            tag, tagtype, val = tagstr.split(':', 2)
+            self.tags.append((tag, int(val) if tagtype == 'i' else val))
+
+        # same conventions as pysam: qstart/qend are the bounds of the aligned part of the query (not counting hard clips), and aend is one past the last aligned reference base
+        cigar = [(int(length), op) for length, op in re.findall('([0-9]+)([MIDNSHP=X])', self.cigarstring)]
+        unclipped = [(length, op) for length, op in cigar if op != 'H']
+        qlen = sum(length for length, op in unclipped if op in 'MIS=X')
+        self.qstart = unclipped[0][0] if len(unclipped) > 0 and unclipped[0][1] == 'S' else 0
+        self.qend = qlen - (unclipped[-1][0] if len(unclipped) > 1 and unclipped[-1][1] == 'S' else 0)
+        self.aend = self.pos + sum(length for length, op in cigar if op in 'MDN=X')
+
+# ----------------------------------------------------------------------------------------
+def read_sam(samfile):
+    """ return the reference names and a list of the SamReads in open sam file <samfile> """
+    references, reads = [], []
+    tids = {}
+    for line in samfile:
+        if line.startswith('@'):
+            if line.startswith('@SQ'):
+                name = [field[3:] for field in line.rstrip('\n').split('\t') if field.startswith('SN:')][0]
+                tids[name] = len(references)
+                references.append(name)
+            continue
+        reads.append(SamRead(line, tids))
+    return references, reads
+
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
-    def __init__(self, args, input_info, reco_info, germline_seqs, parameter_dir, write_parameters=False):
+    def __init__(self, args, input_info, reco_info, germline_seqs, parameter_dir, write_parameters=False, profiler=None, in_process_max_queries=None):
         self.parameter_dir = parameter_dir
+        self.profiler = profiler if profiler is not None else Profiler()  # timing spans and counters (pass in the caller's profiler to get them in its profile)
         self.args = args
         self.debug = self.args.debug if self.args.sw_debug is None else self.args.sw_debug
 
         self.input_info = input_info
         self.remaining_queries = [query for query in self.input_info.keys()]  # we remove queries from this list when we're satisfied with the current output (in general we may have to rerun some queries with different match/mismatch scores)
         self.new_indels = 0  # number of new indels that were kicked up this time through
+        self.n_tries = {}  # number of times we've run each query through vdjalign (queries that needed rerunning are usually the slow ones)
+        self.chunks_per_proc = 4  # split the queries into about this many chunks for each proc, so procs that finish early can pick up more work
+        self.min_queries_per_chunk = 50  # ...but don't make chunks smaller than this (vdjalign has some startup time)
+        self.in_process_max_queries = in_process_max_queries  # if set, align passes with at most this many queries in this process, with vdjalign's python module (i.e. without the vdjalign/samtools procs or the bam files)
 
         self.reco_info = reco_info
         self.germline_seqs = germline_seqs
@@ -83,17 +130,27 @@ class Waterer(object):
         base_outfname = 'query-seqs.bam'
         sys.stdout.flush()
 
-        n_tries = 0
-        while len(self.remaining_queries) > 0:  # we remove queries from <self.remaining_queries> as we're satisfied with their output
-            self.write_vdjalign_input(base_infname, n_procs=self.args.n_fewer_procs)
-            self.execute_command(base_infname, base_outfname, self.args.n_fewer_procs)
-            self.read_output(base_outfname, n_procs=self.args.n_fewer_procs)
-            n_tries += 1
-            if n_tries > 2:
-                self.info['skipped_unknown_queries'] += self.remaining_queries
-                break
-
-        self.finalize()
+        with self.profiler.span('sw'):
+            self.profiler.count('sw.queries', len(self.remaining_queries))
+            n_tries = 0
+            while len(self.remaining_queries) > 0:  # we remove queries from <self.remaining_queries> as we're satisfied with their output
+                ig_align = self.get_in_process_aligner()
+                if ig_align is not None:
+                    with self.profiler.span('sw.in_process'):
+                        self.align_in_process(ig_align, base_infname)
+                else:
+                    with self.profiler.span('sw.write_input'):
+                        n_chunks = self.write_vdjalign_input(base_infname, n_procs=self.args.n_fewer_procs)
+                    with self.profiler.span('sw.execute'):  # includes sw.read_output, since we read each chunk's output while the others are running
+                        self.execute_commands(base_infname, base_outfname, n_chunks, n_procs=self.args.n_fewer_procs)
+                n_tries += 1
+                self.profiler.count('sw.tries')
+                if n_tries > 2:
+                    self.info['skipped_unknown_queries'] += self.remaining_queries
+                    self.profiler.count('sw.skipped_unknown', len(self.remaining_queries))
+                    break
+
+            self.finalize()
 
     # ----------------------------------------------------------------------------------------
     def finalize(self):
@@ -114,51 +171,72 @@ class Waterer(object):
                     self.true_pcounter.plot(self.args.plotdir + 'sw/true', subset_by_gene=True, cyst_positions=self.cyst_positions, tryp_positions=self.tryp_positions)
 
     # ----------------------------------------------------------------------------------------
-    def execute_command(self, base_infname, base_outfname, n_procs):
-        if n_procs == 1:
-            cmd_str = self.get_vdjalign_cmd_str(self.args.workdir, base_infname, base_outfname)
-            proc = Popen(cmd_str.split(), stdout=PIPE, stderr=PIPE)
-            out, err = proc.communicate()
-            utils.process_out_err(out, err)
-            if not self.args.no_clean:
-                os.remove(self.args.workdir + '/' + base_infname)
-        else:
-            procs = []
-            for iproc in range(n_procs):
-                cmd_str = self.get_vdjalign_cmd_str(self.args.workdir + '/sw-' + str(iproc), base_infname, base_outfname)
-                procs.append(Popen(cmd_str.split(), stdout=PIPE, stderr=PIPE))
-                time.sleep(0.1)
-            for iproc in range(len(procs)):
-                out, err = procs[iproc].communicate()
-                utils.process_out_err(out, err, extra_str=str(iproc))
+    def execute_commands(self, base_infname, base_outfname, n_chunks, n_procs):
+        """
+        Run vdjalign on each of <n_chunks> chunks, with at most <n_procs> running at once. Whenever a proc finishes, start the next chunk, then read
+        the finished chunk's output (i.e. while the other chunks are still running).
+        """
+        workdirs = [self.args.workdir]
+        if n_chunks > 1:
+            workdirs = [self.args.workdir + '/sw-' + str(ichunk) for ichunk in range(n_chunks)]
+        finished = Queue.Queue()
+        pending = collections.deque(range(n_chunks))
+        while len(pending) > 0 and n_chunks - len(pending) < n_procs:
+            ichunk = pending.popleft()
+            utils.start_watched_proc(self.get_vdjalign_cmd_str(workdirs[ichunk], base_infname, base_outfname), ichunk, finished)
+
+        n_processed = 0
+        for _ in range(n_chunks):
+            ichunk, out, err = utils.get_finished_proc(finished)
+            if len(pending) > 0:  # start the next chunk before we read this one's output
+                inext = pending.popleft()
+                utils.start_watched_proc(self.get_vdjalign_cmd_str(workdirs[inext], base_infname, base_outfname), inext, finished)
+            utils.process_out_err(out, err, extra_str=str(ichunk))
             if not self.args.no_clean:
-                for iproc in range(n_procs):
-                    os.remove(self.args.workdir + '/sw-' + str(iproc) + '/' + base_infname)
+                os.remove(workdirs[ichunk] + '/' + base_infname)
+            with self.profiler.span('sw.read_output'):
+                n_processed += self.read_output(workdirs[ichunk] + '/' + base_outfname)
+            if not self.args.no_clean and n_chunks > 1:  # still need the top-level workdir
+                os.rmdir(workdirs[ichunk])
 
         sys.stdout.flush()
+        self.finish_pass(n_processed)
 
     # ----------------------------------------------------------------------------------------
     def write_vdjalign_input(self, base_infname, n_procs):
-        queries_per_proc = float(len(self.remaining_queries)) / n_procs
-        n_queries_per_proc = int(math.ceil(queries_per_proc))
-        if n_procs == 1:  # double check for rounding problems or whatnot
-            assert n_queries_per_proc == len(self.remaining_queries)
-        for iproc in range(n_procs):
+        """
+        Split the remaining queries into chunks with about the same amount of work (sequence length, weighted up for queries we've already had to rerun), and
+        write an input file for each chunk. Returns the number of chunks.
+        """
+        n_chunks = max(n_procs, min(n_procs * self.chunks_per_proc, len(self.remaining_queries) / self.min_queries_per_chunk))
+        n_chunks = max(1, min(n_chunks, len(self.remaining_queries)))
+
+        # hand out the biggest queries first, each to whichever chunk has the least work so far
+        seqs, work = {}, {}
+        for query_name in self.remaining_queries:
+            seqs[query_name] = self.input_info[query_name]['seq']
+            if query_name in self.info['indels']:
+                seqs[query_name] = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+            work[query_name] = len(seqs[query_name]) * (1 + self.n_tries.get(query_name, 0))
+        chunk_queries = [[] for _ in range(n_chunks)]
+        chunk_work = [(0, ichunk) for ichunk in range(n_chunks)]  # heap of (total work, chunk index)
+        for query_name in sorted(self.remaining_queries, key=lambda q: work[q], reverse=True):
+            total, ichunk = heapq.heappop(chunk_work)
+            chunk_queries[ichunk].append(query_name)
+            heapq.heappush(chunk_work, (total + work[query_name], ichunk))
+
+        for ichunk in range(n_chunks):
             workdir = self.args.workdir
-            if n_procs > 1:
-                workdir += '/sw-' + str(iproc)
+            if n_chunks > 1:
+                workdir += '/sw-' + str(ichunk)
                 utils.prep_dir(workdir)
             with opener('w')(workdir + '/' + base_infname) as sub_infile:
-                for iquery in range(iproc*n_queries_per_proc, (iproc + 1)*n_queries_per_proc):
-                    if iquery >= len(self.remaining_queries):
-                        break
-                    query_name = self.remaining_queries[iquery]
+                for query_name in chunk_queries[ichunk]:
                     sub_infile.write('>' + query_name + ' NUKES\n')
+                    sub_infile.write(seqs[query_name] + '\n')
+                    self.n_tries[query_name] = self.n_tries.get(query_name, 0) + 1
 
-                    seq = self.input_info[query_name]['seq']
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    sub_infile.write(seq + '\n')
+        return n_chunks
 
     # ----------------------------------------------------------------------------------------
     def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname):
@@ -184,25 +262,70 @@ class Waterer(object):
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def read_output(self, base_outfname, n_procs=1):
+    def get_in_process_aligner(self):
+        """ return vdjalign's ig_align() if we should align this pass in-process (and we can import it), otherwise None """
+        if self.in_process_max_queries is None or len(self.remaining_queries) > self.in_process_max_queries:
+            return None
+        pydir = self.args.ighutil_dir + '/python'
+        if pydir not in sys.path:
+            sys.path.append(pydir)
+        try:
+            from vdjalign.sw import ig_align
+        except ImportError:
+            print '    couldn\'t import vdjalign.sw from %s, so running vdjalign procs instead' % pydir
+            self.in_process_max_queries = None  # don't try again
+            return None
+        return ig_align
+
+    # ----------------------------------------------------------------------------------------
+    def align_in_process(self, ig_align, base_infname):
+        """ run the remaining queries through vdjalign's aligner in this process (same options as get_vdjalign_cmd_str()), and process the sam output directly """
+        infname = self.args.workdir + '/' + base_infname
+        samfname = self.args.workdir + '/query-seqs.sam'
+        with opener('w')(infname) as infile:
+            for query_name in self.remaining_queries:
+                seq = self.input_info[query_name]['seq']
+                if query_name in self.info['indels']:
+                    seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+                infile.write('>' + query_name + ' NUKES\n' + seq + '\n')
+                self.n_tries[query_name] = self.n_tries.get(query_name, 0) + 1
+
+        match, mismatch = self.args.match_mismatch
+        reffnames = [self.args.datadir + '/igh' + region + '.fasta' for region in utils.regions]  # v, then the extra refs in d, j order
+        ig_align(reffnames[0], infname, samfname, extra_ref_paths=reffnames[1:], match=match, mismatch=mismatch, gap_open=self.args.gap_open_penalty, gap_extend=1,
+                 max_drop=50, min_score=0, bandwidth=150, n_threads=self.args.n_fewer_procs)
+
         n_processed = 0
-        for iproc in range(n_procs):
-            workdir = self.args.workdir
-            if n_procs > 1:
-                workdir += '/sw-' + str(iproc)
-            outfname = workdir + '/' + base_outfname
-            with contextlib.closing(pysam.Samfile(outfname)) as bam:
-                grouped = itertools.groupby(iter(bam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    self.n_total += 1
-                    self.process_query(bam, list(reads))
-                    n_processed += 1
+        with open(samfname) as samfile:
+            references, reads = read_sam(samfile)
+            for _, query_reads in itertools.groupby(reads, operator.attrgetter('qname')):
+                self.n_total += 1
+                self.process_query(references, list(query_reads))
+                n_processed += 1
+
+        if not self.args.no_clean:
+            os.remove(infname)
+            os.remove(samfname)
+        self.finish_pass(n_processed)
 
-            if not self.args.no_clean:
-                os.remove(outfname)
-                if n_procs > 1:  # still need the top-level workdir
-                    os.rmdir(workdir)
+    # ----------------------------------------------------------------------------------------
+    def read_output(self, outfname):
+        """ process the queries in the bam file <outfname>, and return how many there were """
+        n_processed = 0
+        with contextlib.closing(pysam.Samfile(outfname)) as bam:
+            grouped = itertools.groupby(iter(bam), operator.attrgetter('qname'))
+            for _, reads in grouped:  # loop over query sequences
+                self.n_total += 1
+                self.process_query(bam.references, list(reads))
+                n_processed += 1
+
+        if not self.args.no_clean:
+            os.remove(outfname)
+        return n_processed
 
+    # ----------------------------------------------------------------------------------------
+    def finish_pass(self, n_processed):
+        """ after reading all the chunks' output, decide what to do with the queries we weren't happy with """
         print '    processed %d queries' % n_processed
 
         if len(self.remaining_queries) > 0:
@@ -285,7 +408,7 @@ class Waterer(object):
         return indelfo
 
     # ----------------------------------------------------------------------------------------
-    def process_query(self, bam, reads):
+    def process_query(self, references, reads):
         primary = next((r for r in reads if not r.is_secondary), None)
         query_seq = primary.seq
         query_name = primary.qname
@@ -299,7 +422,7 @@ class Waterer(object):
         for read in reads:  # loop over the matches found for each query sequence
             # set this match's values
             read.seq = query_seq  # only the first one has read.seq set by default, so we need to set the rest by hand
-            gene = bam.references[read.tid]
+            gene = references[read.tid]
             region = utils.get_region(gene)
             raw_score = read.tags[0][1]  # raw because they don't include the gene choice probs
             score = raw_score
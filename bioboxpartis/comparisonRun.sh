@@ -1,5 +1,46 @@
 #This file contains commands to run the biobox encased Partis project
+#Usage (from the top level directory): ./bioboxpartis/comparisonRun.sh [simulated input csv]
+#The last line of output is '<name of biobox>:<path to plot directory>', which comparison.py records in its registry
+#Each run gets its own directory under ./bioboxpartis/runs with its own biobox.yml, input, and output, so the checkout isn't modified and concurrent runs don't step on each other
+#================
 #python ./bioboxpartis/input_data/YamlFileGenerator.py
 #mv biobox.yml ./bioboxpartis/input_data
-docker build -t bioboxpartis ./bioboxpartis 
-docker run --volume="$(pwd)/input_data:/bbx/input:ro" --volume="$(pwd)/output_data:/bbx/output:rw" bioboxpartis default
+set -o errexit
+#================
+#set up this run's directory, and copy the input sample (or the default one) into it
+INPUTFILE=./bioboxmixcr/inputDir/simu-10-leaves-1-mutate.csv
+if [ $# -gt 0 ] ; then
+	INPUTFILE=$1
+fi
+mkdir -p ./bioboxpartis/runs
+RUNDIR=$(cd $(mktemp -d ./bioboxpartis/runs/run.XXXXXX) && pwd)
+mkdir -p $RUNDIR/input $RUNDIR/output
+#fixed name, since assemble.sh picks the action by grepping biobox.yml
+cp $INPUTFILE $RUNDIR/input/seqs.csv
+#write this run's biobox.yml: cache parameters on the input sample, then run viterbi with them and plot performance against the simulation truth
+cat > $RUNDIR/input/biobox.yml <<YML
+cacheparameters:
+  isdata: false
+  nmaxqueries: -1
+  parameterdir: /bbx/output/parameters
+  plotdir: /bbx/output/parameter-plots
+  seqfile: /bbx/input/seqs.csv
+  skipunproductive: false
+runviterbi:
+  seqfile: /bbx/input/seqs.csv
+  isdata: false
+  parameterdir: /bbx/output/parameters/hmm
+  nbestevents: 1
+  nmaxqueries: -1
+  debug: 0
+  outfname: /bbx/output/viterbi.csv
+  plotdir: /bbx/output/plots
+  plotperformance: true
+YML
+#================
+#run docker commands
+docker build -t bioboxpartis ./bioboxpartis
+docker run --volume="$RUNDIR/input:/bbx/input:ro" --volume="$RUNDIR/output:/bbx/output:rw" bioboxpartis default
+#================
+#write name of biobox and corresponding path to the plot directory (partis writes its performance plots to <plotdir>/hmm/performance)
+echo bioboxpartis:$RUNDIR/output/plots/hmm/performance
@@ -1,107 +1,179 @@
 #!/usr/bin/env python
 #8-20-15
-#This script runs comparisons for the percent of correct gene calls on VDJ Alignment projects packaged into bioboxes. 
-#TBI: reprompt after every insertion
+#This script runs comparisons for the percent of correct gene calls on VDJ Alignment projects packaged into bioboxes.
+#Usage (from this directory):
+#	./comparison.py --bioboxes bioboxmixcr:bioboxpartis --input <simulated data file> [--n-workers <n>]
+#runs each biobox's comparisonRun.sh at the same time (at most <n> at once), records each biobox's plot directory in dataFile.txt,
+#stores their percent of correct gene calls under this run in the result store (results.db), and writes the ranked v, d, and j gene comparison for the run to results.txt.
+#Leave out --bioboxes to just compare the bioboxes that are already in dataFile.txt, or use --trend to see how a biobox did over all the stored runs.
 #==============================
 #Importing relevant modules
+import argparse
 import subprocess
 import os
 import csv
 import sys
-import operator
+import time
+from multiprocessing.pool import ThreadPool
+from resultstore import ResultStore, regions
 #==============================
 #This function parses the data file and stores the information collected into a dictionary
-def parseFile(dataFile, dataDict):
-	#if data file is not empty parse it 
-	if os.stat(dataFileName).st_size != 0:
+def parseFile(dataFileName, dataDict):
+	#if data file is not empty parse it
+	if os.path.exists(dataFileName) and os.stat(dataFileName).st_size != 0:
 		with open(dataFileName) as file:
 			for line in file:
 				line = line.rstrip()
-				temp=line.split(':')
+				if line == '':
+					continue
+				temp=line.split(':', 1)
 				dataDict[temp[0]] = temp[1]
 #==============================
+#This function writes the dictionary back to the data file. It writes to a temporary file and then renames it, so an interrupted run never leaves a truncated registry behind.
+def writeFile(dataFileName, dataDict):
+	tmpFileName = dataFileName + '.tmp'
+	with open(tmpFileName, 'w') as file:
+		for biobox in sorted(dataDict):
+			file.write('%s:%s\n' % (biobox, dataDict[biobox]))
+	os.rename(tmpFileName, dataFileName)
+#==============================
 #returns percentages and error from csv files in dictionary format
 def getCSV(paths):
 	#dictionary containing the percentage value and margin of error per biobox
 	percentages = {}
 	for biobox in paths:
 		csvfile=paths[biobox]
-		#parse csv file		
+		#parse csv file
 		with open(csvfile) as file:
-			reader = csv.DictReader(file, delimiter=',')	
+			reader = csv.DictReader(file, delimiter=',')
 			for row in reader:
 				if row['bin_low_edge']=='-0.5':
-		        		percentages[biobox]=row['contents']+','+row['binerror']	
+					percentages[biobox]=row['contents']+','+row['binerror']
 	#the values are in the string format 'contents,binerror' (i.e. 1.0,0.005450822838987679)
 	return percentages
 #==============================
-#output to a file the rank, name of biobox and percentage of bin error for each biobox in the input dictionary
-def compare(csvDict):
-	sortedList=sorted(csvDict.items(), key=operator.itemgetter(1)) 		
-	file = open('results.txt', 'w')
-	for i in sortedList:
-		print>>file, i
-	file.close()					
+#adds the bioboxes in the data file that aren't in the result store at all to <run> (i.e. from a data file written before there was a result store)
+def addRegistered(store, run, dataDict):
+	for biobox, plotdir in dataDict.items():
+		if store.has(biobox):
+			continue
+		if not os.path.exists(plotdir + '/plots'):
+			print '  WARNING %s not found for %s, skipping' % (plotdir + '/plots', biobox)
+			continue
+		try:
+			store.addPlotdir(run, biobox, plotdir, getCSV)
+		except Exception as err:
+			print '  WARNING couldn\'t read results for %s from %s (%s), skipping' % (biobox, plotdir, err)
 #==============================
-#name of original simulated data file
-inputData = 'simulatedDataFiles/simu-10-leaves-1-mutate.csv'
-#dictionary to hold info from dataFile
-dataDict = {}			 
-#Create an empty text file that will store the paths to the output plot directory
-dataFileName = 'dataFile.txt'
-dataFile = open(dataFileName, 'w')
-dataFile.close()
-parseFile(dataFile, dataDict)
+#output to a file the rank, name of biobox and percentage of bin error for each biobox and each region in <run>
+def compare(store, run, outFileName='results.txt'):
+	print 'run ' + run
+	with open(outFileName, 'w') as file:
+		writer = csv.DictWriter(file, ('region', 'rank', 'biobox', 'percent_correct', 'binerror'))
+		writer.writeheader()
+		for region in regions:
+			for irank, biobox, percent, binerror in store.rank(run, region):
+				writer.writerow({'region' : region, 'rank' : irank, 'biobox' : biobox, 'percent_correct' : percent, 'binerror' : binerror})
+				print '  %s  %d  %-20s %.4f +/- %.4f' % (region, irank, biobox, percent, binerror)
 #==============================
-#Asks user for action to be taken
-actions = {'1':'Compare current bioboxes', '2':'Add new biobox', '3':'Run projects with new simulated data file'}
-print 'The following dictionary displays actions that can be taken: '
-print actions
-index = raw_input('Enter the number corresponding to the action you want to take: ')
-#TBI: reprompt if input not in dictionary
-action = actions[index]
-print 'You have selected: '+action
+#runs one biobox's docker pipeline and plot performance script, and returns (name of biobox, path to plot directory or None, run time)
+#comparisonRun.sh has to be run from this directory and must finish by printing '<name of biobox>:<path to plot directory>'
+#NOTE to add a new biobox, the directory must be in the same directory as this script
+def runBiobox(biobox, inputData):
+	start = time.time()
+	cmd = ['bash', './' + biobox + '/comparisonRun.sh']
+	if inputData is not None:
+		cmd.append(inputData)
+	logFileName = biobox + '/comparisonRun.log'
+	plotdir = None
+	try:
+		with open(logFileName, 'w') as logfile:
+			proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+			out, _ = proc.communicate()
+			logfile.write(out)
+	except (OSError, IOError) as err:  #couldn't start it at all, so it's a failed run like any other
+		print '  %s: %s' % (biobox, err)
+		return biobox, plotdir, time.time() - start
+	if proc.returncode == 0:
+		for line in reversed(out.splitlines()):
+			if line.startswith(biobox + ':'):
+				plotdir = line.split(':', 1)[1].strip()
+				break
+	return biobox, plotdir, time.time() - start
 #==============================
-#Looks at the plot performance of each biobox (percent v, d, and j correct)
-if action == 'Compare current bioboxes':
-	#if data file is empty, print error message and break
-	if os.stat(dataFileName).st_size == 0:
-		sys.exit('There are no bioboxes currently listed in '+dataFileName)
-	#else compare percentages located in dataDict dictionary
-	else:
-		#dictionary containing names of bioboxes and paths to csv files
-		paths = {}
-		#add names of bioboxes to dictionary
-		for biobox in dataDict:
-			paths[dataDict[biobox]] = ''	
-		#add name of csv file of gene to compare to end of path to plot direcotry
-		percentagesToCompare = {1:'v_gene', 2:'d_gene', 3:'j_gene'}
-		print 'The following dictionary displays the types of comparisons possible'
-		print percentagesToCompare
-		percentToCompare = percentagesToCompare[raw_input('Pick the number corresponding to a percentage to compare')]+'.csv'			
-		for biobox in paths:
-			paths[biobox]+=percentageToCompare
-		#compare the csv files	
-		percentages=getCSV(paths)
-		#output results in sorted order to file
-		compare(percentages)
+#prints the percent of correct gene calls for <biobox> in each of the stored runs
+def trend(store, biobox):
+	for region in regions:
+		for run, percent, binerror in store.trend(biobox, region):
+			print '  %s  %-30s %.4f +/- %.4f' % (region, run, percent, binerror)
+#==============================
+#runs the bioboxes in a pool of at most <nWorkers> at a time, recording each one in the data file and the result store as soon as it finishes
+#a biobox whose run or results fail is recorded in the returned list of failures, and the others keep going
+def runBioboxes(bioboxes, inputData, nWorkers, dataFileName, dataDict, store, run):
+	pool = ThreadPool(min(nWorkers, len(bioboxes)))
+	failures = []
+	try:
+		for biobox, plotdir, runtime in pool.imap_unordered(lambda b: runBiobox(b, inputData), bioboxes):
+			if plotdir is None:
+				print '  %s failed after %.1fs (see %s/comparisonRun.log)' % (biobox, runtime, biobox)
+				failures.append(biobox)
+				continue
+			try:
+				store.addPlotdir(run, biobox, plotdir, getCSV)
+			except Exception as err:
+				print '  %s failed after %.1fs: couldn\'t read results from %s (%s)' % (biobox, runtime, plotdir, err)
+				failures.append(biobox)
+				continue
+			print '  %s finished in %.1fs: %s' % (biobox, runtime, plotdir)
+			dataDict[biobox] = plotdir
+			writeFile(dataFileName, dataDict)
+	finally:
+		pool.close()
+		pool.join()
+	return failures
 #==============================
-#Adds a new biobox into dataFile.txt, dataFile.txt is basically a dictionary with keys containing the names of the
+parser = argparse.ArgumentParser()
+parser.add_argument('--bioboxes', help='colon-separated list of biobox directories to run (e.g. bioboxmixcr:bioboxpartis)')
+parser.add_argument('--input', help='simulated data file to run the bioboxes on (if not set, each biobox uses its default input)')
+parser.add_argument('--n-workers', type=int, default=2, help='maximum number of bioboxes to run at once')
+parser.add_argument('--datafile', default='dataFile.txt', help='registry of biobox names and plot directories (kept between runs)')
+parser.add_argument('--outfile', default='results.txt')
+parser.add_argument('--store', default='results.db', help='sqlite file with the results of every biobox, run, and region (kept between runs)')
+parser.add_argument('--run', help='name under which to store and compare results (default: name of the input file, or the most recent run if no bioboxes are run)')
+parser.add_argument('--trend', help='print the stored results for this biobox over all runs, instead of comparing')
+args = parser.parse_args()
+if args.input is not None:
+	args.input = os.path.abspath(args.input)
+store = ResultStore(args.store)
+if args.trend is not None:
+	trend(store, args.trend)
+	sys.exit(0)
+#==============================
+#dictionary to hold info from the data file, which is basically a dictionary with keys containing the names of the
 #bioboxes and values containing the path to their output directory (plot performance data)
-#NOTE: to add a new biobox, the directory must be in the same directory as this script
-elif action == 'Add new biobox':
-	#enter name of the biobox, run biobox with current data file, return path to plotting data 
-	bioboxname = raw_input('Enter the name of the new biobox: ')
-	#TBI: if biobox already in directory print message
-	comparisonRunPath='./'+bioboxname+'/comparisonRun.sh'
-	#TBI: pass in dataFileName as parameter
-	#calls the shellscript that will ask for parameters to generate an input yaml file, run the docker image, and run plot performance
-	subprocess.call(comparisonRunPath, shell=True)
+dataDict = {}
+parseFile(args.datafile, dataDict)
+failures = []
+if args.bioboxes is not None:
+	bioboxes = args.bioboxes.strip().split(':')
+	for biobox in bioboxes:
+		if not os.path.exists('./' + biobox + '/comparisonRun.sh'):
+			sys.exit('no comparisonRun.sh found for biobox ' + biobox)
+	if args.run is None:
+		args.run = 'default' if args.input is None else os.path.basename(args.input)
+	failures = runBioboxes(bioboxes, args.input, args.n_workers, args.datafile, dataDict, store, args.run)
 #==============================
-#TBI: run projects with new simulated file
-#elif action == 'Run projects with new simulated data file':
-	#select which projects to run with new data file, run those projects 
+#Looks at the plot performance of each biobox (percent v, d, and j correct)
+if len(dataDict) == 0:
+	sys.exit('There are no bioboxes currently listed in ' + args.datafile)
+if args.run is None:
+	storedRuns = store.runs()
+	args.run = storedRuns[-1] if len(storedRuns) > 0 else 'default'
+addRegistered(store, args.run, dataDict)
+compare(store, args.run, args.outfile)
+store.close()
 #==============================
+if len(failures) > 0:
+	sys.exit('failed bioboxes: ' + ' '.join(failures))
 print 'PROCESS COMPLETED'
 #==============================
-
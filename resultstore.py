@@ -0,0 +1,51 @@
+#This module keeps the percent of correct gene calls for every biobox, run, and region in a single indexed sqlite table, so that
+#rankings and trends over many runs are a keyed lookup rather than a walk over every biobox's plot directory.
+#==============================
+#Importing relevant modules
+import sqlite3
+import time
+#==============================
+#the regions whose percent of correct gene calls we store
+regions = ['v', 'd', 'j']
+#==============================
+class ResultStore(object):
+	#==============================
+	def __init__(self, fname):
+		self.fname = fname
+		self.db = sqlite3.connect(fname)
+		self.db.execute('CREATE TABLE IF NOT EXISTS results (run TEXT, biobox TEXT, region TEXT, percent_correct REAL, binerror REAL, plotdir TEXT, added REAL, PRIMARY KEY (run, biobox, region))')
+		self.db.execute('CREATE INDEX IF NOT EXISTS results_by_biobox ON results (biobox, region)')
+		self.db.commit()
+	#==============================
+	def close(self):
+		self.db.close()
+	#==============================
+	#reads the v, d, and j gene csv files in a biobox's plot directory (once) and adds them under <run>
+	#<getCSV> is comparison.getCSV, which returns the 'contents,binerror' string for each biobox
+	def addPlotdir(self, run, biobox, plotdir, getCSV):
+		with self.db:
+			for region in regions:
+				percentages = getCSV({biobox : plotdir + '/plots/' + region + '_gene.csv'})
+				if biobox not in percentages:
+					raise Exception('no percent correct found for %s in %s' % (biobox, plotdir))
+				percent, binerror = [float(val) for val in percentages[biobox].split(',')]
+				self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', (run, biobox, region, percent, binerror, plotdir, time.time()))
+	#==============================
+	#returns True if there are results for <biobox> (in <run>, if it's set)
+	def has(self, biobox, run=None):
+		if run is None:
+			return self.db.execute('SELECT 1 FROM results WHERE biobox = ? LIMIT 1', (biobox, )).fetchone() is not None
+		return self.db.execute('SELECT 1 FROM results WHERE run = ? AND biobox = ? LIMIT 1', (run, biobox)).fetchone() is not None
+	#==============================
+	#returns the names of the runs, most recently added last
+	def runs(self):
+		return [row[0] for row in self.db.execute('SELECT run FROM results GROUP BY run ORDER BY MAX(added)')]
+	#==============================
+	#returns a list of (rank, name of biobox, percentage, bin error) tuples for <region> in <run>, best first
+	def rank(self, run, region):
+		rows = self.db.execute('SELECT biobox, percent_correct, binerror FROM results WHERE run = ? AND region = ? ORDER BY percent_correct DESC', (run, region)).fetchall()
+		return [(irank + 1, ) + tuple(rows[irank]) for irank in range(len(rows))]
+	#==============================
+	#returns a list of (run, percentage, bin error) tuples for <biobox> and <region>, in the order the runs were added
+	def trend(self, biobox, region):
+		return [tuple(row) for row in self.db.execute('SELECT run, percent_correct, binerror FROM results WHERE biobox = ? AND region = ? ORDER BY added', (biobox, region))]